@@ -0,0 +1,86 @@
+"""Buffer pool
+
+This module keeps image buffers that are no longer in use so that the next image of the same
+dimensions can be read into one instead of allocating new memory. Images from one camera all
+have the same dimensions, so a long running process reuses the same few buffers.
+"""
+
+import threading
+
+import numpy as np
+
+# Default limit of the memory held by buffers that aren't in use
+DEFAULT_BUFFER_POOL_MB = 512
+
+
+class BufferPool(object):
+    """Size limited pool of numpy buffers, matched by shape and type
+    """
+
+    def __init__(self, max_mb=DEFAULT_BUFFER_POOL_MB):
+        """Initializes the pool
+        Args:
+            max_mb(int): the most memory to hold in buffers that aren't in use, in megabytes
+        """
+        self.max_bytes = max_mb * 1024 * 1024
+        self.free = []
+        self.free_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def set_max_mb(self, max_mb):
+        """Changes the limit of the pool, releasing buffers that no longer fit
+        Args:
+            max_mb(int): the most memory to hold in buffers that aren't in use, in megabytes
+        """
+        with self.lock:
+            self.max_bytes = max_mb * 1024 * 1024
+            self.trim()
+
+    def get(self, shape, dtype=np.uint8):
+        """Returns a buffer, reusing a free one of the same shape and type when there is one
+        Args:
+            shape(tuple): the shape of the buffer
+            dtype(numpy dtype): the type of the buffer's elements
+        Return:
+            The buffer; its contents are undefined
+        """
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        with self.lock:
+            # The most recently released buffers are checked first
+            for idx in range(len(self.free) - 1, -1, -1):
+                one_buffer = self.free[idx]
+                if one_buffer.shape == shape and one_buffer.dtype == dtype:
+                    del self.free[idx]
+                    self.free_bytes -= one_buffer.nbytes
+                    self.hits += 1
+                    return one_buffer
+            self.misses += 1
+
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, buf):
+        """Returns a buffer to the pool once its contents are no longer needed
+        Args:
+            buf(numpy array): a buffer returned by get(); views of it aren't accepted
+        Notes:
+            The least recently released buffers are dropped when the pool is over its limit.
+            Buffers that aren't released are freed as usual
+        """
+        if buf is None or buf.base is not None or not buf.flags.c_contiguous:
+            return
+
+        with self.lock:
+            if any(one_buffer is buf for one_buffer in self.free):
+                return
+            self.free.append(buf)
+            self.free_bytes += buf.nbytes
+            self.trim()
+
+    def trim(self):
+        """Drops the least recently released buffers until the pool is within its limit
+        """
+        while self.free and self.free_bytes > self.max_bytes:
+            self.free_bytes -= self.free.pop(0).nbytes
@@ -0,0 +1,243 @@
+"""Component labels
+
+This module labels the connected components of a boolean mask in horizontal strips, using
+worker threads, and merges the components that continue across the strip seams with a
+union-find. Component areas and overlaps are those of the whole mask, so thresholds applied to
+them give the same result as labeling the mask in one piece.
+"""
+
+import os
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import cv2
+
+# Number of threads labeling a mask; 1 labels the whole mask at once
+DEFAULT_LABEL_WORKERS = 1
+
+# Fewest rows in a strip; smaller masks are split into fewer strips
+MIN_STRIP_ROWS = 64
+
+# The configured number of threads, and the pool of threads with the process that created it
+_label_workers = DEFAULT_LABEL_WORKERS
+_thread_pool = None
+_thread_pool_pid = None
+_thread_pool_workers = None
+
+
+def set_label_workers(workers):
+    """Sets the number of threads used to label masks in this process
+    Args:
+        workers(int): the number of threads; values below 1 are treated as 1
+    """
+    global _label_workers
+    _label_workers = max(int(workers), 1)
+
+
+def get_label_workers():
+    """Returns the number of threads used to label masks in this process
+    """
+    return _label_workers
+
+
+def get_thread_pool(workers):
+    """Returns the pool of labeling threads, creating it as needed
+    Args:
+        workers(int): the number of threads the pool needs
+    Return:
+        The ThreadPool instance
+    Notes:
+        Threads don't survive a fork, so a pool created by another process isn't reused
+    """
+    global _thread_pool, _thread_pool_pid, _thread_pool_workers
+    if _thread_pool is None or _thread_pool_pid != os.getpid() or _thread_pool_workers != workers:
+        if _thread_pool is not None and _thread_pool_pid == os.getpid():
+            _thread_pool.terminate()
+        _thread_pool = ThreadPool(workers)
+        _thread_pool_pid = os.getpid()
+        _thread_pool_workers = workers
+
+    return _thread_pool
+
+
+def strip_bounds(rows, strips):
+    """Splits rows into strips of nearly equal height
+    Args:
+        rows(int): the number of rows to split
+        strips(int): the number of strips wanted
+    Return:
+        A list of (first row, row after the last) tuples
+    """
+    strips = max(min(strips, rows // MIN_STRIP_ROWS), 1)
+    edges = [rows * idx // strips for idx in range(strips + 1)]
+    return [(edges[idx], edges[idx + 1]) for idx in range(strips)]
+
+
+def find_roots(parents, first, second):
+    """Merges pairs of components with a vectorized union-find
+    Args:
+        parents(numpy array): the parent of each component, where every component points at
+                              its root and roots point at themselves
+        first(numpy array): the components on one side of each connection
+        second(numpy array): the components on the other side of each connection
+    Return:
+        The array of the root of each component after the merges
+    Notes:
+        Roots are hooked onto the smaller of the two roots of each connection and the paths are
+        compressed until every pair of connected components has the same root
+    """
+    while True:
+        first_roots, second_roots = parents[first], parents[second]
+        differ = first_roots != second_roots
+        if not np.any(differ):
+            return parents
+
+        first_roots, second_roots = first_roots[differ], second_roots[differ]
+        np.minimum.at(parents, np.maximum(first_roots, second_roots),
+                      np.minimum(first_roots, second_roots))
+
+        while True:
+            grandparents = parents[parents]
+            if np.array_equal(grandparents, parents):
+                break
+            parents = grandparents
+
+
+class ComponentLabels(object):
+    """The connected components of a boolean mask, labeled in strips
+    """
+
+    def __init__(self, mask, connectivity=4, workers=None):
+        """Labels the components of a mask
+        Args:
+            mask(numpy array): the boolean mask to label
+            connectivity(int): 4 or 8 connected neighbours
+            workers(int): the number of threads labeling strips, or None for the number set by
+                          set_label_workers()
+        Notes:
+            Each strip keeps its own labels starting at 1. A component is identified across the
+            strips by the strip's offset plus its label, and 0 is the background of all strips
+        """
+        self.shape = mask.shape
+        self.workers = get_label_workers() if workers is None else max(workers, 1)
+        self.strips = strip_bounds(mask.shape[0], self.workers)
+        self.labels = np.empty(mask.shape, dtype=np.int32)
+
+        counts = self.map_strips(self.label_strip, [(mask, connectivity, strip)
+                                                    for strip in self.strips])
+
+        self.counts = [one_count for one_count, _ in counts]
+        self.offsets = np.cumsum([0] + self.counts[:-1])
+        num = sum(self.counts)
+
+        areas = np.zeros(num + 1, dtype=np.int64)
+        for offset, (one_count, strip_areas) in zip(self.offsets, counts):
+            areas[0] += strip_areas[0]
+            areas[offset + 1:offset + one_count + 1] = strip_areas[1:]
+
+        self.roots = self.merge_seams(connectivity, num)
+        self.areas = self.component_totals(areas)
+
+    def map_strips(self, function, args):
+        """Runs a function on each strip, in the labeling threads when there's more than one
+        """
+        if len(args) > 1:
+            return get_thread_pool(self.workers).map(function, args)
+        return [function(one_arg) for one_arg in args]
+
+    def label_strip(self, args):
+        """Labels one strip of the mask
+        Args:
+            args(tuple): the mask, the connectivity, and the (first row, row after the last) of
+                         the strip
+        Return:
+            A tuple of the number of components in the strip, and the area of each of its
+            labels including the background
+        """
+        mask, connectivity, (first, last) = args
+        # The strip's rows of the label image are contiguous, so they're labeled in place
+        num, _, stats, _ = cv2.connectedComponentsWithStats(mask[first:last].view(np.uint8),
+                                                            labels=self.labels[first:last],
+                                                            connectivity=connectivity,
+                                                            ltype=cv2.CV_32S)
+
+        return (num - 1, stats[:, cv2.CC_STAT_AREA])
+
+    def global_labels(self, strip_index, labels):
+        """Returns the identifiers of a strip's labels across the strips, keeping 0 as background
+        """
+        return np.where(labels > 0, labels + self.offsets[strip_index], 0)
+
+    def merge_seams(self, connectivity, num):
+        """Finds the root of each component, merging the components that touch across seams
+        Return:
+            The array of the root of each component, indexed by identifier
+        """
+        parents = np.arange(num + 1)
+        first, second = [], []
+        for idx in range(1, len(self.strips)):
+            seam = self.strips[idx][0]
+            above = self.global_labels(idx - 1, self.labels[seam - 1])
+            below = self.global_labels(idx, self.labels[seam])
+
+            pairs = [(above, below)]
+            if connectivity == 8:
+                pairs.extend([(above[:-1], below[1:]), (above[1:], below[:-1])])
+            for one_above, one_below in pairs:
+                touching = (one_above > 0) & (one_below > 0)
+                first.append(one_above[touching])
+                second.append(one_below[touching])
+
+        if first:
+            parents = find_roots(parents, np.concatenate(first), np.concatenate(second))
+
+        return parents
+
+    def component_totals(self, values):
+        """Adds up the values of the labels of each component
+        Args:
+            values(numpy array): a value for each identifier
+        Return:
+            The total of the component each identifier belongs to, indexed by identifier
+        """
+        totals = np.bincount(self.roots, weights=values, minlength=values.size)
+        return totals.astype(np.int64)[self.roots]
+
+    def overlaps(self, mask):
+        """Determines which components have pixels in a mask
+        Args:
+            mask(numpy array): the boolean mask to check the components against
+        Return:
+            A boolean array indexed by identifier, including the background
+        """
+        counts = np.zeros(self.roots.size, dtype=np.int64)
+        for idx, (first, last) in enumerate(self.strips):
+            offset, count = self.offsets[idx], self.counts[idx]
+            strip_counts = np.bincount(self.labels[first:last][mask[first:last]],
+                                       minlength=count + 1)
+            counts[0] += strip_counts[0]
+            counts[offset + 1:offset + count + 1] = strip_counts[1:]
+
+        return self.component_totals(counts) > 0
+
+    def select(self, chosen):
+        """Returns the mask of the pixels in the chosen components
+        Args:
+            chosen(numpy array): boolean array indexed by identifier; index 0 is the background
+        Return:
+            The boolean mask
+        """
+        selected = np.empty(self.shape, dtype=np.bool_)
+        self.map_strips(self.select_strip, [(chosen, selected, idx)
+                                            for idx in range(len(self.strips))])
+        return selected
+
+    def select_strip(self, args):
+        """Fills in one strip of the selected pixels, see select()
+        """
+        chosen, selected, idx = args
+        first, last = self.strips[idx]
+        offset, count = self.offsets[idx], self.counts[idx]
+
+        lookup = np.concatenate((chosen[:1], chosen[offset + 1:offset + count + 1]))
+        np.take(lookup, self.labels[first:last], out=selected[first:last])
@@ -0,0 +1,212 @@
+"""Image quality
+
+This module scores the quality of an image that's already been decoded into memory. The
+grayscale plane is calculated once and summarized in a histogram; the threshold counts and the
+brightness are answered from the histogram, and the plane is shared with the MAC score and the
+saturated mask process.
+"""
+
+import numpy as np
+import cv2
+
+# Number of rows processed at a time to keep temporary arrays small
+CHUNK_ROWS = 256
+
+# Number of grayscale values, and bins in an image histogram
+HISTOGRAM_BINS = 256
+
+# Grayscale value above which a pixel is saturated, and below which a pixel is low valued
+SATURATE_THRESHOLD = 245
+LOW_PIXEL_THRESHOLD = 20
+
+# Multiscale Autocorrelation row offsets
+MAC_SCALES = (2, 3, 5)
+
+# Limits of an acceptable image: the portion of low valued pixels, the range of the average
+# pixel value, and the smallest Multiscale Autocorrelation score
+MAX_LOW_RATE = 0.1
+MIN_BRIGHTNESS = 30
+MAX_BRIGHTNESS = 195
+MIN_MAC_SCORE = 13
+
+
+def grayscale(img, channel_order='bgr'):
+    """Calculates the grayscale plane of an image
+    Args:
+        img(numpy array): uint8 image as rows x columns x channels, or a single plane
+        channel_order(str): the order of the color channels in the image, 'bgr' or 'rgb'
+    Return:
+        A uint8 array of grayscale values
+    Notes:
+        This is the same plane as cv2.cvtColor() returns, which the mask process classifies
+        saturated pixels with, so the plane can be shared between them. cvtColor() converts
+        uint8 images in fixed point with 15-bit weights; 8-bit weights would fit in uint16 but
+        differ from its plane by one level on some pixels
+    """
+    if img.ndim == 2:
+        return img
+
+    if channel_order == 'bgr':
+        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+
+
+def gray_histogram(gray):
+    """Counts the pixels of each grayscale value
+    Args:
+        gray(numpy array): the uint8 grayscale plane
+    Return:
+        An int64 array of HISTOGRAM_BINS counts
+    Notes:
+        The plane is counted a chunk of rows at a time since counting widens the values
+    """
+    histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    for start in range(0, gray.shape[0], CHUNK_ROWS):
+        histogram += np.bincount(gray[start:start + CHUNK_ROWS].ravel(),
+                                 minlength=HISTOGRAM_BINS)
+
+    return histogram
+
+
+def mac_score(gray, scales=MAC_SCALES):
+    """Calculates the Multiscale Autocorrelation (MAC) score of a grayscale plane
+    Args:
+        gray(numpy array): the grayscale plane
+        scales(tuple): the row offsets to correlate, in increasing order
+    Return:
+        The MAC score
+    Notes:
+        Returns the same score as terra_rgbmask.MAC() for the same grayscale plane, including
+        the last rows that MAC() leaves holding values from earlier scales. Products are formed
+        over row views a chunk at a time instead of on shifted copies of the image.
+    """
+    rows = gray.shape[0]
+    max_scale = max(scales)
+    if rows <= max_scale:
+        return 0.0
+
+    # Rows before the tail only ever compare against the current scale's row
+    body_rows = rows - max_scale
+    totals = [0] * len(scales)
+    for start in range(0, body_rows, CHUNK_ROWS):
+        end = min(start + CHUNK_ROWS, body_rows)
+        center = gray[start:end]
+        for idx, scale in enumerate(scales):
+            diff = np.subtract(gray[start + 1:end + 1], gray[start + scale:end + scale],
+                               dtype=np.int32)
+            np.multiply(diff, center, out=diff)
+            totals[idx] += int(diff.sum(dtype=np.int64))
+
+    # The tail rows keep the values left by earlier scales, as they do in MAC()
+    center = gray[body_rows:].astype(np.int32)
+    shifted = center.copy()
+    shifted[:-1] = gray[body_rows + 1:]
+    tail = center.copy()
+    for idx, scale in enumerate(scales):
+        tail[:max_scale - scale] = gray[body_rows + scale:]
+        totals[idx] += int((center * (shifted - tail)).sum(dtype=np.int64))
+
+    return float(np.mean(totals)) / float(gray.size)
+
+
+class ImageStatistics(object):
+    """Grayscale statistics of an image, calculated once and shared by the quality checks and
+    the mask process
+    """
+
+    def __init__(self, histogram, gray=None, mac=None):
+        """Initializes the statistics
+        Args:
+            histogram(numpy array): the counts of each grayscale value, see gray_histogram()
+            gray(numpy array): the grayscale plane, or None if it's not available
+            mac(float): the MAC score, or None to calculate it from the grayscale plane
+        """
+        self.histogram = histogram
+        self.gray = gray
+        self.pixels = float(histogram.sum())
+        self._mac = mac
+
+    @classmethod
+    def from_image(cls, img, channel_order='bgr', sample_step=1):
+        """Calculates the statistics of an image
+        Args:
+            img(numpy array): uint8 image as rows x columns x channels
+            channel_order(str): the order of the color channels in the image, 'bgr' or 'rgb'
+            sample_step(int): use every sample_step row and column of the image to estimate the
+                              statistics; 1 uses all pixels
+        Return:
+            The ImageStatistics instance
+        Notes:
+            Estimates don't keep the grayscale plane, so they have no MAC score
+        """
+        if sample_step and sample_step > 1:
+            gray = grayscale(np.ascontiguousarray(img[::sample_step, ::sample_step]),
+                             channel_order)
+            return cls(gray_histogram(gray))
+
+        gray = grayscale(img, channel_order)
+        return cls(gray_histogram(gray), gray)
+
+    def over_rate(self, threshold=SATURATE_THRESHOLD):
+        """Returns the portion of pixels with grayscale values above the threshold
+        """
+        return float(self.histogram[threshold + 1:].sum()) / self.pixels
+
+    def low_rate(self, threshold=LOW_PIXEL_THRESHOLD):
+        """Returns the portion of pixels with grayscale values below the threshold
+        """
+        return float(self.histogram[:threshold].sum()) / self.pixels
+
+    def brightness(self):
+        """Returns the average grayscale value
+        """
+        return float(np.dot(np.arange(HISTOGRAM_BINS), self.histogram)) / self.pixels
+
+    def mac(self):
+        """Returns the MAC score, calculating it the first time it's needed
+        Exception:
+            A ValueError is raised if the statistics don't have a grayscale plane or a score
+        """
+        if self._mac is None:
+            if self.gray is None:
+                raise ValueError("The MAC score needs the full grayscale plane of the image")
+            self._mac = mac_score(self.gray)
+        return self._mac
+
+    def quality(self, saturate_threshold=SATURATE_THRESHOLD, low_threshold=LOW_PIXEL_THRESHOLD):
+        """Returns the quality scores, see image_quality()
+        """
+        return {
+            'over_rate': self.over_rate(saturate_threshold),
+            'low_rate': self.low_rate(low_threshold),
+            'brightness': self.brightness(),
+            'mac': self.mac()
+        }
+
+
+def image_quality(img, channel_order='bgr', saturate_threshold=SATURATE_THRESHOLD,
+                  low_threshold=LOW_PIXEL_THRESHOLD):
+    """Calculates all the quality scores of an image
+    Args:
+        img(numpy array): uint8 image as rows x columns x channels
+        channel_order(str): the order of the color channels in the image, 'bgr' or 'rgb'
+        saturate_threshold(int): grayscale values above this are counted as saturated
+        low_threshold(int): grayscale values below this are counted as low
+    Return:
+        A dictionary with the portion of saturated pixels ('over_rate'), the portion of low
+        valued pixels ('low_rate'), the average pixel value ('brightness'), and the MAC
+        score ('mac')
+    """
+    return ImageStatistics.from_image(img, channel_order).quality(saturate_threshold,
+                                                                  low_threshold)
+
+
+def is_low_quality(quality):
+    """Determines if an image should be rejected based upon its quality scores
+    Args:
+        quality(dict): the scores as returned by image_quality()
+    Return:
+        True if the image is of low quality and False otherwise
+    """
+    return quality['low_rate'] > MAX_LOW_RATE or quality['brightness'] < MIN_BRIGHTNESS or \
+           quality['brightness'] > MAX_BRIGHTNESS or quality['mac'] < MIN_MAC_SCORE
@@ -0,0 +1,223 @@
+"""Mask cache
+
+This module keeps the masks of images on disk, keyed by a fingerprint of the image's bytes and
+the parameters the mask was generated with, so that unchanged images don't need to be masked
+again. Masks are stored bit packed and the least recently used entries are removed when the
+cache grows past its size limit. The size of the cache is tracked as entries are added, so
+the folder is only walked when the cache may be over its limit.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+
+# Increase when the way masks are generated changes without any of the parameters changing
+CACHE_VERSION = 2
+
+# Number of bytes read at a time when fingerprinting a file
+READ_CHUNK_BYTES = 1024 * 1024
+
+# File name extensions of cache entries, and of entries that are being written
+ENTRY_EXTENSION = '.npz'
+TEMP_EXTENSION = '.tmp'
+
+# Fraction of the size limit that eviction brings the cache down to, leaving room for new entries
+# before the folder needs to be walked again
+EVICT_TO_FRACTION = 0.9
+
+# Estimated size in bytes of each cache folder used by this process; entries added by other
+# processes are only counted once the folder is walked again
+_cache_sizes = {}
+
+
+def file_fingerprint(file_name, params):
+    """Calculates the fingerprint of a file and the parameters used to process it
+    Args:
+        file_name(str): path of the file
+        params(dict): the parameters that determine the result of processing the file; the
+                      values need to be JSON serializable
+    Return:
+        The SHA-256 fingerprint as a hexadecimal string
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'version': CACHE_VERSION, 'params': params},
+                             sort_keys=True).encode('utf-8'))
+    with open(file_name, 'rb') as in_file:
+        chunk = in_file.read(READ_CHUNK_BYTES)
+        while chunk:
+            digest.update(chunk)
+            chunk = in_file.read(READ_CHUNK_BYTES)
+
+    return digest.hexdigest()
+
+
+class MaskCache(object):
+    """Size limited on-disk cache of image masks and their plant ratios
+    """
+
+    def __init__(self, cache_dir, max_mb):
+        """Initializes the cache
+        Args:
+            cache_dir(str): the folder to keep the cache in; it's created if it doesn't exist
+            max_mb(int): the largest size of the cache, in megabytes
+        Notes:
+            The folder can be shared by several processes. Entries are written to a temporary
+            file that's renamed into place, so readers only see complete entries
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Another process may have created the folder in the meantime
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def entry_path(self, key):
+        """Returns the path of the file holding an entry
+        Args:
+            key(str): the fingerprint of the entry
+        Return:
+            The path of the entry's file, which may not exist
+        """
+        return os.path.join(self.cache_dir, key[:2], key + ENTRY_EXTENSION)
+
+    def get(self, key):
+        """Looks up a mask
+        Args:
+            key(str): the fingerprint of the entry, as returned by file_fingerprint()
+        Return:
+            None if there isn't an entry. Otherwise a tuple of the plant ratio and the boolean
+            mask; both are None if the image had low quality scores
+        """
+        path = self.entry_path(key)
+        try:
+            with np.load(path) as entry:
+                if entry['low_quality']:
+                    result = (None, None)
+                else:
+                    shape = tuple(entry['shape'])
+                    size = int(np.prod(shape))
+                    mask = np.unpackbits(entry['bits'])[:size].reshape(shape).view(np.bool_)
+                    result = (float(entry['ratio']), mask)
+        except (IOError, OSError, KeyError, ValueError):
+            # Missing, or removed or damaged by another process
+            self.misses += 1
+            return None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return result
+
+    def put(self, key, ratio, mask):
+        """Stores a mask and evicts the least recently used entries if the cache is too large
+        Args:
+            key(str): the fingerprint of the entry, as returned by file_fingerprint()
+            ratio(float): the plant ratio of the image, or None if it had low quality scores
+            mask(numpy array): the boolean mask, or None if the image had low quality scores
+        Notes:
+            Entries are only evicted once the estimated size is over the limit, so a cache shared
+            by several processes can exceed its limit by the entries the other processes added
+            since this process last walked the folder
+        """
+        cached_bytes = self.cached_bytes()
+        path = self.entry_path(key)
+        entry_dir = os.path.dirname(path)
+        if not os.path.isdir(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError:
+                if not os.path.isdir(entry_dir):
+                    raise
+
+        handle, temp_path = tempfile.mkstemp(suffix=TEMP_EXTENSION, dir=entry_dir)
+        try:
+            with os.fdopen(handle, 'wb') as out_file:
+                if ratio is None:
+                    np.savez(out_file, low_quality=True)
+                else:
+                    np.savez(out_file, low_quality=False, ratio=ratio,
+                             shape=np.array(mask.shape), bits=np.packbits(mask))
+            os.rename(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        try:
+            cached_bytes += os.path.getsize(path)
+        except OSError:
+            pass
+        _cache_sizes[self.cache_dir] = cached_bytes
+
+        if cached_bytes > self.max_bytes:
+            self.evict()
+
+    def cached_bytes(self):
+        """Returns the estimated size of the cache, walking its folder the first time
+        """
+        if self.cache_dir not in _cache_sizes:
+            _cache_sizes[self.cache_dir] = self.scan()[1]
+        return _cache_sizes[self.cache_dir]
+
+    def scan(self):
+        """Walks the cache folder
+        Return:
+            A tuple of the list of (modification time, size, path) of each entry and the total
+            size of the entries
+        """
+        entries = []
+        total_bytes = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for one_file in files:
+                if not one_file.endswith(ENTRY_EXTENSION):
+                    continue
+                path = os.path.join(root, one_file)
+                try:
+                    stats = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stats.st_mtime, stats.st_size, path))
+                total_bytes += stats.st_size
+
+        return (entries, total_bytes)
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is within EVICT_TO_FRACTION
+        of its size limit
+        Return:
+            The number of entries removed
+        """
+        entries, total_bytes = self.scan()
+
+        removed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes * EVICT_TO_FRACTION:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                # Already removed by another process
+                pass
+            total_bytes -= size
+        _cache_sizes[self.cache_dir] = total_bytes
+
+        if removed:
+            logging.getLogger(__name__).debug("Removed %s entries from mask cache %s",
+                                              str(removed), self.cache_dir)
+        return removed
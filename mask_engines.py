@@ -0,0 +1,170 @@
+"""Mask engines
+
+This module holds the vegetation indices that can classify the pixels of an image as plants
+before the neighbourhood vote of the plant mask. Each engine works on the uint8 channels of a
+BGR image with int16 or float32 arithmetic and returns a boolean plane that's True for plant
+pixels.
+
+Thresholds are in the units of each index as it's usually published: pixel values for G - R,
+chromatic coordinates (each channel divided by R + G + B) for ExG and ExG - ExR, and the index
+value for the VARI and NGRDI ratios.
+"""
+
+import numpy as np
+
+# Engine used when none is specified; it's the original G > R rule
+DEFAULT_MASK_ENGINE = 'g-r'
+
+
+def green_minus_red(img, threshold):
+    """Classifies pixels whose green value exceeds their red value by more than the threshold
+    Args:
+        img(numpy array): uint8 BGR image as rows x columns x channels
+        threshold(int): the difference that G - R must exceed
+    Return:
+        The boolean plane of plant pixels
+    """
+    votes = np.empty(img.shape[:2], dtype=np.bool_)
+    if not threshold:
+        return np.greater(img[:, :, 1], img[:, :, 2], out=votes)
+
+    diff = np.subtract(img[:, :, 1], img[:, :, 2], dtype=np.int16)
+    return np.greater(diff, threshold, out=votes)
+
+
+def chromatic_greater(index, img, scale, threshold):
+    """Classifies pixels whose index, in chromatic coordinates, exceeds the threshold
+    Args:
+        index(numpy array): int16 index calculated from the pixel values, scale times the index
+                            calculated from the chromatic coordinates times R + G + B
+        img(numpy array): uint8 BGR image the index was calculated from
+        scale(int): the factor the index was scaled by to calculate it with integers
+        threshold(float): the value the chromatic index must exceed
+    Return:
+        The boolean plane of plant pixels; black pixels have no chromatic coordinates and
+        aren't plants
+    Notes:
+        Dividing the pixel values by R + G + B only scales the index, so it's compared against
+        the threshold scaled by R + G + B instead, and a threshold of 0 needs no scaling
+    """
+    votes = np.empty(img.shape[:2], dtype=np.bool_)
+    if not threshold:
+        return np.greater(index, 0, out=votes)
+
+    total = np.add(img[:, :, 0], img[:, :, 1], dtype=np.int16)
+    total += img[:, :, 2]
+    limit = np.multiply(total, threshold * scale, dtype=np.float32)
+    del total
+
+    # Black pixels have an index and a limit of 0, so they aren't plants for any threshold
+    return np.greater(index, limit, out=votes)
+
+
+def excess_green(img, threshold):
+    """Classifies pixels by their Excess Green index, 2g - r - b in chromatic coordinates
+    Args:
+        img(numpy array): uint8 BGR image as rows x columns x channels
+        threshold(float): the value the index must exceed
+    Return:
+        The boolean plane of plant pixels
+    """
+    index = np.multiply(img[:, :, 1], 2, dtype=np.int16)
+    index -= img[:, :, 2]
+    index -= img[:, :, 0]
+
+    return chromatic_greater(index, img, 1, threshold)
+
+
+def excess_green_minus_red(img, threshold):
+    """Classifies pixels by Excess Green minus Excess Red, (2g - r - b) - (1.4r - g) in
+    chromatic coordinates
+    Args:
+        img(numpy array): uint8 BGR image as rows x columns x channels
+        threshold(float): the value the index must exceed
+    Return:
+        The boolean plane of plant pixels
+    Notes:
+        The index is scaled by 5 to 15G - 12R - 5B so that it's calculated with integers
+    """
+    index = np.multiply(img[:, :, 1], 15, dtype=np.int16)
+    temp = np.multiply(img[:, :, 2], 12, dtype=np.int16)
+    index -= temp
+    np.multiply(img[:, :, 0], 5, out=temp, dtype=np.int16)
+    index -= temp
+    del temp
+
+    return chromatic_greater(index, img, 5, threshold)
+
+
+def normalized_ratio(numerator, denominator, threshold):
+    """Classifies pixels where a ratio of channel combinations exceeds the threshold
+    Args:
+        numerator(numpy array): float32 numerator of the index; it's overwritten
+        denominator(numpy array): float32 denominator of the index
+        threshold(float): the value the index must exceed
+    Return:
+        The boolean plane of plant pixels; pixels with a zero denominator are not plants
+    """
+    valid = denominator != 0
+    np.divide(numerator, denominator, out=numerator, where=valid)
+
+    votes = np.zeros(numerator.shape, dtype=np.bool_)
+    return np.greater(numerator, threshold, out=votes, where=valid)
+
+
+def vari(img, threshold):
+    """Classifies pixels by the Visible Atmospherically Resistant Index, (G - R) / (G + R - B)
+    Args:
+        img(numpy array): uint8 BGR image as rows x columns x channels
+        threshold(float): the value the index must exceed
+    Return:
+        The boolean plane of plant pixels
+    """
+    numerator = np.subtract(img[:, :, 1], img[:, :, 2], dtype=np.float32)
+    denominator = np.add(img[:, :, 1], img[:, :, 2], dtype=np.float32)
+    denominator -= img[:, :, 0]
+
+    return normalized_ratio(numerator, denominator, threshold)
+
+
+def ngrdi(img, threshold):
+    """Classifies pixels by the Normalized Green Red Difference Index, (G - R) / (G + R)
+    Args:
+        img(numpy array): uint8 BGR image as rows x columns x channels
+        threshold(float): the value the index must exceed
+    Return:
+        The boolean plane of plant pixels
+    """
+    numerator = np.subtract(img[:, :, 1], img[:, :, 2], dtype=np.float32)
+    denominator = np.add(img[:, :, 1], img[:, :, 2], dtype=np.float32)
+
+    return normalized_ratio(numerator, denominator, threshold)
+
+
+# The engines by name, with their functions and default thresholds
+MASK_ENGINES = {
+    'g-r': (green_minus_red, 0),
+    'exg': (excess_green, 0.1),
+    'exg-exr': (excess_green_minus_red, 0.0),
+    'vari': (vari, 0.05),
+    'ngrdi': (ngrdi, 0.02)
+}
+
+
+def vegetation_votes(img, engine=DEFAULT_MASK_ENGINE, threshold=None):
+    """Classifies the pixels of an image as plants with an engine
+    Args:
+        img(numpy array): uint8 BGR image as rows x columns x channels
+        engine(str): the name of the engine, one of MASK_ENGINES
+        threshold(float): the threshold of the engine's index, or None for its default
+    Return:
+        The boolean plane of plant pixels
+    Exception:
+        A ValueError is raised if the engine isn't known
+    """
+    if engine not in MASK_ENGINES:
+        raise ValueError("Unknown mask engine '%s', expected one of %s" %
+                         (str(engine), ", ".join(sorted(MASK_ENGINES))))
+
+    function, default_threshold = MASK_ENGINES[engine]
+    return function(img, default_threshold if threshold is None else threshold)
@@ -1,6 +1,13 @@
 import os
+import json
+import inspect
+import math
+import time
+import logging
+import argparse
+import sys
+import multiprocessing
 import numpy as np
-import tempfile
 import shutil
 
 from osgeo import gdal
@@ -11,19 +18,95 @@ from pyclowder.datasets import download_metadata, upload_metadata, remove_metada
 from terrautils.metadata import get_extractor_metadata, get_terraref_metadata
 from terrautils.extractors import TerrarefExtractor, is_latest_file, check_file_in_dataset, \
     build_metadata, upload_to_dataset, file_exists, contains_required_files, \
-    confirm_clowder_info, timestamp_to_terraref
-from terrautils.formats import create_geotiff, compress_geotiff
+    confirm_clowder_info, timestamp_to_terraref, build_dataset_hierarchy, load_json_file, \
+    add_arguments as add_extractor_arguments, StageTimings, monotonic_ns
+from terrautils.sensors import Sensors, add_arguments as add_sensor_arguments
+from terrautils import httpclient
+from terrautils.formats import create_geotiff, create_geotiff_dataset, create_reprojected_geotiff, \
+     convert_to_cog
 from terrautils.spatial import geojson_to_tuples
-from terrautils.imagefile import file_is_image_type, image_get_geobounds, get_epsg
+from terrautils.imagefile import file_is_image_type, dataset_get_geobounds, get_epsg
+from image_quality import ImageStatistics, is_low_quality, MAX_LOW_RATE, MIN_BRIGHTNESS, \
+    MAX_BRIGHTNESS, MIN_MAC_SCORE, LOW_PIXEL_THRESHOLD, SATURATE_THRESHOLD
+from mask_cache import MaskCache, file_fingerprint
+from mask_engines import MASK_ENGINES, DEFAULT_MASK_ENGINE, vegetation_votes
+from component_labels import ComponentLabels, set_label_workers, DEFAULT_LABEL_WORKERS
+from buffer_pool import BufferPool, DEFAULT_BUFFER_POOL_MB
 
 from skimage import morphology
 
 import cv2
 
 
-SATURATE_THRESHOLD = 245
 MAX_PIXEL_VAL = 255
 SMALL_AREA_THRESHOLD = 200
+# Saturated areas larger than this number of pixels are not added into the basic mask
+MAX_SATURATED_AREA = 100000
+# Number of pixels to be filled as small holes in a normal image mask
+SMALL_HOLE_THRESHOLD = 3000
+# Number of pixels to be removed as small areas, and filled as small holes, before the
+# saturated pixels of an image are classified
+SATURATED_SMALL_AREA_THRESHOLD = 500
+SATURATED_SMALL_HOLE_THRESHOLD = 300
+# Number of pixels to be filled as small holes in a saturated image mask
+SATURATED_HOLE_THRESHOLD = 4000
+
+# Portion of saturated pixels above which the saturated mask process is used
+SATURATED_IMAGE_RATE = 0.15
+
+# Estimated peak number of bytes used per pixel when masking a whole image in memory
+WHOLE_IMAGE_BYTES_PER_PIXEL = 32
+# Default memory budget for masking an image before switching to tiled processing
+DEFAULT_MASK_MEMORY_MB = 2048
+# Number of pixels read around each tile so that blur and morphology see their neighbours
+TILE_HALO = 128
+# Smallest tile edge used when processing in tiles
+MIN_TILE_SIZE = 256
+
+# Compression of the mask GeoTIFFs; horizontal differencing helps the runs of black pixels
+DEFAULT_MASK_COMPRESSION = 'LZW'
+DEFAULT_MASK_PREDICTOR = 2
+
+# Products are written in tiles, with blocks compressed by all CPUs
+MASK_GEOTIFF_TILED = True
+MASK_GEOTIFF_THREADS = 'ALL_CPUS'
+
+# Products that can be written for each image: the masked RGB image, the single band mask, or both
+OUTPUT_MODES = ['rgb', 'mask', 'both']
+DEFAULT_OUTPUT_MODE = 'rgb'
+# File name option that identifies single band masks
+BIN_MASK_OPT = 'bin'
+# Overview resampling of cloud optimized products; the single band mask keeps its values
+RGB_OVERVIEW_RESAMPLE = 'AVERAGE'
+MASK_OVERVIEW_RESAMPLE = 'NEAREST'
+
+# Default size limit of the mask cache
+DEFAULT_CACHE_MAX_MB = 1024
+
+# Working memory of the warper when reprojecting an image
+DEFAULT_WARP_MEMORY_MB = 256
+
+# Bands of an RGB image in the BGR order of the mask functions
+BGR_BAND_LIST = [3, 2, 1]
+
+# Sensor of the images masked in batch mode, and the sides of a capture
+BATCH_SOURCE_SENSOR = 'rgb_geotiff'
+BATCH_SIDES = ['left', 'right']
+
+# Journal events of images that were masked or skipped, and of products registered with Clowder
+JOURNAL_MASKED = 'masked'
+JOURNAL_SKIPPED = 'skipped'
+JOURNAL_REGISTERED = 'registered'
+
+# Any capture timestamp; it's used to find the folders of a sensor's dates
+BATCH_SAMPLE_TIMESTAMP = '2000-01-01__00-00-00-000'
+
+# Extractor description added to the metadata of the products
+EXTRACTOR_INFO_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'extractor_info.json')
+
+# Buffers that images are read into, reused from one image to the next
+image_buffers = BufferPool(DEFAULT_BUFFER_POOL_MB)
 
 def getImageQuality(imgfile):
     img = Image.open(imgfile)
@@ -53,9 +136,84 @@ def gen_plant_mask(colorImg, kernelSize=3):
 
     return mask_1
 
+def plant_mask_vote_count(kernelSize=3):
+    """Returns the number of G>R pixels in a kernel that mark the center as plant
+    Args:
+        kernelSize(int): the size of the square voting kernel
+    Return:
+        The minimum neighbour count that gen_plant_mask() keeps as a plant pixel
+    Notes:
+        gen_plant_mask() keeps a pixel when the rounded cv2.blur() value of a 0/255 image
+        is greater than 128; the equivalent count is found here using the same rounding
+    """
+    area = kernelSize * kernelSize
+    for count in range(area + 1):
+        if (MAX_PIXEL_VAL * count * 2 + area) // (2 * area) > 128:
+            return count
+    return area + 1
+
+def gen_plant_mask_fused(colorImg, kernelSize=3, engine=DEFAULT_MASK_ENGINE, threshold=None):
+    """Generates the same mask as gen_plant_mask() without the intermediate images
+    Args:
+        colorImg(numpy array): BGR image to generate the mask from
+        kernelSize(int): the size of the square voting kernel
+        engine(str): the name of the vegetation index classifying each pixel, see mask_engines
+        threshold(float): the threshold of the engine's index, or None for its default
+    Return:
+        The mask image with plant pixels set to MAX_PIXEL_VAL and all others set to 0
+    Notes:
+        The engine classifies pixels into a boolean plane, the neighbours are counted with an
+        unnormalized box filter, and the count is compared against plant_mask_vote_count() in
+        place. With the default G>R engine the result is bit-identical to gen_plant_mask(),
+        which is kept as the reference implementation.
+    """
+    votes = vegetation_votes(colorImg, engine, threshold)
+
+    # Counts only fit in uint8 for kernels up to 15x15
+    depth = cv2.CV_8U if kernelSize * kernelSize <= MAX_PIXEL_VAL else cv2.CV_16U
+    counts = cv2.boxFilter(votes.view(np.uint8), depth, (kernelSize, kernelSize),
+                           normalize=False)
+    del votes
+
+    # Threshold in place; cv2.compare() can't be used since it takes a 1x1 image for a scalar
+    cv2.threshold(counts, plant_mask_vote_count(kernelSize) - 1, MAX_PIXEL_VAL,
+                  cv2.THRESH_BINARY, dst=counts)
+    if depth != cv2.CV_8U:
+        return counts.astype(np.uint8)
+
+    return counts
+
+def smaller_than_args(function, name, size):
+    """Returns the keyword arguments of a scikit-image filter that select sizes below a size
+    Args:
+        function(callable): remove_small_objects() or remove_small_holes()
+        name(str): the name of the function's exclusive size parameter in older versions
+        size(int): areas with strictly fewer pixels than this are selected
+    Return:
+        The dict of keyword arguments
+    Notes:
+        scikit-image 0.26 replaced the exclusive size parameters with an inclusive max_size, and
+        maps the old name, positional or keyword, onto max_size
+    """
+    if 'max_size' in inspect.signature(function).parameters:
+        return {'max_size': size - 1}
+    return {name: size}
+
 def remove_small_area_mask(maskImg, min_area_size):
+    """Removes the mask components that have fewer pixels than the minimum area
+    Args:
+        maskImg(numpy array): the mask image where non-zero values are part of the mask
+        min_area_size(int): components with strictly fewer pixels than this are removed
+    Return:
+        The mask as an image of 0 and MAX_PIXEL_VAL values
+    Notes:
+        Components of exactly min_area_size pixels are kept with all versions of scikit-image,
+        see smaller_than_args()
+    """
     mask_array = maskImg > 0
-    rel_array = morphology.remove_small_objects(mask_array, min_area_size)
+    rel_array = morphology.remove_small_objects(
+        mask_array, **smaller_than_args(morphology.remove_small_objects, 'min_size',
+                                        min_area_size))
 
     rel_img = np.zeros_like(maskImg)
     rel_img[rel_array] = MAX_PIXEL_VAL
@@ -63,8 +221,20 @@ def remove_small_area_mask(maskImg, min_area_size):
     return rel_img
 
 def remove_small_holes_mask(maskImg, max_hole_size):
+    """Fills the holes in the mask that have fewer pixels than the maximum hole size
+    Args:
+        maskImg(numpy array): the mask image where non-zero values are part of the mask
+        max_hole_size(int): holes with strictly fewer pixels than this are filled
+    Return:
+        The mask as an image of 0 and MAX_PIXEL_VAL values
+    Notes:
+        Holes of exactly max_hole_size pixels aren't filled with all versions of scikit-image,
+        see smaller_than_args()
+    """
     mask_array = maskImg > 0
-    rel_array = morphology.remove_small_holes(mask_array, max_hole_size)
+    rel_array = morphology.remove_small_holes(
+        mask_array, **smaller_than_args(morphology.remove_small_holes, 'area_threshold',
+                                        max_hole_size))
     rel_img = np.zeros_like(maskImg)
     rel_img[rel_array] = MAX_PIXEL_VAL
 
@@ -74,29 +244,89 @@ def saturated_pixel_classification(gray_img, baseMask, saturatedMask, dilateSize
     # add saturated area into basic mask
     saturatedMask = morphology.binary_dilation(saturatedMask, morphology.diamond(dilateSize))
 
-    rel_img = np.zeros_like(gray_img)
-    rel_img[saturatedMask] = MAX_PIXEL_VAL
+    components = ComponentLabels(saturatedMask, connectivity=8)
 
-    label_img, num = morphology.label(rel_img, connectivity=2, return_num=True)
+    # add the saturated areas touching the basic mask, unless the area is too large
+    merge = components.overlaps(baseMask) & (components.areas <= MAX_SATURATED_AREA)
+    merge[0] = False
 
-    rel_mask = baseMask
+    rel_mask = baseMask | components.select(merge)
 
-    for i in range(1, num):
-        x = (label_img == i)
+    return rel_mask
 
-        if np.sum(x) > 100000:  # if the area is too large, do not add it into basic mask
-            continue
+class MaskMorphology(object):
+    """Applies the small area and small hole filters to a boolean mask
+    Notes:
+        Each filter labels the foreground, or the background, once with 4-connectivity and
+        uses the component sizes from the labeling to decide what to change. The results match
+        remove_small_area_mask() and remove_small_holes_mask() without their relabeling and
+        0/MAX_PIXEL_VAL images; to_image() is only needed when writing the mask out.
+        Labeling is split into strips over the threads set with set_label_workers(); components
+        are merged across the strips so the results don't depend on the number of threads.
+    """
 
-        if not (x & baseMask).any():
-            continue
+    def __init__(self, mask):
+        """Initializes the instance
+        Args:
+            mask(numpy array): the mask as a boolean array, or an image where non-zero
+                               values are part of the mask
+        """
+        self.mask = mask if mask.dtype == np.bool_ else np.greater(mask, 0)
 
-        rel_mask = rel_mask | x
+    def remove_small_areas(self, min_area_size):
+        """Removes the mask components that have fewer pixels than the minimum area
+        Args:
+            min_area_size(int): the smallest number of pixels a component needs to be kept
+        Return:
+            This instance
+        """
+        components = ComponentLabels(self.mask, connectivity=4)
+        keep = components.areas >= min_area_size
+        keep[0] = False
 
-    return rel_mask
+        self.mask = components.select(keep)
+
+        return self
 
-def over_saturation_pocess(rgb_img, init_mask, threshold=SATURATE_THRESHOLD):
+    def fill_small_holes(self, max_hole_size):
+        """Fills the holes in the mask that have fewer pixels than the maximum hole size
+        Args:
+            max_hole_size(int): holes with fewer pixels than this are filled
+        Return:
+            This instance
+        """
+        components = ComponentLabels(np.logical_not(self.mask), connectivity=4)
+        fill = components.areas < max_hole_size
+        fill[0] = False
+
+        self.mask |= components.select(fill)
+
+        return self
+
+    def count(self):
+        """Returns the number of pixels in the mask
+        """
+        return np.count_nonzero(self.mask)
+
+    def to_image(self):
+        """Returns the mask as an image of 0 and MAX_PIXEL_VAL values
+        """
+        return np.multiply(self.mask, MAX_PIXEL_VAL, dtype=np.uint8)
+
+def over_saturation_mask(rgb_img, init_mask, threshold=SATURATE_THRESHOLD, gray_img=None):
+    """Adds the saturated areas of an image that touch the initial mask into the mask
+    Args:
+        rgb_img(numpy array): the BGR image being masked
+        init_mask(numpy array): the initial mask, as a boolean array or 0/MAX_PIXEL_VAL image
+        threshold(int): grayscale values above this are considered saturated
+        gray_img(numpy array): the grayscale plane of the image if it's already been calculated,
+                               such as ImageStatistics.gray
+    Return:
+        The boolean mask
+    """
     # connected component analysis for over saturation pixels
-    gray_img = cv2.cvtColor(rgb_img, cv2.COLOR_BGR2GRAY)
+    if gray_img is None:
+        gray_img = cv2.cvtColor(rgb_img, cv2.COLOR_BGR2GRAY)
 
     mask_over = gray_img > threshold
 
@@ -106,42 +336,101 @@ def over_saturation_pocess(rgb_img, init_mask, threshold=SATURATE_THRESHOLD):
 
     mask_1 = src_mask_array & mask_0
 
-    mask_1 = morphology.remove_small_objects(mask_1, SMALL_AREA_THRESHOLD)
+    mask_1 = MaskMorphology(mask_1).remove_small_areas(SMALL_AREA_THRESHOLD).mask
 
-    mask_over = morphology.remove_small_objects(mask_over, SMALL_AREA_THRESHOLD)
+    mask_over = MaskMorphology(mask_over).remove_small_areas(SMALL_AREA_THRESHOLD).mask
 
-    rel_mask = saturated_pixel_classification(gray_img, mask_1, mask_over, 1)
-    rel_img = np.zeros_like(gray_img)
+    return saturated_pixel_classification(gray_img, mask_1, mask_over, 1)
+
+def over_saturation_pocess(rgb_img, init_mask, threshold=SATURATE_THRESHOLD, gray_img=None):
+    rel_mask = over_saturation_mask(rgb_img, init_mask, threshold, gray_img)
+    rel_img = np.zeros(rel_mask.shape, dtype=np.uint8)
     rel_img[rel_mask] = MAX_PIXEL_VAL
 
     return rel_img
 
-def gen_saturated_mask(img, kernelSize):
-    binMask = gen_plant_mask(img, kernelSize)
-    binMask = remove_small_area_mask(binMask,
-                                     500)  # 500 is a parameter for number of pixels to be removed as small area
-    binMask = remove_small_holes_mask(binMask,
-                                      300)  # 300 is a parameter for number of pixels to be filled as small holes
+def gen_saturated_mask_morphology(img, kernelSize, engine=DEFAULT_MASK_ENGINE, threshold=None,
+                                  gray_img=None):
+    """Generates the mask of a saturated image
+    Args:
+        img(numpy array): the BGR image to mask
+        kernelSize(int): the size of the plant mask voting kernel
+        engine(str): the name of the vegetation index classifying each pixel
+        threshold(float): the threshold of the engine's index, or None for its default
+        gray_img(numpy array): the grayscale plane of the image, or None to calculate it
+    Return:
+        The MaskMorphology instance holding the mask
+    """
+    binMask = MaskMorphology(gen_plant_mask_fused(img, kernelSize, engine, threshold))
+    binMask.remove_small_areas(SATURATED_SMALL_AREA_THRESHOLD)
+    binMask.fill_small_holes(SATURATED_SMALL_HOLE_THRESHOLD)
+
+    binMask = MaskMorphology(over_saturation_mask(img, binMask.mask, SATURATE_THRESHOLD,
+                                                  gray_img))
+
+    return binMask.fill_small_holes(SATURATED_HOLE_THRESHOLD)
 
-    binMask = over_saturation_pocess(img, binMask, SATURATE_THRESHOLD)
+def gen_mask_morphology(img, kernelSize, engine=DEFAULT_MASK_ENGINE, threshold=None,
+                        gray_img=None):
+    """Generates the mask of a normal image
+    Args:
+        img(numpy array): the BGR image to mask
+        kernelSize(int): the size of the plant mask voting kernel
+        engine(str): the name of the vegetation index classifying each pixel
+        threshold(float): the threshold of the engine's index, or None for its default
+        gray_img(numpy array): unused; accepted so that either mask process can be called alike
+    Return:
+        The MaskMorphology instance holding the mask
+    """
+    binMask = MaskMorphology(gen_plant_mask_fused(img, kernelSize, engine, threshold))
+    binMask.remove_small_areas(SMALL_AREA_THRESHOLD)
 
-    binMask = remove_small_holes_mask(binMask, 4000)
+    return binMask.fill_small_holes(SMALL_HOLE_THRESHOLD)
 
-    return binMask
+def gen_saturated_mask(img, kernelSize, engine=DEFAULT_MASK_ENGINE, threshold=None):
+    return gen_saturated_mask_morphology(img, kernelSize, engine, threshold).to_image()
 
-def gen_mask(img, kernelSize):
-    binMask = gen_plant_mask(img, kernelSize)
-    binMask = remove_small_area_mask(binMask, SMALL_AREA_THRESHOLD)
-    binMask = remove_small_holes_mask(binMask,
-                                      3000)  # 3000 is a parameter for number of pixels to be filled as small holes
+def gen_mask(img, kernelSize, engine=DEFAULT_MASK_ENGINE, threshold=None):
+    return gen_mask_morphology(img, kernelSize, engine, threshold).to_image()
 
-    return binMask
+def gen_rgb_mask(img, binMask, out=None):
+    # out can be img to mask the image in place; binMask then needs to be the boolean mask
+    if out is not None:
+        return np.multiply(img, binMask[:, :, np.newaxis], out=out)
 
-def gen_rgb_mask(img, binMask):
     rgbMask = cv2.bitwise_and(img, img, mask=binMask)
 
     return rgbMask
 
+def gen_bin_mask(img, binMask, nodata=None):
+    """Generates the single band mask product
+    Args:
+        img(numpy array): the image the mask was generated from
+        binMask(numpy array): the plant mask, True or non-zero for plants
+        nodata(int): the value for pixels without image data, which are black in every band,
+                     such as those outside a reprojected image; None to not mark them
+    Return:
+        A uint8 array that is 1 for plants, 0 for everything else, and nodata where there's
+        no image data
+    """
+    mask = (binMask != 0).view(np.uint8)
+    if nodata is not None:
+        mask[~img.any(axis=2)] = nodata
+
+    return mask
+
+def mask_nbits(nodata=None):
+    """Returns the number of bits needed per pixel to store a single band mask
+    Args:
+        nodata(int): the nodata value of the mask, or None if there isn't one
+    Return:
+        The number of bits for the GeoTIFF NBITS option
+    """
+    if nodata is None:
+        return 1
+
+    return max(int(nodata).bit_length(), 1)
+
 def rgb2gray(rgb):
     r, g, b = rgb[:,:,0], rgb[:,:,1], rgb[:,:,2]
     gray = 0.2989 * r + 0.5870 * g + 0.1140 * b
@@ -164,60 +453,746 @@ def MAC(im1, im2, im):  # main function: Multiscale Autocorrelation (MAC)
     NRMAC = np.mean(FM)
     return NRMAC
 
-def check_saturation(img):
+def check_saturation(img, stats=None):
     # check how many percent of pix close to 255 or 0
-    grayImg = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    # stats can be the ImageStatistics of the image to reuse its histogram
+    if stats is None:
+        stats = ImageStatistics.from_image(img)
 
-    m1 = grayImg > SATURATE_THRESHOLD
-    m2 = grayImg < 20  # 20 is a threshold to classify low pixel value
-
-    over_rate = float(np.sum(m1)) / float(grayImg.size)
-    low_rate = float(np.sum(m2)) / float(grayImg.size)
+    over_rate = stats.over_rate(SATURATE_THRESHOLD)
+    low_rate = stats.low_rate(LOW_PIXEL_THRESHOLD)  # 20 is a threshold to classify low pixel value
 
     return over_rate, low_rate
 
-def check_brightness(img):
+def check_brightness(img, stats=None):
     # gen average pixel value from grayscale image
-    grayImg = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if stats is None:
+        stats = ImageStatistics.from_image(img)
 
-    aveValue = np.average(grayImg)
+    aveValue = stats.brightness()
 
     return aveValue
 
-def gen_cc_enhanced(input_path, kernelSize=3):
+def open_image(source):
+    """Returns the open raster of an image
+    Args:
+        source(str or gdal.Dataset): path to the image, or an already open raster such as an
+                                     in-memory reprojection
+    Return:
+        The open gdal.Dataset
+    """
+    if isinstance(source, gdal.Dataset):
+        return source
+
+    return gdal.Open(source)
+
+def reproject_image(input_path, epsg, output_format='MEM', warp_memory_mb=DEFAULT_WARP_MEMORY_MB):
+    """Reprojects an image without writing to disk
+    Args:
+        input_path(str): path to the image to reproject
+        epsg(int): the EPSG code to reproject to
+        output_format(str): 'MEM' to warp the whole image into memory now, or 'VRT' to warp
+                            windows of the image as they're read
+        warp_memory_mb(int): the working memory of the warper, in megabytes
+    Return:
+        The reprojected gdal.Dataset
+    Notes:
+        The warp uses all CPUs. A 'VRT' dataset holds no pixels and suits images masked in tiles
+    """
+    return gdal.Warp('', input_path, format=output_format, dstSRS='EPSG:' + str(epsg),
+                     multithread=True, warpMemoryLimit=warp_memory_mb * 1024 * 1024,
+                     warpOptions=['NUM_THREADS=ALL_CPUS'])
+
+def read_bgr_image(src, xoff=0, yoff=0, xsize=None, ysize=None, out=None):
+    """Reads an image, or a window of it, in the BGR order expected by the mask functions
+    Args:
+        src(gdal.Dataset): the open raster to read from
+        xoff(int): the starting column of the window
+        yoff(int): the starting row of the window
+        xsize(int): the width of the window; None reads to the right edge
+        ysize(int): the height of the window; None reads to the bottom edge
+        out(numpy array): the rows x columns x 3 uint8 buffer to read into, or None to use a
+                          buffer from image_buffers
+    Return:
+        The uint8 pixels of the window as a rows x columns x channels array
+    Notes:
+        Byte RGB images are decoded by GDAL straight into the pixel interleaved buffer with
+        the bands in BGR order. Release the buffer with image_buffers.release() once the image
+        isn't needed so the next image of the same size can reuse it
+    """
+    xsize = src.RasterXSize - xoff if xsize is None else xsize
+    ysize = src.RasterYSize - yoff if ysize is None else ysize
+
+    if src.RasterCount < 3 or src.GetRasterBand(1).DataType != gdal.GDT_Byte:
+        # TODO: cv2 has problems with some RGB geotiffs...
+        img = np.rollaxis(src.ReadAsArray(xoff, yoff, xsize, ysize).astype(np.uint8), 0, 3)
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=out)
+
+    if out is None:
+        out = image_buffers.get((ysize, xsize, 3))
+
+    try:
+        src.ReadAsArray(xoff, yoff, xsize, ysize, buf_obj=out, interleave='pixel',
+                        band_list=BGR_BAND_LIST)
+    except TypeError:
+        # GDAL without pixel interleaved array reads; the interleaved bytes are copied once
+        pixels = src.ReadRaster(xoff, yoff, xsize, ysize, buf_type=gdal.GDT_Byte,
+                                band_list=BGR_BAND_LIST, buf_pixel_space=3,
+                                buf_line_space=3 * xsize, buf_band_space=1)
+        np.copyto(out, np.frombuffer(pixels, dtype=np.uint8).reshape(out.shape))
+
+    return out
+
+def gen_cc_enhanced(input_path, kernelSize=3, quality_check=True, engine=DEFAULT_MASK_ENGINE,
+                    engine_threshold=None, sample_step=1):
+    ratio, img, binMask = gen_cc_enhanced_mask(input_path, kernelSize, quality_check, engine,
+                                               engine_threshold, sample_step)
+    if ratio is None:
+        return None, None
+
+    rgbMask = gen_rgb_mask(img, binMask.view(np.uint8))
+    image_buffers.release(img)
+
+    return ratio, rgbMask
+
+def gen_cc_enhanced_mask(input_path, kernelSize=3, quality_check=True, engine=DEFAULT_MASK_ENGINE,
+                         engine_threshold=None, sample_step=1):
+    # same as gen_cc_enhanced(), returning the image and its boolean plant mask instead of the
+    # masked RGB so that any of the products can be generated from them
+    # engine names the vegetation index that classifies pixels before the vote, see mask_engines
     # abandon low quality images, mask enhanced
-    # TODO: cv2 has problems with some RGB geotiffs...
+    # input_path can also be an open, possibly in-memory, gdal.Dataset
     # img = cv2.imread(input_path)
-    img = np.rollaxis(gdal.Open(input_path).ReadAsArray().astype(np.uint8), 0, 3)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    img = read_bgr_image(open_image(input_path))
 
-    # calculate image scores
-    over_rate, low_rate = check_saturation(img)
+    # calculate image statistics once; they're shared by the quality check and the saturated
+    # mask process. Without a quality check, a sample_step above 1 estimates them from every
+    # sample_step row and column, since the full grayscale plane is only needed for MAC
+    if quality_check:
+        sample_step = 1
+    stats = ImageStatistics.from_image(img, sample_step=sample_step)
 
-    # TODO: disabling this check for now because it's crashing extractor - generate mask regardless
     # if low score, return None
     # low_rate is percentage of low value pixels(lower than 20) in the grayscale image, if low_rate > 0.1, return
-    # aveValue is average pixel value of grayscale image, if aveValue lower than 30 or higher than 195, return
-    # quality_score is a score from Multiscale Autocorrelation (MAC), if quality_score lower than 13, return
-
-    #aveValue = check_brightness(img)
-    #quality_score = getImageQuality(input_path)
-    #if low_rate > 0.1 or aveValue < 30 or aveValue > 195 or quality_score < 13:
-    #    return None, None, None
+    # brightness is average pixel value of grayscale image, if lower than 30 or higher than 195, return
+    # mac is a score from Multiscale Autocorrelation (MAC), if lower than 13, return
+    if quality_check and is_low_quality(stats.quality()):
+        image_buffers.release(img)
+        return None, None, None
 
     # saturated image process
     # over_rate is percentage of high value pixels(higher than SATUTATE_THRESHOLD) in the grayscale image, if over_rate > 0.15, try to fix it use gen_saturated_mask()
-    if over_rate > 0.15:
-        binMask = gen_saturated_mask(img, kernelSize)
+    if stats.over_rate(SATURATE_THRESHOLD) > SATURATED_IMAGE_RATE:
+        binMask = gen_saturated_mask_morphology(img, kernelSize, engine, engine_threshold,
+                                                stats.gray)
     else:  # nomal image process
-        binMask = gen_mask(img, kernelSize)
+        binMask = gen_mask_morphology(img, kernelSize, engine, engine_threshold)
 
-    c = np.count_nonzero(binMask)
-    ratio = c / float(binMask.size)
+    c = binMask.count()
+    ratio = c / float(binMask.mask.size)
 
-    rgbMask = gen_rgb_mask(img, binMask)
+    return ratio, img, binMask.mask
 
-    return ratio, rgbMask
+def mask_parameters(kernelSize=3, quality_check=True, epsg=None, native_crs=False,
+                    engine=DEFAULT_MASK_ENGINE, engine_threshold=None, sample_step=1):
+    """Returns the parameters that determine the mask of an image, for fingerprinting cached masks
+    Args:
+        kernelSize(int): the size of the plant mask voting kernel
+        quality_check(bool): whether low quality images are rejected
+        epsg(int): the EPSG code images are masked in, or None if they aren't reprojected
+        native_crs(bool): whether images are masked in their native EPSG space
+        engine(str): the name of the vegetation index classifying pixels
+        engine_threshold(float): the threshold of the engine's index, or None for its default
+        sample_step(int): the sampling of the image statistics, see gen_cc_enhanced_mask()
+    Return:
+        A dictionary of the parameters
+    """
+    if engine_threshold is None:
+        engine_threshold = MASK_ENGINES[engine][1]
+    if quality_check or not sample_step:
+        sample_step = 1
+
+    return {
+        'kernel_size': kernelSize,
+        'quality_check': quality_check,
+        'engine': engine,
+        'engine_threshold': engine_threshold,
+        'sample_step': sample_step,
+        'quality_limits': [MAX_LOW_RATE, MIN_BRIGHTNESS, MAX_BRIGHTNESS, MIN_MAC_SCORE],
+        'epsg': None if native_crs or epsg is None else str(epsg),
+        'saturate_threshold': SATURATE_THRESHOLD,
+        'saturated_image_rate': SATURATED_IMAGE_RATE,
+        'small_area_threshold': SMALL_AREA_THRESHOLD,
+        'small_hole_threshold': SMALL_HOLE_THRESHOLD,
+        'max_saturated_area': MAX_SATURATED_AREA,
+        'saturated_small_area_threshold': SATURATED_SMALL_AREA_THRESHOLD,
+        'saturated_small_hole_threshold': SATURATED_SMALL_HOLE_THRESHOLD,
+        'saturated_hole_threshold': SATURATED_HOLE_THRESHOLD
+    }
+
+def gen_cc_enhanced_mask_cached(input_path, cache=None, cache_key=None, kernelSize=3,
+                                quality_check=True, engine=DEFAULT_MASK_ENGINE,
+                                engine_threshold=None, sample_step=1):
+    """Same as gen_cc_enhanced_mask(), reusing the mask kept in a cache when there is one
+    Args:
+        input_path(str or gdal.Dataset): path to the image to mask, or its open raster
+        cache(MaskCache): the cache of masks, or None to always generate the mask
+        cache_key(str): the fingerprint of the image and the mask parameters
+        kernelSize(int): the size of the plant mask voting kernel
+        quality_check(bool): set to False to mask images that have low quality scores
+        engine(str): the name of the vegetation index classifying pixels
+        engine_threshold(float): the threshold of the engine's index, or None for its default
+        sample_step(int): the sampling of the image statistics, see gen_cc_enhanced_mask()
+    Return:
+        The same values as gen_cc_enhanced_mask()
+    Notes:
+        Low quality results are cached too. The image is still read on a cache hit since the
+        products are built from it
+    """
+    if cache is None:
+        return gen_cc_enhanced_mask(input_path, kernelSize, quality_check, engine,
+                                    engine_threshold, sample_step)
+
+    cached = cache.get(cache_key)
+    if cached is None:
+        ratio, img, binMask = gen_cc_enhanced_mask(input_path, kernelSize, quality_check, engine,
+                                                   engine_threshold, sample_step)
+        try:
+            cache.put(cache_key, ratio, binMask)
+        except (IOError, OSError) as ex:
+            logging.getLogger(__name__).warning("Unable to add mask to cache: %s", str(ex))
+        return ratio, img, binMask
+
+    ratio, binMask = cached
+    if ratio is None:
+        return None, None, None
+
+    return ratio, read_bgr_image(open_image(input_path)), binMask
+
+def choose_processing_mode(input_path, memory_mb=DEFAULT_MASK_MEMORY_MB):
+    """Determines whether an image can be masked in memory or needs to be processed in tiles
+    Args:
+        input_path(str or gdal.Dataset): path to the image to mask, or its open raster
+        memory_mb(int): the memory budget for masking, in megabytes
+    Return:
+        Returns 'whole' if the image fits the memory budget and 'tiled' otherwise
+    """
+    src = open_image(input_path)
+    needed = src.RasterXSize * src.RasterYSize * WHOLE_IMAGE_BYTES_PER_PIXEL
+
+    return 'whole' if needed <= memory_mb * 1024 * 1024 else 'tiled'
+
+def tile_step(size, block, out_blocks):
+    """Rounds a tile dimension up to whole blocks of the source and of the outputs
+    Args:
+        size(int): the wanted tile dimension, in pixels
+        block(int): the block dimension of the source raster
+        out_blocks(list): the block dimensions of the output rasters
+    Return:
+        The rounded tile dimension
+    Notes:
+        Tiles are rounded to a common multiple of the block sizes. When the common multiple is
+        more than twice the wanted size, tiles are only rounded to the output blocks; the
+        source blocks on the tile edges are then decoded twice, but no output block is written
+        more than once
+    """
+    out_step = 1
+    for one_block in out_blocks:
+        out_step = out_step * one_block // math.gcd(out_step, one_block)
+
+    step = block * out_step // math.gcd(block, out_step)
+    if out_blocks and step > 2 * size:
+        step = out_step
+
+    return int(np.ceil(size / float(step))) * step
+
+def get_tile_size(src, memory_mb=DEFAULT_MASK_MEMORY_MB, halo=TILE_HALO, outputs=None):
+    """Returns the width and height of the tiles to process an image with
+    Args:
+        src(gdal.Dataset): the open raster to be tiled
+        memory_mb(int): the memory budget for masking a tile, including its halo, in megabytes
+        halo(int): the number of pixels added around each side of a tile
+        outputs(list): the open rasters the tiles are written to, if any
+    Return:
+        A tuple of tile width and tile height, in pixels
+    Notes:
+        Tiles are sized to whole multiples of the raster's block size, and of the block sizes of
+        the outputs, so that each block is decoded and each output block is written as few times
+        as possible; see tile_step(). Images stored in strips are processed in bands of
+        full-width rows.
+    """
+    block_x, block_y = src.GetRasterBand(1).GetBlockSize()
+    out_blocks = [raster.GetRasterBand(1).GetBlockSize() for raster in (outputs or [])]
+    budget_pixels = max(memory_mb * 1024 * 1024 // WHOLE_IMAGE_BYTES_PER_PIXEL, 1)
+
+    if block_x >= src.RasterXSize:
+        tile_x = src.RasterXSize
+        tile_y = max(budget_pixels // (tile_x + 2 * halo) - 2 * halo, MIN_TILE_SIZE)
+    else:
+        tile_x = max(int(np.sqrt(budget_pixels)) - 2 * halo, MIN_TILE_SIZE)
+        tile_y = tile_x
+
+    # Round up to whole blocks without going past the image
+    tile_x = min(tile_step(tile_x, block_x, [one_block[0] for one_block in out_blocks]),
+                 src.RasterXSize)
+    tile_y = min(tile_step(tile_y, block_y, [one_block[1] for one_block in out_blocks]),
+                 src.RasterYSize)
+
+    return (tile_x, tile_y)
+
+def iterate_tiles(width, height, tile_x, tile_y):
+    """Generates the windows covering an image in row-major order
+    Args:
+        width(int): the width of the image
+        height(int): the height of the image
+        tile_x(int): the width of a tile
+        tile_y(int): the height of a tile
+    Return:
+        Yields a tuple of column offset, row offset, width and height for each tile
+    """
+    for yoff in range(0, height, tile_y):
+        for xoff in range(0, width, tile_x):
+            yield (xoff, yoff, min(tile_x, width - xoff), min(tile_y, height - yoff))
+
+def image_quality_tiled(src, tile_x, tile_y):
+    """Calculates the statistics and quality scores of an image one tile at a time
+    Args:
+        src(gdal.Dataset): the open raster to score
+        tile_x(int): the width of the tiles to read
+        tile_y(int): the height of the tiles to read
+    Return:
+        The ImageStatistics of the whole image, without its grayscale plane
+    Notes:
+        The histograms of the tiles add up to the histogram of the whole image. The MAC scores
+        of the tiles are weighted by their number of pixels; the score of each tile treats its
+        last rows as the end of the image, so it differs slightly from the score of the whole
+        image.
+    """
+    histogram = None
+    mac_total = 0.0
+    for xoff, yoff, xsize, ysize in iterate_tiles(src.RasterXSize, src.RasterYSize, tile_x, tile_y):
+        img = read_bgr_image(src, xoff, yoff, xsize, ysize)
+        stats = ImageStatistics.from_image(img)
+        histogram = stats.histogram if histogram is None else histogram + stats.histogram
+        mac_total += stats.mac() * xsize * ysize
+        image_buffers.release(img)
+
+    size = float(src.RasterXSize * src.RasterYSize)
+    return ImageStatistics(histogram, mac=mac_total / size)
+
+def gen_cc_enhanced_tiled(input_path, out_path, bounds, kernelSize=3,
+                          memory_mb=DEFAULT_MASK_MEMORY_MB, halo=TILE_HALO,
+                          extractor_info=None, system_md=None, quality_check=True, compress=False,
+                          predictor=None, compress_level=None, mask_path=None, mask_nodata=None,
+                          engine=DEFAULT_MASK_ENGINE, engine_threshold=None, timings=None):
+    """Generates the masked RGB GeoTIFF of an image, and/or its single band mask, one tile at a time
+    Args:
+        input_path(str or gdal.Dataset): path to the image to mask, or its open raster
+        out_path(str): path of the masked RGB GeoTIFF to write, or None to not write one
+        bounds(tuple): the GeoTIFF boundaries as (min y, max y, min x, max x)
+        kernelSize(int): the size of the plant mask voting kernel
+        memory_mb(int): the memory budget for masking a tile, in megabytes
+        halo(int): the number of pixels read around each tile
+        extractor_info(dict): details about the extractor to store in the GeoTIFF
+        system_md(dict): cleaned TERRA-REF metadata to store in the GeoTIFF
+        quality_check(bool): set to False to mask images that have low quality scores
+        compress(str): the GeoTIFF compression codec, or False to write an uncompressed file
+        predictor(int): the GeoTIFF compression predictor
+        compress_level(int): the DEFLATE or ZSTD compression level
+        mask_path(str): path of the single band mask GeoTIFF to write, or None to not write one
+        mask_nodata(int): the nodata value of the single band mask, see gen_bin_mask()
+        engine(str): the name of the vegetation index classifying pixels
+        engine_threshold(float): the threshold of the engine's index, or None for its default
+        timings(StageTimings): receives the time spent masking ('mask') and writing ('write')
+    Return:
+        The ratio of plant pixels to all pixels in the image, or None if the image has low
+        quality scores and no file was written
+    Notes:
+        The quality check and the choice between the saturated and normal mask process are
+        made once for the whole image, as gen_cc_enhanced() does. Each tile is then masked together with a halo of
+        surrounding pixels, and only the tile itself is written.
+        Tile seams: the blur is exact, but a small object, small hole or saturated area that
+        extends past the halo of a tile can be classified differently than on the whole image.
+        Away from the seams, and for components that fit inside the halo, the mask matches
+        gen_cc_enhanced().
+    """
+    timings = timings if timings is not None else StageTimings()
+    src = open_image(input_path)
+    width, height = src.RasterXSize, src.RasterYSize
+    tile_x, tile_y = get_tile_size(src, memory_mb, halo)
+
+    with timings.stage('mask'):
+        stats = image_quality_tiled(src, tile_x, tile_y)
+    if quality_check and is_low_quality(stats.quality()):
+        return None
+
+    if stats.over_rate(SATURATE_THRESHOLD) > SATURATED_IMAGE_RATE:
+        mask_function = gen_saturated_mask_morphology
+    else:
+        mask_function = gen_mask_morphology
+
+    out_raster, mask_raster = None, None
+    if out_path:
+        out_raster = create_geotiff_dataset(height, width, 3, bounds, out_path, None, False,
+                                            extractor_info, system_md, None, compress, predictor,
+                                            compress_level, MASK_GEOTIFF_TILED,
+                                            MASK_GEOTIFF_THREADS)
+    if mask_path:
+        mask_raster = create_geotiff_dataset(height, width, 1, bounds, mask_path, mask_nodata,
+                                             False, extractor_info, system_md, None, compress,
+                                             predictor, compress_level, MASK_GEOTIFF_TILED,
+                                             MASK_GEOTIFF_THREADS, mask_nbits(mask_nodata))
+    # Tiles are written in whole blocks of the outputs
+    tile_x, tile_y = get_tile_size(src, memory_mb, halo,
+                                   [raster for raster in (out_raster, mask_raster)
+                                    if raster is not None])
+    plant_count = 0
+    try:
+        for xoff, yoff, xsize, ysize in iterate_tiles(width, height, tile_x, tile_y):
+            # Extend the tile by the halo, staying within the image
+            read_x, read_y = max(xoff - halo, 0), max(yoff - halo, 0)
+            read_width = min(xoff + xsize + halo, width) - read_x
+            read_height = min(yoff + ysize + halo, height) - read_y
+
+            with timings.stage('mask'):
+                img = read_bgr_image(src, read_x, read_y, read_width, read_height)
+                binMask = mask_function(img, kernelSize, engine, engine_threshold).mask
+
+            tile_rows = slice(yoff - read_y, yoff - read_y + ysize)
+            tile_cols = slice(xoff - read_x, xoff - read_x + xsize)
+            # The tile is written from views of the halo window without copying it
+            tileMask = binMask[tile_rows, tile_cols]
+            plant_count += np.count_nonzero(tileMask)
+
+            tileImg = img[tile_rows, tile_cols]
+
+            with timings.stage('write'):
+                # The single band mask looks for image data, so it's made before the image is
+                # masked
+                if mask_raster is not None:
+                    mask_raster.GetRasterBand(1).WriteArray(gen_bin_mask(tileImg, tileMask,
+                                                                         mask_nodata), xoff, yoff)
+                if out_raster is not None:
+                    rgbMask = gen_rgb_mask(tileImg, tileMask, out=tileImg)
+
+                    # Bands are written in RGB order
+                    for band in range(3):
+                        out_raster.GetRasterBand(band + 1).WriteArray(rgbMask[:, :, 2 - band],
+                                                                      xoff, yoff)
+            image_buffers.release(img)
+    finally:
+        with timings.stage('write'):
+            for raster in (out_raster, mask_raster):
+                if raster is not None:
+                    raster.FlushCache()
+            out_raster, mask_raster = None, None
+
+    return plant_count / float(width * height)
+
+def gen_cc_enhanced_native(input_path, out_path, epsg, bounds, width, height, kernelSize=3,
+                           extractor_info=None, system_md=None, quality_check=True, compress=False,
+                           predictor=None, compress_level=None, mask_path=None, mask_nodata=None,
+                           cache=None, cache_key=None, engine=DEFAULT_MASK_ENGINE,
+                           engine_threshold=None, cog=False, sample_step=1, timings=None):
+    """Masks an image in its native EPSG space and reprojects only the products when writing them
+    Args:
+        input_path(str or gdal.Dataset): path to the image to mask, or its open raster
+        out_path(str): path of the masked RGB GeoTIFF to write, or None to not write one
+        epsg(int): the EPSG code of the GeoTIFF to write
+        bounds(tuple): the GeoTIFF boundaries as (min y, max y, min x, max x)
+        width(int): the width of the GeoTIFF to write, in pixels
+        height(int): the height of the GeoTIFF to write, in pixels
+        kernelSize(int): the size of the plant mask voting kernel
+        extractor_info(dict): details about the extractor to store in the GeoTIFF
+        system_md(dict): cleaned TERRA-REF metadata to store in the GeoTIFF
+        quality_check(bool): set to False to mask images that have low quality scores
+        compress(str): the GeoTIFF compression codec, or False to write an uncompressed file
+        predictor(int): the GeoTIFF compression predictor
+        compress_level(int): the DEFLATE or ZSTD compression level
+        mask_path(str): path of the single band mask GeoTIFF to write, or None to not write one
+        mask_nodata(int): the nodata value of the single band mask, see gen_bin_mask(); it also
+                          marks the pixels outside of the reprojected image
+        cache(MaskCache): the cache of masks, or None to always generate the mask
+        cache_key(str): the fingerprint of the image and the mask parameters
+        engine(str): the name of the vegetation index classifying pixels
+        engine_threshold(float): the threshold of the engine's index, or None for its default
+        cog(bool): write cloud optimized GeoTIFFs with internal tiles and overviews
+        sample_step(int): the sampling of the image statistics, see gen_cc_enhanced_mask()
+        timings(StageTimings): receives the time spent masking ('mask') and reprojecting and
+                               writing the products ('write')
+    Return:
+        A tuple of the ratio of plant pixels to all pixels in the native image (None if the
+        image has low quality scores and no file was written), the number of bytes warped, the
+        number of image bytes that were not warped, and the CPU seconds spent warping
+    Notes:
+        The blur and vegetation index votes see the sensor's own pixels, and the output is resampled with
+        nearest neighbour so that mask values stay intact
+    """
+    timings = timings if timings is not None else StageTimings()
+    src = open_image(input_path)
+    with timings.stage('mask'):
+        mask_ratio, img, binMask = gen_cc_enhanced_mask_cached(src, cache, cache_key, kernelSize,
+                                                               quality_check, engine,
+                                                               engine_threshold, sample_step)
+    if mask_ratio is None:
+        return (None, 0, 0, 0.0)
+
+    warped_bytes = 0
+    start_ns = monotonic_ns()
+    start_times = os.times()
+    # The single band mask looks for image data, so it's made before the image is masked
+    if mask_path:
+        mask = gen_bin_mask(img, binMask, mask_nodata)
+        create_reprojected_geotiff(mask, src.GetGeoTransform(), src.GetProjection(), mask_path,
+                                   int(epsg), bounds, height, width, mask_nodata, False,
+                                   extractor_info, system_md, None, compress, predictor,
+                                   compress_level, MASK_GEOTIFF_TILED, MASK_GEOTIFF_THREADS,
+                                   nbits=mask_nbits(mask_nodata), cog=cog,
+                                   overview_resample=MASK_OVERVIEW_RESAMPLE)
+        warped_bytes += mask.nbytes
+    if out_path:
+        # Masked in place; the bands are reversed in a view to avoid swapping R and B
+        mask_rgb = gen_rgb_mask(img, binMask, out=img)[:, :, ::-1]
+        create_reprojected_geotiff(mask_rgb, src.GetGeoTransform(), src.GetProjection(), out_path,
+                                   int(epsg), bounds, height, width, None, False, extractor_info,
+                                   system_md, None, compress, predictor, compress_level,
+                                   MASK_GEOTIFF_TILED, MASK_GEOTIFF_THREADS, cog=cog,
+                                   overview_resample=RGB_OVERVIEW_RESAMPLE)
+        warped_bytes += mask_rgb.nbytes
+    end_times = os.times()
+    timings.add('write', monotonic_ns() - start_ns)
+    image_buffers.release(img)
+    cpu_seconds = (end_times[0] - start_times[0]) + (end_times[1] - start_times[1])
+
+    image_bytes = 0
+    for band in range(1, src.RasterCount + 1):
+        image_bytes += src.RasterXSize * src.RasterYSize * \
+                       gdal.GetDataTypeSize(src.GetRasterBand(band).DataType) // 8
+
+    return (mask_ratio, warped_bytes, image_bytes, cpu_seconds)
+
+def native_warp_report(warped_bytes, image_bytes, cpu_seconds):
+    """Describes what masking in the native EPSG space saved over warping the image first
+    Args:
+        warped_bytes(int): the bytes of products that were warped
+        image_bytes(int): the bytes of the image, which would have been warped before masking
+        cpu_seconds(float): the CPU seconds spent warping and writing the products
+    Return:
+        The message reporting the bytes and CPU time of both approaches and their difference
+    Notes:
+        The image isn't warped, so its CPU time is estimated at the CPU time per byte measured
+        for the products. A negative saving means warping the image would have been cheaper,
+        as when a 3 band product and a mask are written from a 3 band image
+    """
+    image_cpu = cpu_seconds * image_bytes / warped_bytes if warped_bytes > 0 else 0.0
+    return ("masked in the native EPSG space: warped %s bytes of products instead of %s bytes "
+            "of image, saving %s bytes; %.2fs of CPU instead of an estimated %.2fs, saving "
+            "%.2fs" % (str(warped_bytes), str(image_bytes), str(image_bytes - warped_bytes),
+                       cpu_seconds, image_cpu, image_cpu - cpu_seconds))
+
+def get_image_bounds(source):
+    """Returns the boundaries of a georeferenced image
+    Args:
+        source(str or gdal.Dataset): path of the image, or its open raster
+    Return:
+        The boundaries as returned by dataset_get_geobounds(), or None if the image isn't
+        georeferenced
+    """
+    bounds = dataset_get_geobounds(open_image(source))
+    bounds_len = len(bounds)
+    if bounds_len <= 0 or np.isnan(bounds[0]):
+        return None
+
+    return bounds
+
+def mask_image_file(job):
+    """Runs the mask pipeline on one image: reprojection, masking, writing and compression
+    Args:
+        job(dict): the image to mask and how to mask it, as returned by
+                   rgbEnhancementExtractor.get_mask_job()
+    Return:
+        A dictionary with the source image ('source'), the product files ('files'), whether
+        masking was attempted ('masked'), the plant ratio ('ratio'), the size of the written
+        files ('bytes'), the reason the image was skipped, if it was ('skip'), a list of
+        progress messages ('info'), and the nanoseconds spent in the 'reproject', 'mask',
+        'write' and 'compress' stages ('timings')
+    Notes:
+        The products are the masked RGB image ('mask_path') and the single band mask
+        ('bin_path'); either can be None to not produce it.
+        Images in another EPSG space are reprojected in memory; nothing but the products are
+        written to disk. With the 'native_crs' option, images that fit in memory are masked in
+        their own EPSG space and only the products are reprojected.
+        The products are written compressed, without a separate compression pass. With the
+        'cog' option they're cloud optimized GeoTIFFs with internal tiles and overviews; only
+        images masked in tiles are rewritten to add the overviews, which is timed as the
+        'compress' stage.
+        When 'cache_dir' is set, masks of images that aren't masked in tiles are kept in the
+        cache and reused; only the products are written again.
+        This function is called in worker processes and doesn't communicate with Clowder;
+        uploads are left to the caller
+    """
+    mask_path = job['mask_path']
+    bin_path = job['bin_path']
+    set_label_workers(job['label_workers'])
+    image_buffers.set_max_mb(job['buffer_pool_mb'])
+    out_files = [one_path for one_path in (mask_path, bin_path) if one_path]
+    timings = StageTimings()
+    result = {'source': job['source'], 'files': out_files, 'masked': False,
+              'ratio': None, 'bytes': 0, 'skip': None, 'info': [], 'timings': timings.durations}
+
+    # Make sure the source image is in the correct EPSG space. Reprojected images are warped
+    # once it's known how they're masked
+    epsg = get_epsg(job['source'])
+    reproject = epsg is not None and str(epsg) != str(job['epsg'])
+    if reproject:
+        result['info'].append("Reprojecting from " + str(epsg) + " to default " +
+                              str(job['epsg']))
+        mask_source = None
+    else:
+        mask_source = gdal.Open(job['source'])
+
+    # Get the bounds of the image to see if we can process it; images without an EPSG code
+    # aren't reprojected, so non-georeferenced images are found here
+    bounds = job['bounds']
+    if bounds is None and not reproject:
+        bounds = get_image_bounds(mask_source)
+        if bounds is None:
+            result['skip'] = "Skipping non-georeferenced image: " + \
+                             os.path.basename(job['source'])
+            return result
+
+    missing = [one_path for one_path in out_files if not file_exists(one_path)]
+    if missing or job['overwrite']:
+        result['info'].append("creating %s" % ", ".join(out_files))
+        result['masked'] = True
+
+        # A reprojected image is warped to about as many pixels as its source has, so the
+        # source's size decides how it's masked
+        native = reproject and job['native_crs'] and \
+                 choose_processing_mode(job['source'], job['memory_mb']) == 'whole'
+        tiled = not native and \
+                choose_processing_mode(job['source'] if reproject else mask_source,
+                                       job['memory_mb']) == 'tiled'
+
+        if reproject:
+            # An image masked whole is warped into memory in one pass. Otherwise the VRT only
+            # describes the warp, and pixels are reprojected as they're read, or, for native
+            # masking, as the products are written
+            with timings.stage('reproject'):
+                mask_source = reproject_image(job['source'], job['epsg'],
+                                              'VRT' if native or tiled else 'MEM',
+                                              job['warp_memory_mb'])
+            if bounds is None:
+                bounds = get_image_bounds(mask_source)
+
+        # Images masked in tiles aren't cached, so they aren't read again to fingerprint them
+        cache, cache_key = None, None
+        if job['cache_dir'] and not tiled:
+            cache = MaskCache(job['cache_dir'], job['cache_max_mb'])
+            cache_key = file_fingerprint(job['source'],
+                                         mask_parameters(quality_check=job['quality_check'],
+                                                         epsg=job['epsg'] if reproject else None,
+                                                         native_crs=job['native_crs'],
+                                                         engine=job['engine'],
+                                                         engine_threshold=job['engine_threshold'],
+                                                         sample_step=job['sample_step']))
+
+        if native:
+            mask_ratio, warped_bytes, image_bytes, cpu_seconds = \
+                gen_cc_enhanced_native(job['source'], mask_path, job['epsg'], bounds,
+                                       mask_source.RasterXSize, mask_source.RasterYSize,
+                                       extractor_info=job['extractor_info'],
+                                       system_md=job['system_md'],
+                                       quality_check=job['quality_check'],
+                                       compress=job['compress'],
+                                       predictor=job['predictor'],
+                                       compress_level=job['compress_level'],
+                                       mask_path=bin_path,
+                                       mask_nodata=job['mask_nodata'],
+                                       cache=cache, cache_key=cache_key,
+                                       engine=job['engine'],
+                                       engine_threshold=job['engine_threshold'],
+                                       cog=job['cog'], sample_step=job['sample_step'],
+                                       timings=timings)
+            if mask_ratio is not None:
+                result['info'].append(native_warp_report(warped_bytes, image_bytes, cpu_seconds))
+        elif tiled:
+            result['info'].append("masking in tiles to stay within %s MB" %
+                                  str(job['memory_mb']))
+            mask_ratio = gen_cc_enhanced_tiled(mask_source, mask_path, bounds,
+                                               memory_mb=job['memory_mb'],
+                                               extractor_info=job['extractor_info'],
+                                               system_md=job['system_md'],
+                                               quality_check=job['quality_check'],
+                                               compress=job['compress'],
+                                               predictor=job['predictor'],
+                                               compress_level=job['compress_level'],
+                                               mask_path=bin_path,
+                                               mask_nodata=job['mask_nodata'],
+                                               engine=job['engine'],
+                                               engine_threshold=job['engine_threshold'],
+                                               timings=timings)
+            if mask_ratio is not None and job['cog']:
+                # Tiles are written as they're masked, so overviews are added afterwards
+                with timings.stage('compress'):
+                    if mask_path:
+                        convert_to_cog(mask_path, job['compress'], job['predictor'],
+                                       job['compress_level'], MASK_GEOTIFF_THREADS,
+                                       resample=RGB_OVERVIEW_RESAMPLE)
+                    if bin_path:
+                        convert_to_cog(bin_path, job['compress'], job['predictor'],
+                                       job['compress_level'], MASK_GEOTIFF_THREADS,
+                                       mask_nbits(job['mask_nodata']),
+                                       resample=MASK_OVERVIEW_RESAMPLE)
+        else:
+            with timings.stage('mask'):
+                mask_ratio, img, binMask = gen_cc_enhanced_mask_cached(mask_source, cache, cache_key,
+                                                                       quality_check=job['quality_check'],
+                                                                       engine=job['engine'],
+                                                                       engine_threshold=job['engine_threshold'],
+                                                                       sample_step=job['sample_step'])
+
+            with timings.stage('write'):
+                # The single band mask looks for image data, so it's made before the image is
+                # masked
+                if mask_ratio is not None and bin_path:
+                    create_geotiff(gen_bin_mask(img, binMask, job['mask_nodata']), bounds, bin_path,
+                                   job['mask_nodata'], False, job['extractor_info'],
+                                   job['system_md'], None, job['compress'], job['predictor'],
+                                   job['compress_level'], MASK_GEOTIFF_TILED, MASK_GEOTIFF_THREADS,
+                                   mask_nbits(job['mask_nodata']), cog=job['cog'],
+                                   overview_resample=MASK_OVERVIEW_RESAMPLE)
+
+                if mask_ratio is not None and mask_path:
+                    # Masked in place; the bands are reversed in a view to avoid swapping R and B
+                    mask_rgb = gen_rgb_mask(img, binMask, out=img)[:, :, ::-1]
+
+                    create_geotiff(mask_rgb, bounds, mask_path, None, False,
+                                   job['extractor_info'], job['system_md'], None, job['compress'],
+                                   job['predictor'], job['compress_level'], MASK_GEOTIFF_TILED,
+                                   MASK_GEOTIFF_THREADS, cog=job['cog'],
+                                   overview_resample=RGB_OVERVIEW_RESAMPLE)
+
+            if mask_ratio is not None:
+                image_buffers.release(img)
+
+        if cache is not None and cache.hits:
+            result['info'].append("reused the cached mask of %s" % os.path.basename(job['source']))
+
+        result['ratio'] = mask_ratio
+        if mask_ratio is None:
+            result['skip'] = "Skipping low quality image: " + os.path.basename(job['source'])
+            return result
+
+        for one_path in out_files:
+            result['bytes'] += os.path.getsize(one_path)
+
+    return result
+
+def terraref_side(file_name):
+    """Returns 'left' or 'right' for the side of the camera that took a TERRA REF image
+    """
+    return 'left' if file_name.endswith('_left.tif') else 'right'
 
 def find_terraref_files(resource):
     """Returns the left, and right image file names
@@ -276,6 +1251,200 @@ def add_local_arguments(parser):
                              help='Identify executable used to for image type capture ' +
                              '(default=' + identify_binary + ')')
 
+    # Memory available for masking an image before switching to tiled processing
+    parser.add_argument('--mask-memory-mb', type=int, dest='mask_memory_mb',
+                        default=int(os.getenv('MASK_MEMORY_MB', DEFAULT_MASK_MEMORY_MB)),
+                        help='memory budget in MB for masking an image; larger images are ' +
+                        'processed in tiles (default=' + str(DEFAULT_MASK_MEMORY_MB) + ')')
+
+    # Number of images to mask at the same time
+    parser.add_argument('--workers', type=int, dest='workers',
+                        default=int(os.getenv('MASK_WORKERS', 1)),
+                        help='number of processes used to mask the images of a dataset; the ' +
+                        'memory budget is shared between them (default=1)')
+
+    # Number of threads labeling the components of each mask
+    parser.add_argument('--label-threads', type=int, dest='label_threads',
+                        default=int(os.getenv('MASK_LABEL_THREADS', DEFAULT_LABEL_WORKERS)),
+                        help='number of threads labeling mask components in strips for each ' +
+                        'image; the masks are the same for any number (default=' +
+                        str(DEFAULT_LABEL_WORKERS) + ')')
+
+    # Memory kept for reading the next images into
+    parser.add_argument('--buffer-pool-mb', type=int, dest='buffer_pool_mb',
+                        default=int(os.getenv('MASK_BUFFER_POOL_MB', DEFAULT_BUFFER_POOL_MB)),
+                        help='memory in MB of image buffers kept between images so that images ' +
+                        'of the same size reuse them; 0 turns reuse off (default=' +
+                        str(DEFAULT_BUFFER_POOL_MB) + ')')
+
+    # Compression of the mask files
+    parser.add_argument('--compression', type=str.upper, dest='compression',
+                        choices=['NONE', 'LZW', 'DEFLATE', 'ZSTD'],
+                        default=os.getenv('MASK_COMPRESSION', DEFAULT_MASK_COMPRESSION),
+                        help='compression codec of the mask GeoTIFFs (default=' +
+                        DEFAULT_MASK_COMPRESSION + ')')
+    parser.add_argument('--compression-level', type=int, dest='compression_level',
+                        default=os.getenv('MASK_COMPRESSION_LEVEL', None),
+                        help='compression level for DEFLATE (1-9) or ZSTD (1-22)')
+    parser.add_argument('--predictor', type=int, dest='predictor', choices=[1, 2],
+                        default=int(os.getenv('MASK_PREDICTOR', DEFAULT_MASK_PREDICTOR)),
+                        help='compression predictor, 1 for none or 2 for horizontal ' +
+                        'differencing (default=' + str(DEFAULT_MASK_PREDICTOR) + ')')
+
+    # Working memory for reprojecting images
+    parser.add_argument('--warp-memory-mb', type=int, dest='warp_memory_mb',
+                        default=int(os.getenv('WARP_MEMORY_MB', DEFAULT_WARP_MEMORY_MB)),
+                        help='working memory in MB used when reprojecting an image ' +
+                        '(default=' + str(DEFAULT_WARP_MEMORY_MB) + ')')
+
+    # Write products that windowed readers can fetch parts and overviews of
+    parser.add_argument('--cog', dest='cog',
+                        default=os.getenv('MASK_COG', 'false').lower() == 'true',
+                        action='store_true',
+                        help='write cloud optimized GeoTIFFs with internal tiles and overviews; ' +
+                        'single band mask overviews use nearest neighbour resampling')
+
+    # Products to write for each image
+    parser.add_argument('--output-mode', dest='output_mode', choices=OUTPUT_MODES,
+                        default=os.getenv('MASK_OUTPUT_MODE', DEFAULT_OUTPUT_MODE),
+                        help='products to write: the masked RGB image (rgb), a single band ' +
+                        'mask of 1 for plants and 0 otherwise (mask), or both ' +
+                        '(default=' + DEFAULT_OUTPUT_MODE + ')')
+    parser.add_argument('--mask-nodata', type=int, dest='mask_nodata',
+                        default=os.getenv('MASK_NODATA', None),
+                        help='nodata value, from 2 to 255, of the single band mask for pixels ' +
+                        'without image data; without it the mask is stored with 1 bit per pixel')
+
+    # Keep masks to reuse when images are processed again
+    parser.add_argument('--cache-dir', dest='cache_dir',
+                        default=os.getenv('MASK_CACHE_DIR', None),
+                        help='folder to keep the masks of images in so that unchanged images ' +
+                        'aren\'t masked again; caching is off when not specified')
+    parser.add_argument('--cache-max-mb', type=int, dest='cache_max_mb',
+                        default=int(os.getenv('MASK_CACHE_MAX_MB', DEFAULT_CACHE_MAX_MB)),
+                        help='size limit of the mask cache in MB; the least recently used ' +
+                        'masks are removed first (default=' + str(DEFAULT_CACHE_MAX_MB) + ')')
+
+    # Mask images before reprojecting them
+    parser.add_argument('--mask-native-crs', dest='mask_native_crs',
+                        default=os.getenv('MASK_NATIVE_CRS', 'false').lower() == 'true',
+                        action='store_true',
+                        help='mask images in their native EPSG space and reproject only the ' +
+                        'masked output; images masked in tiles are still reprojected first')
+
+    # Vegetation index used to classify pixels as plants
+    parser.add_argument('--mask-engine', dest='mask_engine', choices=sorted(MASK_ENGINES),
+                        default=os.getenv('MASK_ENGINE', DEFAULT_MASK_ENGINE),
+                        help='vegetation index classifying pixels before the plant mask vote; ' +
+                        'can be overridden by the experiment configuration (default=' +
+                        DEFAULT_MASK_ENGINE + ')')
+    parser.add_argument('--mask-engine-threshold', type=float, dest='mask_engine_threshold',
+                        default=os.getenv('MASK_ENGINE_THRESHOLD', None),
+                        help='value the vegetation index must exceed for a pixel to be a ' +
+                        'plant, in pixel values for g-r, chromatic coordinates (channels ' +
+                        'divided by R+G+B) for exg and exg-exr, and index values for vari and ' +
+                        'ngrdi; defaults to the engine\'s own threshold')
+
+    # Estimate the statistics choosing the saturated mask process from a sample of the pixels
+    parser.add_argument('--saturation-sample-step', type=int, dest='saturation_sample_step',
+                        default=int(os.getenv('MASK_SATURATION_SAMPLE_STEP', 1)),
+                        help='with --skip-quality-check, choose between the saturated and ' +
+                        'normal mask process using every Nth row and column of an image ' +
+                        '(default=1, all pixels)')
+
+    # Mask images even when their quality scores are low
+    parser.add_argument('--skip-quality-check', dest='skip_quality_check', default=False,
+                        action='store_true',
+                        help='generate masks for low quality images instead of skipping them')
+
+def get_mask_options(args):
+    """Returns the options of mask jobs that are the same for every image
+    Args:
+        args(Namespace): the parsed command line with the arguments of add_local_arguments()
+    Return:
+        A dictionary of the options, keyed as in the jobs passed to mask_image_file()
+    Exception:
+        A ValueError is raised if the nodata value of the single band mask isn't valid
+    """
+    mask_nodata = args.mask_nodata
+    if mask_nodata is not None:
+        mask_nodata = int(mask_nodata)
+        if not 1 < mask_nodata <= MAX_PIXEL_VAL:
+            raise ValueError("--mask-nodata must be from 2 to %s" % str(MAX_PIXEL_VAL))
+
+    engine_threshold = args.mask_engine_threshold
+    if engine_threshold is not None:
+        engine_threshold = float(engine_threshold)
+
+    return {
+        'mask_nodata': mask_nodata,
+        'quality_check': not args.skip_quality_check,
+        'sample_step': max(args.saturation_sample_step, 1),
+        'engine': args.mask_engine,
+        'engine_threshold': engine_threshold,
+        'label_workers': max(args.label_threads, 1),
+        'buffer_pool_mb': max(args.buffer_pool_mb, 0),
+        'compress': None if args.compression == 'NONE' else args.compression,
+        'predictor': args.predictor,
+        'compress_level': args.compression_level,
+        'warp_memory_mb': args.warp_memory_mb,
+        'native_crs': args.mask_native_crs,
+        'cog': args.cog,
+        'cache_dir': args.cache_dir,
+        'cache_max_mb': args.cache_max_mb
+    }
+
+def mask_output_paths(sensors, output_mode, datestamp, opts=None):
+    """Returns the paths of the products configured by the output mode
+    Args:
+        sensors(Sensors): the sensor the products are stored under
+        output_mode(str): one of OUTPUT_MODES
+        datestamp(str): the date to use when creating file paths
+        opts(list): the file name options identifying the image, such as ['left']
+    Return:
+        A tuple of the masked RGB image path and the single band mask path; a path is None if
+        the output mode doesn't produce that product
+    """
+    opts = opts if opts else []
+    mask_name, bin_name = None, None
+    if output_mode in ['rgb', 'both']:
+        mask_name = sensors.create_sensor_path(datestamp, opts=opts)
+    if output_mode in ['mask', 'both']:
+        bin_name = sensors.create_sensor_path(datestamp, opts=opts + [BIN_MASK_OPT])
+
+    return (mask_name, bin_name)
+
+def find_duplicate_outputs(jobs):
+    """Finds the product paths that more than one masking job would write
+    Args:
+        jobs(list): the jobs to pass to mask_image_file()
+    Return:
+        A sorted list of the paths written by more than one job
+    """
+    seen, duplicates = set(), set()
+    for job in jobs:
+        for one_path in [job['mask_path'], job['bin_path']]:
+            if one_path is None:
+                continue
+            if one_path in seen:
+                duplicates.add(one_path)
+            seen.add(one_path)
+
+    return sorted(duplicates)
+
+def mask_process_context():
+    """Returns the multiprocessing context that starts the processes masking images
+    Return:
+        The forkserver context where it's available, and the spawn context otherwise
+    Notes:
+        The extractor has upload and labeling threads running when it masks images. A process
+        forked while they run can inherit locks they hold that are never released, so masking
+        processes are started from a process without them
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
 class rgbEnhancementExtractor(TerrarefExtractor):
 
     def __init__(self):
@@ -288,31 +1457,120 @@ class rgbEnhancementExtractor(TerrarefExtractor):
 
         # assign local arguments
         self.leftonly = self.args.left
+        self.mask_memory_mb = self.args.mask_memory_mb
+        self.workers = max(self.args.workers, 1)
+        self.mask_pool = None
+        self.output_mode = self.args.output_mode
+        try:
+            self.mask_options = get_mask_options(self.args)
+        except ValueError as ex:
+            self.parser.error(str(ex))
 
-    def get_maskfilename_bounds(self, file_name, datestamp):
-        """Determines the name of the masking file and loads the boundaries of the file
+    def get_output_paths(self, datestamp, opts=None):
+        """Returns the paths of the products configured by the output mode
+        Args:
+            datestamp(str): the date to use when creating file paths
+            opts(list): the file name options identifying the image, such as ['left']
+        Return:
+            See mask_output_paths()
+        """
+        return mask_output_paths(self.sensors, self.output_mode, datestamp, opts)
+
+    def get_mask_pool(self):
+        """Returns the pool of processes masking images, creating it the first time
+        Notes:
+            The pool is kept between messages since its processes are slow to start
+        """
+        if self.mask_pool is None:
+            self.mask_pool = mask_process_context().Pool(self.workers)
+        return self.mask_pool
+
+    def close_mask_pool(self):
+        """Stops the processes masking images, including any jobs they're still running
+        """
+        if self.mask_pool is not None:
+            self.mask_pool.terminate()
+            self.mask_pool.join()
+            self.mask_pool = None
+
+    def get_mask_engine(self):
+        """Returns the vegetation index engine to mask images with
+        Return:
+            A tuple of the engine name and its threshold, which is None for the engine's default
+        Notes:
+            The experiment configuration can override the command line with the 'maskEngine'
+            and 'maskEngineThreshold' values of its 'extractors' section. The threshold is in the
+            units of the engine's index, see mask_engines. An unknown engine in the configuration
+            is ignored
+        """
+        engine, threshold = self.mask_options['engine'], self.mask_options['engine_threshold']
+
+        if not self.experiment_metadata is None:
+            if 'extractors' in self.experiment_metadata:
+                ex_config = self.experiment_metadata['extractors']
+                if 'maskEngine' in ex_config:
+                    if ex_config['maskEngine'] in MASK_ENGINES:
+                        if ex_config['maskEngine'] != engine:
+                            engine, threshold = ex_config['maskEngine'], None
+                    else:
+                        logging.getLogger(__name__).warning(
+                            "Ignoring unknown mask engine '%s' in experiment configuration",
+                            str(ex_config['maskEngine']))
+                if 'maskEngineThreshold' in ex_config:
+                    threshold = float(ex_config['maskEngineThreshold'])
+
+        return (engine, threshold)
+
+    def get_mask_job(self, file_name, datestamp, workers=1, source_names=False):
+        """Determines the name of the masking file and how the file is to be masked
         Args:
             file_name(str): path of the file to create a mask from
             datestamp(str): the date to use when creating file paths
+            workers(int): the number of images being masked at the same time
+            source_names(bool): whether other images are named after their source file
         Return:
+            The job to pass to mask_image_file()
+        Notes:
+            The boundaries of TERRA REF images are loaded from their metadata. Other images
+            have their boundaries loaded from the image by mask_image_file(), after any
+            reprojection. Other images are named after the dataset's timestamp; source_names
+            is set when a dataset has more than one of them, so their products don't overwrite
+            each other
         """
-        mask_name, bounds = (None, None)
+        bounds = None
 
         if not self.get_terraref_metadata is None:
-            key = 'left' if file_name.endswith('_left.tif') else 'right'
-            mask_name = self.sensors.create_sensor_path(datestamp, opts=[key])
+            key = terraref_side(file_name)
+            mask_name, bin_name = self.get_output_paths(datestamp, [key])
             bounds = geojson_to_tuples(self.get_terraref_metadata['spatial_metadata'][key]['bounding_box'])
+        elif source_names:
+            source_name = os.path.splitext(os.path.basename(file_name))[0]
+            mask_name, bin_name = self.get_output_paths(datestamp, [source_name])
         else:
-            mask_name = self.sensors.create_sensor_path(datestamp)
-            bounds = image_get_geobounds(file_name)
-            bounds_len = len(bounds)
-            if bounds_len <= 0 or bounds[0] == np.nan:
-                bounds = None
-
-        return (mask_name, bounds)
+            mask_name, bin_name = self.get_output_paths(datestamp)
+        engine, engine_threshold = self.get_mask_engine()
+
+        job = dict(self.mask_options)
+        job.update({
+            'source': file_name,
+            'mask_path': mask_name,
+            'bin_path': bin_name,
+            'bounds': bounds,
+            'epsg': self.default_epsg,
+            'overwrite': self.overwrite,
+            'engine': engine,
+            'engine_threshold': engine_threshold,
+            # Images masked at the same time share the memory budget
+            'memory_mb': max(self.mask_memory_mb // max(workers, 1), 1),
+            'extractor_info': self.extractor_info,
+            'system_md': self.get_terraref_metadata
+        })
+
+        return job
 
     def check_message(self, connector, host, secret_key, resource, parameters):
         if "rulechecked" in parameters and parameters["rulechecked"]:
+            self.start_download()
             return CheckMessage.download
 
         self.start_check(resource)
@@ -333,14 +1591,19 @@ class rgbEnhancementExtractor(TerrarefExtractor):
                 self.log_skip(resource, "missing required files")
                 return CheckMessage.ignore
 
-            if get_extractor_metadata(md, self.extractor_info['name'],
-                                      self.extractor_info['version']):
-                # Make sure outputs properly exist
+            extractor_md = get_extractor_metadata(md, self.extractor_info['name'],
+                                                  self.extractor_info['version'])
+            if extractor_md:
+                # Make sure outputs properly exist, except for the images that were skipped
                 timestamp = resource['dataset_info']['name'].split(" - ")[1]
-                left_mask_tiff = self.sensors.create_sensor_path(timestamp, opts=['left'])
-                right_mask_tiff = self.sensors.create_sensor_path(timestamp, opts=['right'])
-                if (self.leftonly and file_exists(left_mask_tiff)) or \
-                   (not (file_exists(left_mask_tiff) and file_exists(right_mask_tiff))):
+                sides = ['left'] if self.leftonly else ['left', 'right']
+                out_files = []
+                for side in sides:
+                    if side + "_skipped" in extractor_md:
+                        continue
+                    out_files.extend([one_path for one_path in
+                                      self.get_output_paths(timestamp, [side]) if one_path])
+                if all([file_exists(one_path) for one_path in out_files]):
                     self.log_skip(resource, "metadata v%s and outputs already exist" % \
                                   self.extractor_info['version'])
                     return CheckMessage.ignore
@@ -350,15 +1613,62 @@ class rgbEnhancementExtractor(TerrarefExtractor):
             return CheckMessage.ignore
 
         # Have TERRA-REF metadata, but not any from this extractor
+        self.start_download()
         return CheckMessage.download
 
-    def process_message(self, connector, host, secret_key, resource, parameters):
+    def upload_product(self, connector, host, secret_key, resource, dataset_id, out_file,
+                       clowder_user, clowder_pass, uploaded_file_ids):
+        """Uploads a product to a dataset unless it's already there, in the upload thread
+        Args:
+            connector(obj): the message queue connector instance
+            host(str): the URI of the Clowder host
+            secret_key(str): used with the host API
+            resource(dict): the resource of the message, for logging
+            dataset_id(str): the dataset to upload to
+            out_file(str): path of the product
+            clowder_user(str): the user to upload as
+            clowder_pass(str): the user's password
+            uploaded_file_ids(list): receives the URL of the uploaded file
+        """
+        with self.stage('upload'):
+            found_in_dest = check_file_in_dataset(connector, host, secret_key, dataset_id,
+                                                  out_file, remove=self.overwrite)
+            if not found_in_dest:
+                self.log_info(resource, "uploading %s" % out_file)
+                fileid = upload_to_dataset(connector, host, clowder_user, clowder_pass,
+                                           dataset_id, out_file)
+                uploaded_file_ids.append(host + ("" if host.endswith("/") else "/") +
+                                         "files/" + fileid)
+
+    def upload_dataset_metadata(self, connector, host, secret_key, resource, dataset_id, md,
+                                uploaded_file_ids):
+        """Replaces the extractor's metadata on the dataset, in the upload thread
+        Args:
+            connector(obj): the message queue connector instance
+            host(str): the URI of the Clowder host
+            secret_key(str): used with the host API
+            resource(dict): the resource of the message
+            dataset_id(str): the dataset the metadata describes
+            md(dict): the metadata content, without the created files
+            uploaded_file_ids(list): the URLs of the uploaded files
+        """
+        content = {"files_created": list(uploaded_file_ids)}
+        content.update(md)
+        extractor_md = build_metadata(host, self.extractor_info, dataset_id, content, 'dataset')
+        self.log_info(resource, "uploading extractor metadata to Lv1 dataset")
+        with self.stage('metadata_upload'):
+            remove_metadata(connector, host, secret_key, resource['id'],
+                            self.extractor_info['name'])
+            upload_metadata(connector, host, secret_key, resource['id'], extractor_md)
 
-        super(rgbEnhancementExtractor, self).process_message(connector, host, secret_key,
-                                                             resource, parameters)
+    def process_message(self, connector, host, secret_key, resource, parameters):
 
         self.start_message(resource)
 
+        with self.stage('metadata'):
+            super(rgbEnhancementExtractor, self).process_message(connector, host, secret_key,
+                                                                 resource, parameters)
+
         # Get left/right files and metadata
         process_files = []
         if not self.get_terraref_metadata is None:
@@ -393,78 +1703,77 @@ class rgbEnhancementExtractor(TerrarefExtractor):
         target_dsid = resource['id']
         uploaded_file_ids = []
         ratios = []
+        skipped = {}
+
+        # Mask images in worker processes when configured to and there's more than one
+        workers = min(self.workers, len(process_files))
+        source_names = len(process_files) > 1
+        jobs = [self.get_mask_job(one_file, timestamp, workers, source_names)
+                for one_file in process_files]
 
         try:
-            for one_file in process_files:
-
-                mask_source = one_file
-
-                # Make sure the source image is in the correct EPSG space
-                epsg = get_epsg(one_file)
-                if epsg != self.default_epsg:
-                    self.log_info(resource, "Reprojecting from " + str(epsg) +
-                                  " to default " + str(self.default_epsg))
-                    _, tmp_name = tempfile.mkstemp()
-                    src = gdal.Open(one_file)
-                    gdal.Warp(tmp_name, src, dstSRS='EPSG:'+str(self.default_epsg))
-                    mask_source = tmp_name
-
-                # Get the bounds of the image to see if we can process it. Also get the mask filename
-                rgb_mask_tif, bounds = self.get_maskfilename_bounds(mask_source, timestamp)
-
-                if bounds is None:
-                    self.log_skip(resource, "Skipping non-georeferenced image: " + \
-                                                                    os.path.basename(one_file))
-                    if mask_source != one_file:
-                        os.remove(mask_source)
+            # Images masked at the same time can't write the same file
+            duplicates = find_duplicate_outputs(jobs)
+            if duplicates:
+                self.log_error(resource, "more than one image would be written to %s; not " \
+                                         "processing request" % ', '.join(duplicates))
+                return
+
+            if workers > 1:
+                self.log_info(resource, "masking %s images using %s processes" %
+                              (str(len(jobs)), str(workers)))
+                results = self.get_mask_pool().imap(mask_image_file, jobs)
+            else:
+                results = (mask_image_file(job) for job in jobs)
+
+            # Results are returned in the same order as the images. Uploads run in the background
+            # while the next image is masked
+            for job, result in zip(jobs, results):
+                self.timings.merge(result['timings'])
+                for msg in result['info']:
+                    self.log_info(resource, msg)
+
+                if result['masked']:
+                    # Keep the position of the ratio for left and right images
+                    ratios.append(result['ratio'])
+
+                if result['skip']:
+                    self.log_skip(resource, result['skip'])
+                    # Skipped images won't be masked by later messages either
+                    if not self.get_terraref_metadata is None:
+                        skipped[terraref_side(job['source'])] = result['skip']
                     continue
 
-                if not file_exists(rgb_mask_tif) or self.overwrite:
-                    self.log_info(resource, "creating %s" % rgb_mask_tif)
-
-                    mask_ratio, mask_rgb = gen_cc_enhanced(mask_source)
-                    ratios.append(mask_ratio)
-
-                    # Bands must be reordered to avoid swapping R and B
-                    mask_rgb = cv2.cvtColor(mask_rgb, cv2.COLOR_BGR2RGB)
+                if result['masked']:
+                    self.created += len(result['files'])
+                    self.bytes += result['bytes']
 
-                    create_geotiff(mask_rgb, bounds, rgb_mask_tif, None, False, self.extractor_info,
-                                   self.get_terraref_metadata)
-                    compress_geotiff(rgb_mask_tif)
-
-                    # Remove any temporary file
-                    if mask_source != one_file:
-                        os.remove(mask_source)
-
-                    self.created += 1
-                    self.bytes += os.path.getsize(rgb_mask_tif)
-
-                found_in_dest = check_file_in_dataset(connector, host, secret_key, target_dsid,
-                                                      rgb_mask_tif, remove=self.overwrite)
-                if not found_in_dest:
-                    self.log_info(resource, "uploading %s" % rgb_mask_tif)
-                    fileid = upload_to_dataset(connector, host, self.clowder_user, self.clowder_pass,
-                                               target_dsid, rgb_mask_tif)
-                    uploaded_file_ids.append(host + ("" if host.endswith("/") else "/") +
-                                             "files/" + fileid)
+                for out_file in result['files']:
+                    self.upload_in_background(self.upload_product, connector, host, secret_key,
+                                              resource, target_dsid, out_file, self.clowder_user,
+                                              self.clowder_pass, uploaded_file_ids)
 
             # Tell Clowder this is completed so subsequent file updates don't daisy-chain
             if not self.get_terraref_metadata is None:
                 ratios_len = len(ratios)
                 left_ratio = (ratios[0] if ratios_len > 0 else None)
                 right_ratio = (ratios[1] if ratios_len > 1 else None)
-                md = {
-                    "files_created": uploaded_file_ids
-                }
+                md = {}
                 if not left_ratio is None:
                     md["left_mask_ratio"] = left_ratio
                 if not self.leftonly and not right_ratio is None:
                     md["right_mask_ratio"] = right_ratio
-                extractor_md = build_metadata(host, self.extractor_info, target_dsid, md, 'dataset')
-                self.log_info(resource, "uploading extractor metadata to Lv1 dataset")
-                remove_metadata(connector, host, secret_key, resource['id'],
-                                self.extractor_info['name'])
-                upload_metadata(connector, host, secret_key, resource['id'], extractor_md)
+                for side in skipped:
+                    md[side + "_skipped"] = skipped[side]
+                # Queued after the products, so the IDs of all the uploaded files are known
+                self.upload_in_background(self.upload_dataset_metadata, connector, host,
+                                          secret_key, resource, target_dsid, md,
+                                          uploaded_file_ids)
+
+        except:
+            # Images of this message can still be masked by the pool
+            self.close_mask_pool()
+            raise
 
         finally:
             # Signal end of processing message and restore changed variables. Be sure to restore
@@ -476,6 +1785,335 @@ class rgbEnhancementExtractor(TerrarefExtractor):
             self.end_message(resource)
 
 
+def add_batch_arguments(parser):
+    """ Add the arguments of batch mode to parser
+    Args:
+        parser: the command argument parser
+    """
+    parser.add_argument('--output-base', dest='output_base',
+                        default=os.getenv('MASK_OUTPUT_BASE', None),
+                        help='sites folder to write the products to (default=--terraref_base)')
+    parser.add_argument('--start-date', dest='start_date', default=None,
+                        help='first capture date to mask, as YYYY-MM-DD')
+    parser.add_argument('--end-date', dest='end_date', default=None,
+                        help='last capture date to mask, as YYYY-MM-DD')
+
+    # Record of the finished work, to resume interrupted runs from
+    parser.add_argument('--journal', dest='journal',
+                        default=os.getenv('MASK_JOURNAL', None),
+                        help='file recording the masked images and registered products; images ' +
+                        'and products it lists are skipped when the run is started again')
+
+    # Register the products with Clowder once the images are masked
+    parser.add_argument('--register', dest='register', default=False, action='store_true',
+                        help='upload the products to Clowder after masking, one dataset for ' +
+                        'each capture')
+    parser.add_argument('--clowder-url', dest='clowder_url',
+                        default=os.getenv('CLOWDER_URL', None),
+                        help='URL of the Clowder instance to register products with')
+    parser.add_argument('--clowder-key', dest='clowder_key',
+                        default=os.getenv('CLOWDER_KEY', ''),
+                        help='Clowder API key used to look up collections and datasets')
+
+def find_capture_images(sensors, needed_sides, start_date=None, end_date=None):
+    """Finds the images of the captures stored in a sites folder
+    Args:
+        sensors(Sensors): the site and sensor of the images
+        needed_sides(list): the sides a capture needs an image of, such as ['left']
+        start_date(str): the first date to include as YYYY-MM-DD, or None for the earliest
+        end_date(str): the last date to include as YYYY-MM-DD, or None for the latest
+    Return:
+        A list of (timestamp, [(side, image path), ...]) tuples in timestamp order
+    Notes:
+        The folders are laid out as by Sensors.get_sensor_path(), with a folder for each date
+        holding a folder for each capture timestamp. Captures missing a needed image are
+        logged and left out
+    """
+    logger = logging.getLogger(__name__)
+
+    # The date folders are the parents of the timestamp folders holding the images
+    sample_path = sensors.get_sensor_path(BATCH_SAMPLE_TIMESTAMP, opts=[BATCH_SIDES[0]])
+    sensor_dir = os.path.dirname(os.path.dirname(os.path.dirname(sample_path)))
+    if not os.path.isdir(sensor_dir):
+        logger.warning("No images found, %s is not a folder", sensor_dir)
+        return []
+
+    captures = []
+    for date in sorted(os.listdir(sensor_dir)):
+        date_dir = os.path.join(sensor_dir, date)
+        if not os.path.isdir(date_dir):
+            continue
+        if (start_date and date < start_date) or (end_date and date > end_date):
+            continue
+
+        for timestamp in sorted(os.listdir(date_dir)):
+            if not os.path.isdir(os.path.join(date_dir, timestamp)):
+                continue
+            images = []
+            for side in BATCH_SIDES:
+                path = sensors.get_sensor_path(timestamp, opts=[side])
+                if os.path.isfile(path):
+                    images.append((side, path))
+
+            missing = [side for side in needed_sides if side not in dict(images)]
+            if missing:
+                logger.warning("Skipping capture %s, missing the %s image", timestamp,
+                               " and ".join(missing))
+                continue
+            captures.append((timestamp, images))
+
+    return captures
+
+def read_journal(journal_path):
+    """Loads the events recorded by earlier batch runs
+    Args:
+        journal_path(str): path of the journal; it doesn't need to exist
+    Return:
+        A tuple of the set of source images that were masked or skipped, the list of masked
+        events, and the set of product paths that were registered with Clowder
+    Notes:
+        Each line of the journal is a JSON event. A line cut short by an interrupted run is
+        ignored
+    """
+    done, masked, registered = set(), [], set()
+    if not os.path.exists(journal_path):
+        return (done, masked, registered)
+
+    with open(journal_path, 'r') as in_file:
+        for line in in_file:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get('event') in [JOURNAL_MASKED, JOURNAL_SKIPPED]:
+                done.add(event['source'])
+                if event['event'] == JOURNAL_MASKED:
+                    masked.append(event)
+            elif event.get('event') == JOURNAL_REGISTERED:
+                registered.add(event['path'])
+
+    return (done, masked, registered)
+
+def write_journal(journal_file, event):
+    """Records an event in the journal, if there is one
+    Args:
+        journal_file(file): the journal opened for appending, or None
+        event(dict): the event to record
+    """
+    if journal_file is not None:
+        journal_file.write(json.dumps(event, sort_keys=True) + "\n")
+        journal_file.flush()
+
+def batch_mask_image(job):
+    """Masks an image in batch mode, returning a failure instead of raising it
+    Args:
+        job(dict): the job to pass to mask_image_file(), with the capture's 'timestamp'
+    Return:
+        The result of mask_image_file() with the capture's timestamp ('timestamp'), the size
+        of the source image ('source_bytes') and, if masking failed, the reason ('error')
+    Notes:
+        This function is called in worker processes; one damaged image doesn't stop the run
+    """
+    try:
+        result = mask_image_file(job)
+    except Exception as ex:
+        result = {'source': job['source'], 'files': [], 'masked': False, 'ratio': None,
+                  'bytes': 0, 'skip': None, 'info': [], 'timings': {}, 'error': str(ex)}
+
+    result['timestamp'] = job['timestamp']
+    result['source_bytes'] = os.path.getsize(job['source'])
+    return result
+
+def register_products(args, display_name, masked, registered, journal_file):
+    """Uploads the masked products to Clowder, one dataset for each capture
+    Args:
+        args(Namespace): the parsed batch command line
+        display_name(str): the name of the products' collections and datasets
+        masked(list): the masked events of the images
+        registered(set): the product paths that are already registered
+        journal_file(file): the journal opened for appending, or None
+    Return:
+        The number of products uploaded
+    Notes:
+        Each capture's collections and dataset are looked up once for all its products, and
+        the uploads reuse the connections of the shared HTTP client. Products are streamed from
+        disk, so only a chunk of each is held in memory
+    """
+    logger = logging.getLogger(__name__)
+    host = args.clowder_url if args.clowder_url.endswith('/') else args.clowder_url + '/'
+
+    capture_files = {}
+    for event in masked:
+        for one_file in event['files']:
+            if one_file not in registered and os.path.exists(one_file):
+                capture_files.setdefault(event['timestamp'], [])
+                if one_file not in capture_files[event['timestamp']]:
+                    capture_files[event['timestamp']].append(one_file)
+
+    uploaded = 0
+    for timestamp in sorted(capture_files):
+        year, month, day = timestamp.split('__')[0].split('-')
+        dataset_id = build_dataset_hierarchy(host, args.clowder_key, args.clowder_user,
+                                             args.clowder_pass, args.clowderspace, None, None,
+                                             display_name, year, month, day,
+                                             "%s - %s" % (display_name, timestamp))
+
+        for one_file in capture_files[timestamp]:
+            logger.info("uploading %s", one_file)
+            # The file is streamed from disk a chunk at a time rather than encoded in memory
+            with httpclient.MultipartFileEncoder("File", one_file) as body:
+                result = httpclient.post('%sapi/uploadToDataset/%s' % (host, dataset_id),
+                                         data=body, headers={'Content-Type': body.content_type},
+                                         auth=(args.clowder_user, args.clowder_pass))
+                result.raise_for_status()
+                logger.info("uploaded %s: %d bytes in %.1f s (%.1f MB/s)",
+                            os.path.basename(one_file), body.len, body.elapsed(),
+                            body.throughput() / 1000000)
+            write_journal(journal_file, {'event': JOURNAL_REGISTERED, 'path': one_file,
+                                         'dataset': dataset_id, 'id': result.json()['id']})
+            uploaded += 1
+
+    return uploaded
+
+def batch_main(argv=None):
+    """Masks the RGB captures stored in a sites folder, without Clowder messages
+    Args:
+        argv(list): the command line arguments following 'batch'
+    Return:
+        The exit status: 0 when every image was processed and 1 when any failed
+    Notes:
+        Images are masked by a pool of --workers processes, with the same options as the
+        extractor. Products are written under the masked sensor's folders of the output base.
+        Images are georeferenced from their own GeoTIFF tags, since the capture metadata is
+        only available from Clowder
+    """
+    parser = argparse.ArgumentParser(prog='terra_rgbmask.py batch',
+                                     description='Mask the RGB GeoTIFF captures of a sites folder')
+    add_extractor_arguments(parser)
+    add_sensor_arguments(parser)
+    add_local_arguments(parser)
+    add_batch_arguments(parser)
+    args = parser.parse_args(argv)
+    try:
+        options = get_mask_options(args)
+    except ValueError as ex:
+        parser.error(str(ex))
+    if args.register and not args.clowder_url:
+        parser.error("--register needs the Clowder URL from --clowder-url")
+
+    logging.basicConfig(level=args.debug, format='%(asctime)s %(levelname)s: %(message)s')
+    logger = logging.getLogger(__name__)
+
+    sources = Sensors(base=args.terraref_base, station=args.terraref_site,
+                      sensor=BATCH_SOURCE_SENSOR)
+    products = Sensors(base=args.output_base if args.output_base else args.terraref_base,
+                       station=args.terraref_site, sensor='rgb_mask')
+    needed_sides = ['left'] if args.left else BATCH_SIDES
+    captures = find_capture_images(sources, needed_sides, args.start_date, args.end_date)
+
+    done, masked, registered = set(), [], set()
+    if args.journal:
+        done, masked, registered = read_journal(args.journal)
+
+    workers = max(args.workers, 1)
+    extractor_info = load_json_file(EXTRACTOR_INFO_FILE)
+    jobs = []
+    for timestamp, images in captures:
+        for side, source in images:
+            if source in done:
+                continue
+            mask_path, bin_path = mask_output_paths(products, args.output_mode, timestamp, [side])
+            job = dict(options)
+            job.update({
+                'source': source,
+                'timestamp': timestamp,
+                'mask_path': mask_path,
+                'bin_path': bin_path,
+                'bounds': None,
+                # The EPSG code of the extractor's products, see TerrarefExtractor.default_epsg
+                'epsg': 4326,
+                'overwrite': args.overwrite,
+                # Images masked at the same time share the memory budget
+                'memory_mb': max(args.mask_memory_mb // workers, 1),
+                'extractor_info': extractor_info,
+                'system_md': None
+            })
+            jobs.append(job)
+
+    logger.info("masking %s images of %s captures using %s processes; %s done earlier",
+                str(len(jobs)), str(len(captures)), str(min(workers, max(len(jobs), 1))),
+                str(len(done)))
+
+    journal_file = open(args.journal, 'a') if args.journal else None
+    pool = None
+    counts = {'masked': 0, 'skipped': 0, 'failed': 0}
+    timings = StageTimings()
+    source_bytes, product_bytes = 0, 0
+    start_time = time.time()
+    try:
+        if workers > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(min(workers, len(jobs)))
+            results = pool.imap_unordered(batch_mask_image, jobs)
+        else:
+            results = (batch_mask_image(job) for job in jobs)
+
+        # Results arrive as the images are finished, in any order
+        for result in results:
+            timings.merge(result['timings'])
+            for msg in result['info']:
+                logger.info(msg)
+
+            if 'error' in result:
+                logger.error("Unable to mask %s: %s", result['source'], result['error'])
+                counts['failed'] += 1
+                continue
+            if result['skip']:
+                logger.info(result['skip'])
+                write_journal(journal_file, {'event': JOURNAL_SKIPPED, 'source': result['source'],
+                                             'timestamp': result['timestamp'],
+                                             'reason': result['skip']})
+                counts['skipped'] += 1
+                continue
+
+            event = {'event': JOURNAL_MASKED, 'source': result['source'],
+                     'timestamp': result['timestamp'], 'files': result['files'],
+                     'ratio': result['ratio']}
+            write_journal(journal_file, event)
+            masked.append(event)
+            if result['masked']:
+                counts['masked'] += 1
+                source_bytes += result['source_bytes']
+                product_bytes += result['bytes']
+
+        elapsed = max(time.time() - start_time, 1e-6)
+        logger.info("masked %s images (%s skipped, %s failed) in %.1fs: %.2f images/s, " +
+                    "%.2f MB/s read, %.2f MB/s written", str(counts['masked']),
+                    str(counts['skipped']), str(counts['failed']), elapsed,
+                    counts['masked'] / elapsed, source_bytes / elapsed / (1024 * 1024),
+                    product_bytes / elapsed / (1024 * 1024))
+        if timings.durations:
+            # Stages of images masked at the same time overlap, so they can add up to more
+            logger.info("time spent in stages: %s", ", ".join(
+                ["%s %.1fs" % (name, timings.durations[name] / 1000000000.0)
+                 for name in sorted(timings.durations)]))
+
+        if args.register:
+            uploaded = register_products(args, products.get_display_name(), masked, registered,
+                                         journal_file)
+            logger.info("registered %s products with Clowder", str(uploaded))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if journal_file is not None:
+            journal_file.close()
+
+    return 1 if counts['failed'] else 0
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        sys.exit(batch_main(sys.argv[2:]))
+
     extractor = rgbEnhancementExtractor()
     extractor.start()
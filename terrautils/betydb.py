@@ -7,7 +7,7 @@ import os
 import logging
 from datetime import datetime
 
-import requests
+from terrautils import httpclient
 import json
 from osgeo import ogr
 
@@ -75,7 +75,7 @@ def query(endpoint="search", **kwargs):
     payload = { 'key': get_bety_key() }
     payload.update(kwargs)
 
-    r = requests.get(get_bety_api(endpoint), params=payload)
+    r = httpclient.get(get_bety_api(endpoint), params=payload)
     r.raise_for_status()
     return r.json()
 
@@ -318,7 +318,7 @@ def submit_traits(csv, filetype='csv', betykey='', betyurl=''):
         logging.error("Unsupported file type.")
         return
 
-    resp = requests.post("%s.%s" % (betyurl, filetype), params=request_payload,
+    resp = httpclient.post("%s.%s" % (betyurl, filetype), params=request_payload,
                     data=file(csv, 'rb').read(),
                     headers={'Content-type': content_type})
 
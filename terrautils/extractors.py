@@ -9,14 +9,23 @@ import logging
 import json
 import os
 import re
-import requests
+import resource
+import sys
+import threading
+from terrautils import httpclient
 import yaml
 import utm
+from contextlib import contextmanager
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from urllib3.filepost import encode_multipart_formdata
 
 from pyclowder.extractors import Extractor
 from pyclowder.datasets import get_file_list, download_metadata as download_dataset_metadata
 from terrautils.influx import Influx, add_arguments as add_influx_arguments
+from terrautils.profiling import MessageProfiler, add_arguments as add_profile_arguments
 from terrautils.metadata import get_terraref_metadata, pipeline_get_metadata, \
                 get_season_and_experiment
 from terrautils.sensors import Sensors, add_arguments as add_sensor_arguments
@@ -27,6 +36,105 @@ logging.basicConfig(format='%(asctime)s %(message)s')
 
 DEFAULT_EXPERIMENT_JSON_FILENAME = 'experiment.yaml'
 
+# Uploads that can wait in the background queue before adding another one blocks
+DEFAULT_UPLOAD_QUEUE_SIZE = 4
+
+
+def monotonic_ns():
+    """Returns the time of a clock that never goes backwards, in nanoseconds. Only the
+    difference between two calls is meaningful.
+    """
+    if hasattr(time, 'monotonic_ns'):
+        return time.monotonic_ns()
+    if hasattr(time, 'monotonic'):
+        return int(time.monotonic() * 1000000000)
+    return int(time.time() * 1000000000)
+
+
+def cpu_seconds(start_times, end_times):
+    """Returns the CPU time spent between two os.times() results, including the time of
+    child processes that finished in between.
+    """
+    return sum(end_times[:4]) - sum(start_times[:4])
+
+
+def peak_rss_bytes():
+    """Returns the largest resident memory of this process over its whole life, in bytes.
+
+    Linux reports it in kilobytes.
+    """
+    return int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) * 1024
+
+
+def reset_peak_rss():
+    """Resets the peak resident memory of this process to its current size, so that VmHWM
+    reports the peak from now on.
+
+    Returns True if the peak was reset, and False if the system doesn't allow it, as on
+    systems other than Linux.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as out_file:
+            out_file.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def status_bytes(field):
+    """Returns a memory field of /proc/self/status, such as VmHWM, in bytes, or None if it
+    can't be read.
+    """
+    try:
+        with open('/proc/self/status', 'r') as in_file:
+            for line in in_file:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class StageTimings(object):
+    """Accumulates the time spent in the named stages of processing a message.
+
+    Stages that run more than once, such as for each file, add up. Timings of work done in
+    other processes can be merged in with add(). Stages can be timed from more than one thread,
+    such as the upload thread.
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager timing the enclosed code as part of a stage.
+
+        Keyword arguments:
+        name -- the name of the stage
+        """
+        start_ns = monotonic_ns()
+        try:
+            yield
+        finally:
+            self.add(name, monotonic_ns() - start_ns)
+
+    def add(self, name, duration_ns):
+        """Adds time to a stage.
+
+        Keyword arguments:
+        name -- the name of the stage
+        duration_ns -- the time to add, in nanoseconds
+        """
+        with self.lock:
+            self.durations[name] = self.durations.get(name, 0) + int(duration_ns)
+
+    def merge(self, durations):
+        """Adds the stage times of another StageTimings' durations dictionary."""
+        for name, duration_ns in durations.items():
+            self.add(name, duration_ns)
+
 def add_arguments(parser):
 
     # TODO: Move defaults into a level-based dict
@@ -57,6 +165,58 @@ def add_arguments(parser):
                              ' provide additional processing information')
 
 
+class UploadQueue(object):
+    """Runs uploads one at a time, in order, in a background thread.
+
+    Uploads overlap with the work queued after them, while Clowder still sees one write at a
+    time. Adding an upload blocks while the queue is full. After an upload fails, the uploads
+    queued after it are dropped and adding another one raises the error, until wait() is
+    called. The error is reported once: by the first add that raises it, or by wait().
+    """
+
+    def __init__(self, maxsize=DEFAULT_UPLOAD_QUEUE_SIZE):
+        self.tasks = queue.Queue(max(maxsize, 1))
+        # The error of the failed upload, and the same error until it's reported to the caller
+        self.failure = None
+        self.error = None
+        self.thread = None
+
+    def submit(self, function, *args, **kwargs):
+        """Queues a call of function with the arguments."""
+        if self.failure is not None:
+            self.error = None
+            raise self.failure
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name="uploads")
+            self.thread.daemon = True
+            self.thread.start()
+        self.tasks.put((function, args, kwargs))
+
+    def _run(self):
+        while True:
+            function, args, kwargs = self.tasks.get()
+            try:
+                if self.failure is None:
+                    function(*args, **kwargs)
+            except Exception as ex:
+                logging.getLogger(__name__).exception("Background upload failed")
+                # Set before the failure, so submit() can't see the failure and miss the error
+                self.error = ex
+                self.failure = ex
+            finally:
+                self.tasks.task_done()
+
+    def wait(self):
+        """Waits until the queued uploads are done.
+
+        Returns the error of the upload that failed, or None if there wasn't one or submit()
+        already raised it, and clears it so the queue can be used again.
+        """
+        self.tasks.join()
+        error, self.error, self.failure = self.error, None, None
+        return error
+
+
 class TerrarefExtractor(Extractor):
 
     def __init__(self):
@@ -66,10 +226,13 @@ class TerrarefExtractor(Extractor):
         add_arguments(self.parser)
         add_sensor_arguments(self.parser)
         add_influx_arguments(self.parser)
+        add_profile_arguments(self.parser)
 
         self.dataset_metadata = None
         self.terraref_metadata = None
         self.experiment_metadata = None
+        self.upload_queue = UploadQueue(int(os.getenv('UPLOAD_QUEUE_SIZE',
+                                                      DEFAULT_UPLOAD_QUEUE_SIZE)))
 
     def setup(self, base='', site='', sensor=''):
 
@@ -97,6 +260,8 @@ class TerrarefExtractor(Extractor):
         self.influx = Influx(self.args.influx_host, self.args.influx_port,
                              self.args.influx_db, self.args.influx_user,
                              self.args.influx_pass)
+        self.profiler = MessageProfiler(self.args.profile_dir, self.args.profile_rate,
+                                        self.args.profile_max_mb, self.args.profile_top)
 
     @property
     def default_epsg(self):
@@ -176,16 +341,83 @@ class TerrarefExtractor(Extractor):
     def start_message(self, resource):
         self.logger.info("[%s] %s - Processing message." % (resource['id'], resource['name']))
         self.starttime = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        self.start_ns = monotonic_ns()
+        self.start_times = os.times()
+        # The peak memory of the message, or the growth of the process' peak when it can't be
+        # reset; worker processes aren't included
+        self.peak_rss_reset = reset_peak_rss()
+        self.start_peak_rss = peak_rss_bytes()
         self.created = 0
         self.bytes = 0
 
+        self.timings = StageTimings()
+        download_ns = getattr(self, 'download_ns', None)
+        if download_ns is not None:
+            self.timings.add('download', self.start_ns - download_ns)
+            self.download_ns = None
+
+        httpclient.reset_counters()
+        clear_dataset_file_indexes()
+        self.profiler.start("%s_%s" % (resource['id'], resource['name']))
+
 
     def end_message(self, resource):
+        # Uploads of this message finish before the next message can queue any
+        upload_error = self.upload_queue.wait()
+        self.profiler.stop()
         self.logger.info("[%s] %s - Done." % (resource['id'], resource['name']))
         endtime = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        duration_ns = monotonic_ns() - self.start_ns
+        cpu_ns = int(cpu_seconds(self.start_times, os.times()) * 1000000000)
+        if self.peak_rss_reset:
+            peak_rss, peak_rss_growth = status_bytes('VmHWM'), None
+        else:
+            peak_rss, peak_rss_growth = None, peak_rss_bytes() - self.start_peak_rss
+        self.logger.debug("[%s] %s - Stage times (ms): %s" % (resource['id'], resource['name'],
+                          ", ".join(["%s %.1f" % (name, self.timings.durations[name] / 1000000.0)
+                                     for name in sorted(self.timings.durations)])))
         self.influx.log(self.extractor_info['name'],
                         self.starttime, endtime,
-                        self.created, self.bytes)
+                        self.created, self.bytes,
+                        duration_ns=duration_ns, stages=self.timings.durations,
+                        cpu_ns=cpu_ns, peak_rss=peak_rss, peak_rss_growth=peak_rss_growth,
+                        http=httpclient.get_counters())
+
+        if upload_error is not None:
+            # An exception that's already being raised, such as from masking, isn't replaced
+            if sys.exc_info()[0] is None:
+                raise upload_error
+            self.log_error(resource, "Upload also failed: %s" % str(upload_error))
+
+
+    def stage(self, name):
+        """Context manager timing the enclosed code as a stage of the current message; the
+        stage times are sent to Influx by end_message().
+
+        Keyword arguments:
+        name -- the name of the stage, such as 'upload'
+        """
+        return self.timings.stage(name)
+
+
+    def upload_in_background(self, function, *args, **kwargs):
+        """Queues an upload to run while the message continues; end_message() waits for the
+        queued uploads and raises the error of one that failed.
+
+        Keyword arguments:
+        function -- the function making the upload, called with the remaining arguments. It
+                    runs in another thread, so values that change before the message ends,
+                    such as credentials, are passed as arguments.
+        """
+        self.upload_queue.submit(function, *args, **kwargs)
+
+
+    def start_download(self):
+        """Marks the start of downloading the files of a message, to be called by check_message()
+        before returning CheckMessage.download. The time until start_message() is recorded as
+        the 'download' stage.
+        """
+        self.download_ns = monotonic_ns()
 
 
     def log_info(self, resource, msg):
@@ -728,6 +960,104 @@ def file_exists(filepath, max_age_mins=3):
         return False
 
 # CLOWDER UTILS -------------------------------------
+class HierarchyCache(object):
+    """Process wide cache of the IDs of Clowder collections and datasets, and of their links.
+
+    Entries are keyed by the host, the kind of resource, the space, the parent collection and
+    the name, and expire after a time to live. Once a resource is known to be linked to a
+    parent collection or a space, the linking request isn't repeated.
+    """
+
+    def __init__(self, ttl):
+        """Keyword arguments:
+        ttl -- seconds an entry stays valid; 0 or less turns the cache off
+        """
+        self.ttl = ttl
+        self.entries = {}
+        self.links = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _valid(self, stamp):
+        return self.ttl > 0 and monotonic_ns() - stamp < self.ttl * 1000000000
+
+    def get(self, host, kind, space, parent, name):
+        """Returns the cached ID of a resource, or None if it's not known or has expired."""
+        key = (host, kind, space, parent, name)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._valid(entry[1]):
+                self.hits += 1
+                return entry[0]
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def put(self, host, kind, space, parent, name, resource_id, links=None):
+        """Caches the ID of a resource, along with its links.
+
+        Keyword arguments:
+        links -- the collections and spaces the resource is known to be linked to; None for
+                 both the parent and the space
+        """
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            stamp = monotonic_ns()
+            self.entries[(host, kind, space, parent, name)] = (resource_id, stamp)
+            for one_parent in (links if links is not None else (parent, space)):
+                if one_parent:
+                    self.links[(host, resource_id, one_parent)] = stamp
+
+    def is_linked(self, host, resource_id, parent_id):
+        """Returns whether a resource is known to be linked to a collection or space."""
+        with self.lock:
+            stamp = self.links.get((host, resource_id, parent_id))
+            return stamp is not None and self._valid(stamp)
+
+    def add_link(self, host, resource_id, parent_id):
+        """Records that a resource is linked to a collection or space."""
+        if self.ttl > 0:
+            with self.lock:
+                self.links[(host, resource_id, parent_id)] = monotonic_ns()
+
+    def forget(self, resource_id):
+        """Removes the entries and links of a resource, such as after it's deleted."""
+        with self.lock:
+            for key in [key for key in self.entries if self.entries[key][0] == resource_id]:
+                del self.entries[key]
+            for key in [key for key in self.links if resource_id in key[1:]]:
+                del self.links[key]
+
+    def clear(self):
+        """Removes all entries and links."""
+        with self.lock:
+            self.entries.clear()
+            self.links.clear()
+
+
+# The hierarchy cache of this process; HIERARCHY_CACHE_TTL is in seconds, 0 turns it off
+hierarchy_cache = HierarchyCache(float(os.getenv('HIERARCHY_CACHE_TTL', 3600)))
+
+
+def link_to_parents(host, secret_key, resource_id, parent_colln, parent_space, add_to_collection,
+                    add_to_space):
+    """Links an existing resource to its parent collection and space, skipping known links.
+
+    Keyword arguments:
+    add_to_collection -- function linking the resource to the collection, called with the
+                         host, the key, the resource's ID and the collection's ID
+    add_to_space -- function linking the resource to the space, called likewise
+    """
+    if parent_colln and not hierarchy_cache.is_linked(host, resource_id, parent_colln):
+        add_to_collection(host, secret_key, resource_id, parent_colln)
+        hierarchy_cache.add_link(host, resource_id, parent_colln)
+    if parent_space and not hierarchy_cache.is_linked(host, resource_id, parent_space):
+        add_to_space(host, secret_key, resource_id, parent_space)
+        hierarchy_cache.add_link(host, resource_id, parent_space)
+
+
 # TODO: Remove redundant ones of these once PyClowder2 supports user/password
 def build_dataset_hierarchy(host, secret_key, clowder_user, clowder_pass, root_space,
                             season, experiment, root_coll_name, year='', month='', date='', leaf_ds_name=''):
@@ -844,25 +1174,38 @@ def build_dataset_hierarchy_crawl(host, secret_key, clowder_user, clowder_pass,
     return target_dsid
 
 
+def link_collection_to_parents(host, secret_key, coll_id, parent_colln, parent_space):
+    """Links an existing collection to its parent collection and space, see link_to_parents()."""
+    link_to_parents(host, secret_key, coll_id, parent_colln, parent_space,
+                    lambda h, k, child, parent: add_collection_to_collection(h, k, parent, child),
+                    add_collection_to_space)
+
+
 def get_collection_or_create(host, secret_key, clowder_user, clowder_pass, cname, parent_colln=None, parent_space=None):
+    # Use the ID found earlier, if there is one. The entry may have been cached without all of
+    # these links, such as by ensure_collection_in_children(); known links aren't requested again
+    coll_id = hierarchy_cache.get(host, 'collection', parent_space, parent_colln, cname)
+    if coll_id:
+        link_collection_to_parents(host, secret_key, coll_id, parent_colln, parent_space)
+        return coll_id
+
     # Fetch dataset from Clowder by name, or create it if not found
     url = "%sapi/collections?key=%s&title=%s&exact=true" % (host, secret_key, cname)
-    result = requests.get(url)
+    result = httpclient.get(url)
     result.raise_for_status()
 
     if len(result.json()) == 0:
-        return create_empty_collection(host, clowder_user, clowder_pass, cname, "", parent_colln, parent_space)
+        coll_id = create_empty_collection(host, clowder_user, clowder_pass, cname, "", parent_colln, parent_space)
     else:
         coll_id = result.json()[0]['id']
-        if parent_colln:
-            add_collection_to_collection(host, secret_key, parent_colln, coll_id)
-        if parent_space:
-            add_collection_to_space(host, secret_key, coll_id, parent_space)
-        return coll_id
+        link_collection_to_parents(host, secret_key, coll_id, parent_colln, parent_space)
+
+    hierarchy_cache.put(host, 'collection', parent_space, parent_colln, cname, coll_id)
+    return coll_id
 
 def get_child_collections(host, secret_key, collection_id):
     url = "%sapi/collections/%s/getChildCollections?key=%s" % (host, collection_id, secret_key)
-    result = requests.get(url)
+    result = httpclient.get(url)
     result.raise_for_status()
 
     return result.json()
@@ -886,28 +1229,28 @@ def create_empty_collection(host, clowder_user, clowder_pass, collectionname, de
     if parentid:
         if (spaceid):
             url = '%sapi/collections/newCollectionWithParent' % host
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data=json.dumps({"name": collectionname, "description": description,
+            result = httpclient.post(url, headers={"Content-Type": "application/json"},
+                                     data=json.dumps({"name": collectionname, "description": description,
                                                     "parentId": parentid, "space": spaceid}),
-                                   auth=(clowder_user, clowder_pass))
+                                     auth=(clowder_user, clowder_pass))
         else:
             url = '%sapi/collections/newCollectionWithParent' % host
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data=json.dumps({"name": collectionname, "description": description,
+            result = httpclient.post(url, headers={"Content-Type": "application/json"},
+                                     data=json.dumps({"name": collectionname, "description": description,
                                                     "parentId": parentid}),
-                                   auth=(clowder_user, clowder_pass))
+                                     auth=(clowder_user, clowder_pass))
     else:
         if (spaceid):
             url = '%sapi/collections' % host
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data=json.dumps({"name": collectionname, "description": description,
+            result = httpclient.post(url, headers={"Content-Type": "application/json"},
+                                     data=json.dumps({"name": collectionname, "description": description,
                                                     "space": spaceid}),
-                                   auth=(clowder_user, clowder_pass))
+                                     auth=(clowder_user, clowder_pass))
         else:
             url = '%sapi/collections' % host
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data=json.dumps({"name": collectionname, "description": description}),
-                                   auth=(clowder_user, clowder_pass))
+            result = httpclient.post(url, headers={"Content-Type": "application/json"},
+                                     data=json.dumps({"name": collectionname, "description": description}),
+                                     auth=(clowder_user, clowder_pass))
     result.raise_for_status()
 
     collectionid = result.json()['id']
@@ -916,21 +1259,26 @@ def create_empty_collection(host, clowder_user, clowder_pass, collectionname, de
     return collectionid
 
 def get_dataset_or_create(host, secret_key, clowder_user, clowder_pass, dsname, parent_colln=None, parent_space=None):
+    # Use the ID found earlier, if there is one
+    ds_id = hierarchy_cache.get(host, 'dataset', parent_space, parent_colln, dsname)
+    if ds_id:
+        return ds_id
+
     # Fetch dataset from Clowder by name, or create it if not found
     url = "%sapi/datasets?key=%s&title=%s&exact=true" % (host, secret_key, dsname)
-    result = requests.get(url)
+    result = httpclient.get(url)
     result.raise_for_status()
 
     if len(result.json()) == 0:
-        return create_empty_dataset(host, clowder_user, clowder_pass, dsname, "",
-                                    parent_colln, parent_space)
+        ds_id = create_empty_dataset(host, clowder_user, clowder_pass, dsname, "",
+                                     parent_colln, parent_space)
     else:
         ds_id = result.json()[0]['id']
-        if parent_colln:
-            add_dataset_to_collection(host, secret_key, ds_id, parent_colln)
-        if parent_space:
-            add_dataset_to_space(host, secret_key, ds_id, parent_space)
-        return ds_id
+        link_to_parents(host, secret_key, ds_id, parent_colln, parent_space,
+                        add_dataset_to_collection, add_dataset_to_space)
+
+    hierarchy_cache.put(host, 'dataset', parent_space, parent_colln, dsname, ds_id)
+    return ds_id
 
 def create_empty_dataset(host, clowder_user, clowder_pass, datasetname, description, parentid=None, spaceid=None):
     """Create a new dataset in Clowder.
@@ -951,25 +1299,25 @@ def create_empty_dataset(host, clowder_user, clowder_pass, datasetname, descript
 
     if parentid:
         if spaceid:
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data=json.dumps({"name": datasetname, "description": description,
+            result = httpclient.post(url, headers={"Content-Type": "application/json"},
+                                     data=json.dumps({"name": datasetname, "description": description,
                                                     "collection": [parentid], "space": [spaceid]}),
-                                   auth=(clowder_user, clowder_pass))
+                                     auth=(clowder_user, clowder_pass))
         else:
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data=json.dumps({"name": datasetname, "description": description,
+            result = httpclient.post(url, headers={"Content-Type": "application/json"},
+                                     data=json.dumps({"name": datasetname, "description": description,
                                                     "collection": [parentid]}),
-                                   auth=(clowder_user, clowder_pass))
+                                     auth=(clowder_user, clowder_pass))
     else:
         if spaceid:
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data=json.dumps({"name": datasetname, "description": description,
+            result = httpclient.post(url, headers={"Content-Type": "application/json"},
+                                     data=json.dumps({"name": datasetname, "description": description,
                                                     "space": [spaceid]}),
-                                   auth=(clowder_user, clowder_pass))
+                                     auth=(clowder_user, clowder_pass))
         else:
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data=json.dumps({"name": datasetname, "description": description}),
-                                   auth=(clowder_user, clowder_pass))
+            result = httpclient.post(url, headers={"Content-Type": "application/json"},
+                                     data=json.dumps({"name": datasetname, "description": description}),
+                                     auth=(clowder_user, clowder_pass))
 
     result.raise_for_status()
 
@@ -999,11 +1347,19 @@ def upload_to_dataset(connector, host, clowder_user, clowder_pass, datasetid, fi
     url = '%sapi/uploadToDataset/%s' % (host, datasetid)
 
     if os.path.exists(filepath):
-        result = connector.post(url, files={"File": open(filepath, 'rb')},
-                                auth=(clowder_user, clowder_pass))
+        # The file is streamed from disk a chunk at a time rather than encoded in memory
+        with httpclient.MultipartFileEncoder("File", filepath) as body:
+            result = httpclient.post(url, data=body, headers={'Content-Type': body.content_type},
+                                     auth=(clowder_user, clowder_pass),
+                                     verify=connector.ssl_verify if connector else True)
+            result.raise_for_status()
+            logger.info("uploaded %s: %d bytes in %.1f s (%.1f MB/s)", os.path.basename(filepath),
+                        body.len, body.elapsed(), body.throughput() / 1000000)
 
         uploadedfileid = result.json()['id']
         logger.debug("uploaded file id = [%s]", uploadedfileid)
+        # Clowder stores the bytes under its own path, so only the name is indexed
+        file_added_to_dataset(host, datasetid, uploadedfileid, os.path.basename(filepath))
 
         return uploadedfileid
     else:
@@ -1034,11 +1390,15 @@ def _upload_to_dataset_local(connector, host, clowder_user, clowder_pass, datase
         (content, header) = encode_multipart_formdata([
             ("file", '{"path":"%s"}' % filepath)
         ])
-        result = connector.post(url, data=content, headers={'Content-Type': header},
-                                auth=(clowder_user, clowder_pass))
+        result = httpclient.post(url, data=content, headers={'Content-Type': header},
+                                 auth=(clowder_user, clowder_pass),
+                                 verify=connector.ssl_verify if connector else True)
+        result.raise_for_status()
 
         uploadedfileid = result.json()['id']
         logger.debug("uploaded file id = [%s]", uploadedfileid)
+        file_added_to_dataset(host, datasetid, uploadedfileid, os.path.basename(filepath),
+                              filepath)
 
         return uploadedfileid
     else:
@@ -1057,7 +1417,7 @@ def get_child_collections(host, secret_key, collectionid):
     if collectionid:
         url = "%sapi/collections/%s/getChildCollections?key=%s" % (host, collectionid, secret_key)
 
-        result = requests.get(url)
+        result = httpclient.get(url)
         result.raise_for_status()
 
         return json.loads(result.text)
@@ -1076,15 +1436,16 @@ def get_datasets(host, clowder_user, clowder_pass, collectionid):
 
     url = "%sapi/collections/%s/datasets" % (host, collectionid)
 
-    result = requests.get(url, auth=(clowder_user, clowder_pass))
+    result = httpclient.get(url, auth=(clowder_user, clowder_pass))
     result.raise_for_status()
 
     return json.loads(result.text)
 
 def delete_dataset(host, clowder_user, clowder_pass, datasetid):
+    hierarchy_cache.forget(datasetid)
     url = "%sapi/datasets/%s" % (host, datasetid)
 
-    result = requests.delete(url, auth=(clowder_user, clowder_pass))
+    result = httpclient.delete(url, auth=(clowder_user, clowder_pass))
     result.raise_for_status()
 
     return json.loads(result.text)
@@ -1092,15 +1453,16 @@ def delete_dataset(host, clowder_user, clowder_pass, datasetid):
 def delete_dataset_metadata(host, clowder_user, clowder_pass, datasetid):
     url = "%sapi/datasets/%s/metadata.jsonld" % (host, datasetid)
 
-    result = requests.delete(url, stream=True, auth=(clowder_user, clowder_pass))
+    result = httpclient.delete(url, stream=True, auth=(clowder_user, clowder_pass))
     result.raise_for_status()
 
     return json.loads(result.text)
 
 def delete_collection(host, clowder_user, clowder_pass, collectionid):
+    hierarchy_cache.forget(collectionid)
     url = "%sapi/collections/%s" % (host, collectionid)
 
-    result = requests.delete(url, auth=(clowder_user, clowder_pass))
+    result = httpclient.delete(url, auth=(clowder_user, clowder_pass))
     result.raise_for_status()
 
     return json.loads(result.text)
@@ -1148,9 +1510,9 @@ def create_empty_space(host, clowder_user, clowder_pass, space_name, description
     logger = logging.getLogger(__name__)
 
     url = '%sapi/spaces' % host
-    result = requests.post(url, headers={"Content-Type": "application/json"},
-                           data=json.dumps({"name": space_name, "description": description}),
-                           auth=(clowder_user, clowder_pass))
+    result = httpclient.post(url, headers={"Content-Type": "application/json"},
+                             data=json.dumps({"name": space_name, "description": description}),
+                             auth=(clowder_user, clowder_pass))
     result.raise_for_status()
 
     spaceid = result.json()['id']
@@ -1161,7 +1523,7 @@ def create_empty_space(host, clowder_user, clowder_pass, space_name, description
 def get_space_or_create(host, secret_key, clowder_user, clowder_pass, space_name):
     # Fetch dataset from Clowder by name, or create it if not found
     url = "%sapi/spaces?key=%s&title=%s&exact=true" % (host, secret_key, space_name)
-    result = requests.get(url)
+    result = httpclient.get(url)
     result.raise_for_status()
 
     if len(result.json()) == 0:
@@ -1171,14 +1533,102 @@ def get_space_or_create(host, secret_key, clowder_user, clowder_pass, space_name
 
 def delete_file(host, secret_key, fileid):
     url = "%sapi/files/%s?key=%s" % (host, fileid, secret_key)
-    result = requests.delete(url)
+    result = httpclient.delete(url)
     result.raise_for_status()
+    file_removed_from_datasets(host, fileid)
+
+
+class DatasetFileIndex(object):
+    """The files of a Clowder dataset, indexed by name, by path and by ID.
+
+    The file list is fetched once; uploads and deletes made through the helpers of this
+    module update the index instead of fetching the list again.
+    """
+
+    def __init__(self, connector, host, secret_key, dsid):
+        self.host = host
+        self.dsid = dsid
+        self.by_id = {}
+        self.by_name = {}
+        self.by_path = {}
+        for f in get_file_list(connector, host, secret_key, dsid):
+            self.add(f['id'], f['filename'], f.get('filepath'))
+
+    def add(self, fileid, filename, filepath=None):
+        """Adds a file; filepath is None when Clowder's path of the file isn't known."""
+        self.remove(fileid)
+        f = {'id': fileid, 'filename': filename, 'filepath': filepath}
+        self.by_id[fileid] = f
+        self.by_name.setdefault(filename, []).append(f)
+        if filepath:
+            self.by_path.setdefault(filepath, []).append(f)
+
+    def remove(self, fileid):
+        """Removes a file, if it's in the index."""
+        f = self.by_id.pop(fileid, None)
+        if f is None:
+            return
+        for index, key in ((self.by_name, f['filename']), (self.by_path, f['filepath'])):
+            if key in index:
+                index[key] = [one_file for one_file in index[key] if one_file['id'] != fileid]
+                if not index[key]:
+                    del index[key]
+
+    def find_by_name(self, filename):
+        """Returns the list of files with the name."""
+        return list(self.by_name.get(filename, []))
+
+    def find_by_path(self, filepath):
+        """Returns the list of files with the path."""
+        return list(self.by_path.get(filepath, []))
+
+
+# File indexes of the datasets used by the current message, keyed by host and dataset ID. The
+# indexes are changed by the upload thread, so they're only used while holding the lock
+dataset_file_indexes = {}
+dataset_file_indexes_lock = threading.Lock()
+
+
+def get_dataset_file_index(connector, host, secret_key, dsid):
+    """Returns the file index of a dataset, fetching its file list the first time.
+
+    The caller needs to hold dataset_file_indexes_lock while it uses the index.
+    """
+    key = (host, dsid)
+    if key not in dataset_file_indexes:
+        dataset_file_indexes[key] = DatasetFileIndex(connector, host, secret_key, dsid)
+    return dataset_file_indexes[key]
+
+
+def clear_dataset_file_indexes(host=None, dsid=None):
+    """Drops the file index of a dataset, or of all datasets, so the next lookup fetches the
+    file list again. TerrarefExtractor.start_message() drops them all.
+    """
+    with dataset_file_indexes_lock:
+        if dsid is None:
+            dataset_file_indexes.clear()
+        else:
+            dataset_file_indexes.pop((host, dsid), None)
+
+
+def file_added_to_dataset(host, dsid, fileid, filename, filepath=None):
+    """Adds an uploaded file to the dataset's index, if the dataset is indexed."""
+    with dataset_file_indexes_lock:
+        if (host, dsid) in dataset_file_indexes:
+            dataset_file_indexes[(host, dsid)].add(fileid, filename, filepath)
+
+
+def file_removed_from_datasets(host, fileid):
+    """Removes a deleted file from the indexes of the datasets."""
+    with dataset_file_indexes_lock:
+        for (index_host, _), index in dataset_file_indexes.items():
+            if index_host == host:
+                index.remove(fileid)
+
 
 def check_file_in_dataset(connector, host, secret_key, dsid, filepath, remove=False, forcepath=False, replacements=[]):
     # Replacements = [("L2","L1")]
     # Each tuple is checked replacing first element in filepath with second element for existing
-    dest_files = get_file_list(connector, host, secret_key, dsid)
-
     if len(replacements) > 0:
         for r in replacements:
             filepath = filepath.replace(r[0], r[1])
@@ -1189,47 +1639,61 @@ def check_file_in_dataset(connector, host, secret_key, dsid, filepath, remove=Fa
 
     filename = os.path.basename(filepath)
 
-    found_file = False
-    for f in dest_files:
-        if (not forcepath and f['filename'] == filename) or (forcepath and f['filepath'] == filepath):
-            if remove:
-                delete_file(host, secret_key, f['id'])
-            found_file = True
+    with dataset_file_indexes_lock:
+        dest_files = get_dataset_file_index(connector, host, secret_key, dsid)
+        if forcepath:
+            found_files = dest_files.find_by_path(filepath)
+        else:
+            found_files = dest_files.find_by_name(filename)
+
+    if remove:
+        for f in found_files:
+            delete_file(host, secret_key, f['id'])
 
-    return found_file
+    return len(found_files) > 0
 
 def ensure_collection_in_children(host, secret_key, clowder_user, clowder_pass, parent_space, parent_coll_id, child_name):
     """Check if named collection is among parent's children, and create if not found."""
+    coll_id = hierarchy_cache.get(host, 'collection', parent_space, parent_coll_id, child_name)
+    if coll_id:
+        return coll_id
+
     child_collections = get_child_collections(host, secret_key, parent_coll_id)
     for c in child_collections:
         if c['name'] == child_name:
-            return str(c['id'])
+            # Only the link to the parent is known; the child may not be in the space
+            coll_id = str(c['id'])
+            hierarchy_cache.put(host, 'collection', parent_space, parent_coll_id, child_name,
+                                coll_id, links=[parent_coll_id])
+            return coll_id
 
     # If we didn't find it, create it
-    return create_empty_collection(host, clowder_user, clowder_pass, child_name, "", parent_coll_id, parent_space)
+    coll_id = create_empty_collection(host, clowder_user, clowder_pass, child_name, "", parent_coll_id, parent_space)
+    hierarchy_cache.put(host, 'collection', parent_space, parent_coll_id, child_name, coll_id)
+    return coll_id
 
 def add_dataset_to_collection(host, secret_key, dataset_id, collection_id):
     # Didn't find space, so we must associate it now
     url = "%sapi/collections/%s/datasets/%s?key=%s" % (host, collection_id, dataset_id, secret_key)
-    result = requests.post(url)
+    result = httpclient.post(url)
     result.raise_for_status()
 
 def add_dataset_to_space(host, secret_key, dataset_id, space_id):
     # Didn't find space, so we must associate it now
     url = "%sapi/spaces/%s/addDatasetToSpace/%s?key=%s" % (host, space_id, dataset_id, secret_key)
-    result = requests.post(url)
+    result = httpclient.post(url)
     result.raise_for_status()
 
 def add_collection_to_collection(host, secret_key, parent_coll_id, child_coll_id):
     # Didn't find space, so we must associate it now
     url = "%sapi/collections/%s/addSubCollection/%s?key=%s" % (host, parent_coll_id, child_coll_id, secret_key)
-    result = requests.post(url)
+    result = httpclient.post(url)
     result.raise_for_status()
 
 def add_collection_to_space(host, secret_key, collection_id, space_id):
     # Didn't find space, so we must associate it now
     url = "%sapi/spaces/%s/addCollectionToSpace/%s?key=%s" % (host, space_id, collection_id, secret_key)
-    result = requests.post(url)
+    result = httpclient.post(url)
     result.raise_for_status()
 
 def confirm_clowder_info(host, secret_key, space_id, clowder_user=None, clowder_pass=None):
@@ -1266,7 +1730,7 @@ def confirm_clowder_info(host, secret_key, space_id, clowder_user=None, clowder_
 
         # Try to find the space in Clowder
         url = '%sapi/spaces/%s?key=%s' % (host, space_id, secret_key)
-        result = requests.get(url)
+        result = httpclient.get(url)
         result.raise_for_status()
 
         ret = result.json()
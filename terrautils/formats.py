@@ -4,7 +4,6 @@ This module handles creation of output files in GeoTIF, netCDF, and other image
 """
 
 import numpy
-import subprocess
 import os
 from osgeo import gdal, osr
 from netCDF4 import Dataset
@@ -12,15 +11,163 @@ from matplotlib import cm, pyplot as plt
 from PIL import Image
 
 
-def compress_geotiff(input_file):
+# Codecs that GeoTIFF files can be compressed with, and the creation option setting their level
+GEOTIFF_COMPRESSION_LEVELS = {
+    'LZW': None,
+    'DEFLATE': 'ZLEVEL',
+    'ZSTD': 'ZSTD_LEVEL'
+}
+
+# Size in pixels of the square tiles of cloud optimized GeoTIFFs; overviews are added until the
+# smallest one fits in a single tile
+COG_BLOCK_SIZE = 512
+
+
+def geotiff_creation_options(compress=False, predictor=None, compress_level=None, tiled=False,
+                             num_threads=None, nbits=None):
+    """Returns the GTiff driver creation options for writing a compressed or bit packed GeoTIFF.
+
+        Keyword arguments:
+        compress -- codec name (LZW, DEFLATE or ZSTD), True for LZW, or False for no compression
+        predictor -- 1 for none, 2 for horizontal differencing, 3 for floating point
+        compress_level -- compression level of DEFLATE (1-9) or ZSTD (1-22); ignored for LZW
+        tiled -- whether to write a tiled file instead of strips
+        num_threads -- number of threads compressing blocks, or ALL_CPUS; None compresses on the calling thread
+        nbits -- number of bits stored per Byte pixel (1-7) for packed files, e.g. 1 for binary masks;
+                 predictors don't apply to packed files and are left out
+
+        Only the NBITS option is returned when compress is False, leaving the file uncompressed and in strips.
+    """
+    packed = nbits and nbits < 8
+    if not compress:
+        return ['NBITS=' + str(nbits)] if packed else []
+
+    codec = 'LZW' if compress is True else str(compress).upper()
+    if codec not in GEOTIFF_COMPRESSION_LEVELS:
+        raise ValueError("Unsupported GeoTIFF compression: %s" % str(compress))
+
+    options = ['COMPRESS=' + codec]
+    if packed:
+        options.append('NBITS=' + str(nbits))
+    elif predictor:
+        options.append('PREDICTOR=' + str(predictor))
+    if compress_level and GEOTIFF_COMPRESSION_LEVELS[codec]:
+        options.append('%s=%s' % (GEOTIFF_COMPRESSION_LEVELS[codec], str(compress_level)))
+    if tiled:
+        options.append('TILED=YES')
+    if num_threads:
+        options.append('NUM_THREADS=' + str(num_threads))
+
+    return options
+
+
+def compress_geotiff(input_file, compress='LZW', predictor=None, compress_level=None, tiled=False,
+                     num_threads=None):
+    """Compress an existing GeoTIFF file in place.
+
+        Keyword arguments:
+        input_file -- path to the GeoTIFF to compress
+        compress, predictor, compress_level, tiled, num_threads -- see geotiff_creation_options()
+
+        New files should be written compressed by create_geotiff() instead; this is for files that
+        already exist.
+    """
     temp_out = input_file.replace(".tif", "_compress.tif")
-    subprocess.call(["gdal_translate", "-co", "COMPRESS=LZW", input_file, temp_out])
+    options = geotiff_creation_options(compress or 'LZW', predictor, compress_level, tiled,
+                                       num_threads)
+    output_raster = gdal.Translate(temp_out, input_file, format='GTiff', creationOptions=options)
+    output_raster = None
     if os.path.isfile(temp_out):
         os.remove(input_file)
         os.rename(temp_out, input_file)
 
 
-def create_geotiff(pixels, gps_bounds, out_path, nodata=-99, asfloat=False, extractor_info=None, system_md=None, extra_metadata=None, compress=False):
+def cog_overview_levels(ncols, nrows, block_size=COG_BLOCK_SIZE):
+    """Returns the overview decimation factors of a cloud optimized GeoTIFF.
+
+        Keyword arguments:
+        ncols, nrows -- pixel width and height of the full resolution image
+        block_size -- size of the square tiles
+
+        Factors double until the overview fits in a single tile; images that already fit have none.
+    """
+    levels = []
+    factor = 2
+    while max(ncols, nrows) > block_size * factor // 2:
+        levels.append(factor)
+        factor *= 2
+
+    return levels
+
+
+def cog_creation_options(compress=False, predictor=None, compress_level=None, num_threads=None,
+                         nbits=None, block_size=COG_BLOCK_SIZE):
+    """Returns the GTiff driver creation options for copying a dataset and its overviews into a
+       cloud optimized GeoTIFF.
+
+        Keyword arguments:
+        compress, predictor, compress_level, num_threads, nbits -- see geotiff_creation_options()
+        block_size -- size of the square tiles
+
+        The file is always tiled, and the overviews of the source are written ahead of the full
+        resolution image so that readers can fetch a few tiles of the level they need.
+    """
+    options = [one_option for one_option in
+               geotiff_creation_options(compress, predictor, compress_level, True, num_threads, nbits)
+               if one_option != 'TILED=YES']
+    options.extend(['TILED=YES', 'BLOCKXSIZE=' + str(block_size), 'BLOCKYSIZE=' + str(block_size),
+                    'COPY_SRC_OVERVIEWS=YES'])
+
+    return options
+
+
+def write_cog(source_raster, out_path, compress=False, predictor=None, compress_level=None,
+              num_threads=None, nbits=None, resample='AVERAGE', block_size=COG_BLOCK_SIZE):
+    """Write a dataset as a cloud optimized GeoTIFF with internal tiles and overviews.
+
+        Keyword arguments:
+        source_raster -- open GDAL dataset to write, typically in memory; its overviews are built
+                         in place
+        out_path -- path to GeoTIFF to be created
+        compress, predictor, compress_level, num_threads, nbits -- see geotiff_creation_options()
+        resample -- overview resampling, such as AVERAGE for images or NEAREST to keep mask values intact
+        block_size -- size of the square tiles
+    """
+    levels = cog_overview_levels(source_raster.RasterXSize, source_raster.RasterYSize, block_size)
+    if levels:
+        source_raster.BuildOverviews(resample, levels)
+
+    options = cog_creation_options(compress, predictor, compress_level, num_threads, nbits,
+                                   block_size)
+    output_raster = gdal.GetDriverByName('GTiff').CreateCopy(out_path, source_raster, 0, options)
+    output_raster = None
+
+
+def convert_to_cog(input_file, compress=False, predictor=None, compress_level=None,
+                   num_threads=None, nbits=None, resample='AVERAGE', block_size=COG_BLOCK_SIZE):
+    """Convert an existing GeoTIFF file into a cloud optimized GeoTIFF in place.
+
+        Keyword arguments:
+        input_file -- path to the GeoTIFF to convert
+        compress, predictor, compress_level, num_threads, nbits, resample, block_size -- see write_cog()
+
+        The overviews are built into the existing file before it's copied, so nothing but the
+        converted file is left behind. Files small enough to be written in memory should be written
+        with create_geotiff(..., cog=True) instead, which writes them once.
+    """
+    temp_out = input_file.replace(".tif", "_cog.tif")
+    source_raster = gdal.Open(input_file, gdal.GA_Update)
+    write_cog(source_raster, temp_out, compress, predictor, compress_level, num_threads, nbits,
+              resample, block_size)
+    source_raster = None
+    if os.path.isfile(temp_out):
+        os.remove(input_file)
+        os.rename(temp_out, input_file)
+
+
+def create_geotiff(pixels, gps_bounds, out_path, nodata=-99, asfloat=False, extractor_info=None, system_md=None, extra_metadata=None, compress=False,
+                   predictor=None, compress_level=None, tiled=False, num_threads=None, nbits=None, cog=False,
+                   overview_resample='AVERAGE'):
     """Generate output GeoTIFF file given a numpy pixel array and GPS boundary.
 
         Keyword arguments:
@@ -35,6 +182,10 @@ def create_geotiff(pixels, gps_bounds, out_path, nodata=-99, asfloat=False, extr
         extractor_info -- details about extractor if applicable
         system_md -- cleaned TERRA-REF metadata
         extra_metadata -- any metadata to be embedded in geotiff; supersedes extractor_info and system_md
+        compress -- codec name (LZW, DEFLATE or ZSTD), True for LZW, or False for no compression
+        predictor, compress_level, tiled, num_threads, nbits -- see geotiff_creation_options()
+        cog -- write a cloud optimized GeoTIFF with internal tiles and overviews; tiled is ignored
+        overview_resample -- resampling of the cloud optimized GeoTIFF overviews, see write_cog()
     """
     dimensions = numpy.shape(pixels)
     if len(dimensions) == 2:
@@ -43,6 +194,62 @@ def create_geotiff(pixels, gps_bounds, out_path, nodata=-99, asfloat=False, extr
     else:
         nrows, ncols, channels = dimensions
 
+    # Cloud optimized files are assembled in memory and written, with their overviews, once
+    output_raster = create_geotiff_dataset(nrows, ncols, channels, gps_bounds,
+                                           '' if cog else out_path, nodata, asfloat, extractor_info,
+                                           system_md, extra_metadata, compress, predictor,
+                                           compress_level, tiled, num_threads, nbits,
+                                           'MEM' if cog else 'GTiff')
+
+    if channels > 1:
+        # typically 3 channels = RGB channels
+        # TODO: Something wonky w/ uint8s --> ending up w/ lots of gaps in data (white pixels)
+        for chan in range(channels):
+            band = chan + 1
+            # Bands are written from views, converted only when they aren't bytes already
+            band_pixels = pixels[:,:,chan]
+            if band_pixels.dtype != numpy.uint8:
+                band_pixels = band_pixels.astype('uint8')
+            output_raster.GetRasterBand(band).WriteArray(band_pixels)
+            output_raster.GetRasterBand(band).FlushCache()
+    else:
+        # single channel image, e.g. temperature
+        output_raster.GetRasterBand(1).WriteArray(pixels)
+        output_raster.GetRasterBand(1).FlushCache()
+
+    if cog:
+        write_cog(output_raster, out_path, compress, predictor, compress_level, num_threads,
+                  None if asfloat else nbits, overview_resample)
+
+    output_raster = None
+
+
+def create_geotiff_dataset(nrows, ncols, channels, gps_bounds, out_path, nodata=-99, asfloat=False, extractor_info=None, system_md=None, extra_metadata=None, compress=False,
+                           predictor=None, compress_level=None, tiled=False, num_threads=None, nbits=None,
+                           driver='GTiff'):
+    """Create an empty GeoTIFF file with coordinates, projection and metadata set, ready for
+       its bands to be written.
+
+        Keyword arguments:
+        nrows -- number of rows (pixel height) of the image
+        ncols -- number of columns (pixel width) of the image
+        channels -- number of bands to create; 3 bands are labeled as red, green, blue
+        gps_bounds -- tuple of GeoTIFF coordinates as ( lat (y) min, lat (y) max,
+                                                        long (x) min, long (x) max)
+        out_path -- path to GeoTIFF to be created
+        nodata -- NoDataValue to be assigned to raster bands; set to None to ignore
+        float -- whether to use GDT_Float32 data type instead of GDT_Byte (e.g. for decimal numbers)
+        extractor_info -- details about extractor if applicable
+        system_md -- cleaned TERRA-REF metadata
+        extra_metadata -- any metadata to be embedded in geotiff; supersedes extractor_info and system_md
+        compress -- codec name (LZW, DEFLATE or ZSTD), True for LZW, or False for no compression
+        predictor, compress_level, tiled, num_threads, nbits -- see geotiff_creation_options()
+        driver -- GDAL driver creating the dataset; MEM creates it in memory, without any creation
+                  options, for copying into a file later
+
+        Returns the open GDAL dataset. Windows of bands can be written with WriteArray(array,
+        xoff, yoff); the file is completed when the caller releases the dataset.
+    """
     geotransform = (
         gps_bounds[2], # upper-left x
         (gps_bounds[3] - gps_bounds[2])/float(ncols), # W-E pixel resolution
@@ -58,12 +265,14 @@ def create_geotiff(pixels, gps_bounds, out_path, nodata=-99, asfloat=False, extr
     else:
         dtype = gdal.GDT_Byte
 
-    if compress:
-        output_raster = gdal.GetDriverByName('GTiff') \
-            .Create(out_path, ncols, nrows, channels, dtype, ['COMPRESS=LZW'])
+    # Compressed files are written in a single pass, with blocks compressed as they're flushed
+    if driver == 'GTiff':
+        options = geotiff_creation_options(compress, predictor, compress_level, tiled, num_threads,
+                                           None if asfloat else nbits)
     else:
-        output_raster = gdal.GetDriverByName('GTiff') \
-            .Create(out_path, ncols, nrows, channels, dtype)
+        options = []
+    output_raster = gdal.GetDriverByName(driver) \
+        .Create(out_path, ncols, nrows, channels, dtype, options)
 
     output_raster.SetGeoTransform(geotransform)
     srs = osr.SpatialReference()
@@ -77,41 +286,105 @@ def create_geotiff(pixels, gps_bounds, out_path, nodata=-99, asfloat=False, extr
 
     if channels == 3:
         # typically 3 channels = RGB channels
-        # TODO: Something wonky w/ uint8s --> ending up w/ lots of gaps in data (white pixels)
-        output_raster.GetRasterBand(1).WriteArray(pixels[:,:,0].astype('uint8'))
         output_raster.GetRasterBand(1).SetColorInterpretation(gdal.GCI_RedBand)
-        output_raster.GetRasterBand(1).FlushCache()
-        if nodata:
-            output_raster.GetRasterBand(1).SetNoDataValue(nodata)
-
-        output_raster.GetRasterBand(2).WriteArray(pixels[:,:,1].astype('uint8'))
         output_raster.GetRasterBand(2).SetColorInterpretation(gdal.GCI_GreenBand)
-        output_raster.GetRasterBand(2).FlushCache()
-        if nodata:
-            output_raster.GetRasterBand(2).SetNoDataValue(nodata)
-
-        output_raster.GetRasterBand(3).WriteArray(pixels[:,:,2].astype('uint8'))
         output_raster.GetRasterBand(3).SetColorInterpretation(gdal.GCI_BlueBand)
-        output_raster.GetRasterBand(3).FlushCache()
-        if nodata:
-            output_raster.GetRasterBand(3).SetNoDataValue(nodata)
 
-    elif channels > 1:
-        # TODO: Something wonky w/ uint8s --> ending up w/ lots of gaps in data (white pixels)
+    if nodata:
         for chan in range(channels):
-            band = chan + 1
-            output_raster.GetRasterBand(band).WriteArray(pixels[:,:,chan].astype('uint8'))
-            output_raster.GetRasterBand(band).FlushCache()
-            if nodata:
-                output_raster.GetRasterBand(band).SetNoDataValue(nodata)
+            output_raster.GetRasterBand(chan + 1).SetNoDataValue(nodata)
+
+    return output_raster
+
+
+def create_reprojected_geotiff(pixels, geotransform, projection, out_path, epsg=4326, gps_bounds=None, nrows=None, ncols=None, nodata=None, asfloat=False,
+                               extractor_info=None, system_md=None, extra_metadata=None, compress=False, predictor=None, compress_level=None,
+                               tiled=False, num_threads=None, resample='near', nbits=None, cog=False,
+                               overview_resample='NEAREST'):
+    """Generate output GeoTIFF file in another EPSG space from a numpy pixel array that's georeferenced
+       in its native space. The pixels are warped from memory directly into the output file.
+
+        Keyword arguments:
+        pixels -- numpy array of pixel values; 2 dimensions for a single band, 3 for one band per Z dimension
+        geotransform -- GDAL geotransform of the pixels in their native space
+        projection -- WKT of the native space of the pixels
+        out_path -- path to GeoTIFF to be created
+        epsg -- EPSG code of the output GeoTIFF
+        gps_bounds -- optional tuple of output coordinates as ( lat (y) min, lat (y) max,
+                                                                long (x) min, long (x) max)
+        nrows, ncols -- optional pixel height and width of the output; used together with gps_bounds to
+                        place the output on a known grid
+        nodata -- NoDataValue to be assigned to raster bands; set to None to ignore
+        float -- whether to use GDT_Float32 data type instead of GDT_Byte (e.g. for decimal numbers)
+        extractor_info -- details about extractor if applicable
+        system_md -- cleaned TERRA-REF metadata
+        extra_metadata -- any metadata to be embedded in geotiff; supersedes extractor_info and system_md
+        compress, predictor, compress_level, tiled, num_threads, nbits -- see geotiff_creation_options()
+        resample -- GDAL resampling algorithm; nearest neighbour keeps mask values intact
+        cog -- write a cloud optimized GeoTIFF with internal tiles and overviews; tiled is ignored
+        overview_resample -- resampling of the cloud optimized GeoTIFF overviews, see write_cog()
+    """
+    dimensions = numpy.shape(pixels)
+    if len(dimensions) == 2:
+        rows, cols = dimensions
+        channels = 1
     else:
-        # single channel image, e.g. temperature
-        output_raster.GetRasterBand(1).WriteArray(pixels)
-        output_raster.GetRasterBand(1).FlushCache()
+        rows, cols, channels = dimensions
+
+    if asfloat:
+        dtype = gdal.GDT_Float32
+    else:
+        dtype = gdal.GDT_Byte
+
+    source_raster = gdal.GetDriverByName('MEM').Create('', cols, rows, channels, dtype)
+    source_raster.SetGeoTransform(geotransform)
+    source_raster.SetProjection(projection)
+
+    if not extra_metadata:
+        extra_metadata = prepare_metadata_for_geotiff(extractor_info, system_md)
+
+    source_raster.SetMetadata(extra_metadata)
+
+    for chan in range(channels):
+        band = source_raster.GetRasterBand(chan + 1)
+        band.WriteArray(pixels[:,:,chan] if channels > 1 else pixels)
         if nodata:
-            output_raster.GetRasterBand(1).SetNoDataValue(nodata)
+            band.SetNoDataValue(nodata)
 
+    if channels == 3:
+        # typically 3 channels = RGB channels
+        source_raster.GetRasterBand(1).SetColorInterpretation(gdal.GCI_RedBand)
+        source_raster.GetRasterBand(2).SetColorInterpretation(gdal.GCI_GreenBand)
+        source_raster.GetRasterBand(3).SetColorInterpretation(gdal.GCI_BlueBand)
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    warp_options = {
+        'format': 'GTiff',
+        'dstSRS': srs.ExportToWkt(),
+        'resampleAlg': resample,
+        'creationOptions': geotiff_creation_options(compress, predictor, compress_level, tiled,
+                                                    num_threads, None if asfloat else nbits),
+        'multithread': True,
+        'warpOptions': ['NUM_THREADS=' + str(num_threads or 1)]
+    }
+    if gps_bounds:
+        warp_options['outputBounds'] = (gps_bounds[2], gps_bounds[0], gps_bounds[3], gps_bounds[1])
+    if nrows and ncols:
+        warp_options['width'] = ncols
+        warp_options['height'] = nrows
+
+    if cog:
+        # Warped into memory so the overviews can be added before the file is written once
+        warp_options['format'] = 'MEM'
+        del warp_options['creationOptions']
+        output_raster = gdal.Warp('', source_raster, **warp_options)
+        write_cog(output_raster, out_path, compress, predictor, compress_level, num_threads,
+                  None if asfloat else nbits, overview_resample)
+    else:
+        output_raster = gdal.Warp(out_path, source_raster, **warp_options)
     output_raster = None
+    source_raster = None
 
 
 def prepare_metadata_for_geotiff(extractor_info=None, terra_md=None):
@@ -5,7 +5,7 @@ This module provides simple wrappers around the clowder Geostreams API
 
 import json
 import logging
-import requests
+from terrautils import httpclient
 
 from terrautils.betydb import get_sites_by_latlon
 from terrautils.spatial import wkt_to_geojson
@@ -40,9 +40,9 @@ def create_sensor(connector, host, key, sensorname, geom, type, region):
 
     url = "%sapi/geostreams/sensors?key=%s" % (host, key)
 
-    result = requests.post(url, headers={'Content-type': 'application/json'},
-                           data=json.dumps(body),
-                           verify=connector.ssl_verify if connector else True)
+    result = httpclient.post(url, headers={'Content-type': 'application/json'},
+                             data=json.dumps(body),
+                             verify=connector.ssl_verify if connector else True)
     result.raise_for_status()
 
     sensorid = result.json()['id']
@@ -76,9 +76,9 @@ def create_stream(connector, host, key, streamname, sensorid, geom, properties={
 
     url = "%sapi/geostreams/streams?key=%s" % (host, key)
 
-    result = requests.post(url, headers={'Content-type': 'application/json'},
-                           data=json.dumps(body),
-                           verify=connector.ssl_verify if connector else True)
+    result = httpclient.post(url, headers={'Content-type': 'application/json'},
+                             data=json.dumps(body),
+                             verify=connector.ssl_verify if connector else True)
     result.raise_for_status()
 
     streamid = result.json()['id']
@@ -114,9 +114,9 @@ def create_datapoint(connector, host, key, streamid, geom, starttime, endtime, p
 
     url = '%sapi/geostreams/datapoints?key=%s' % (host, key)
 
-    result = requests.post(url, headers={'Content-type': 'application/json'},
-                           data=json.dumps(body),
-                           verify=connector.ssl_verify if connector else True)
+    result = httpclient.post(url, headers={'Content-type': 'application/json'},
+                             data=json.dumps(body),
+                             verify=connector.ssl_verify if connector else True)
     result.raise_for_status()
 
     dpid = result.json()['id']
@@ -143,9 +143,9 @@ def create_datapoints(connector, host, key, streamid, datapoint_list):
 
     url = '%sapi/geostreams/datapoints/bulk?key=%s' % (host, key)
 
-    result = requests.post(url, headers={'Content-type': 'application/json'},
-                           data=json.dumps(body),
-                           verify=connector.ssl_verify if connector else True)
+    result = httpclient.post(url, headers={'Content-type': 'application/json'},
+                             data=json.dumps(body),
+                             verify=connector.ssl_verify if connector else True)
     result.raise_for_status()
 
 
@@ -226,8 +226,8 @@ def get_sensor_by_name(connector, host, key, sensorname):
 
     url = "%sapi/geostreams/sensors?sensor_name=%s&key=%s" % (host, sensorname, key)
 
-    result = requests.get(url,
-                          verify=connector.ssl_verify if connector else True)
+    result = httpclient.get(url,
+                            verify=connector.ssl_verify if connector else True)
     result.raise_for_status()
 
     for sens in result.json():
@@ -254,8 +254,8 @@ def get_sensors_by_circle(connector, host, key, lon, lat, radius=0):
 
     url = "%sapi/geostreams/sensors?geocode=%s,%s,%s&key=%s" % (host, lat, lon, radius, key)
 
-    result = requests.get(url,
-                          verify=connector.ssl_verify if connector else True)
+    result = httpclient.get(url,
+                            verify=connector.ssl_verify if connector else True)
     result.raise_for_status()
 
     # Return first sensor
@@ -281,8 +281,8 @@ def get_sensors_by_polygon(connector, host, key, coord_list):
     coord_strings = [str(i) for i in coord_list]
     url = "%sapi/geostreams/sensors?geocode=%s&key=%s" % (host, ','.join(coord_strings), key)
 
-    result = requests.get(url,
-                          verify=connector.ssl_verify if connector else True)
+    result = httpclient.get(url,
+                            verify=connector.ssl_verify if connector else True)
     result.raise_for_status()
 
     # Return first sensor
@@ -307,8 +307,8 @@ def get_stream_by_name(connector, host, key, streamname):
 
     url = "%sapi/geostreams/streams?stream_name=%s&key=%s" % (host, streamname, key)
 
-    result = requests.get(url,
-                          verify=connector.ssl_verify if connector else True)
+    result = httpclient.get(url,
+                            verify=connector.ssl_verify if connector else True)
     result.raise_for_status()
 
     for strm in result.json():
@@ -335,8 +335,8 @@ def get_streams_by_circle(connector, host, key, lon, lat, radius=0):
 
     url = "%sapi/geostreams/stream?geocode=%s,%s,%s&key=%s" % (host, lat, lon, radius, key)
 
-    result = requests.get(url,
-                          verify=connector.ssl_verify if connector else True)
+    result = httpclient.get(url,
+                            verify=connector.ssl_verify if connector else True)
     result.raise_for_status()
 
     jbody = result.json()
@@ -361,8 +361,8 @@ def get_streams_by_polygon(connector, host, key, coord_list):
     coord_strings = [str(i) for i in coord_list]
     url = "%sapi/geostreams/stream?geocode=%s&key=%s" % (host, ','.join(coord_strings), key)
 
-    result = requests.get(url,
-                          verify=connector.ssl_verify if connector else True)
+    result = httpclient.get(url,
+                            verify=connector.ssl_verify if connector else True)
     result.raise_for_status()
 
     jbody = result.json()
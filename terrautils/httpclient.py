@@ -0,0 +1,269 @@
+"""HTTP client
+
+This module provides the HTTP calls of the terrautils helpers. The calls share one session
+per process, which keeps connections to each host open between calls, applies default
+timeouts, and retries on connection failures and server errors. It counts the requests and
+bytes sent and received so that extractors can report them for each message. Files are
+uploaded as streamed multipart bodies, so an upload holds only one chunk of the file in memory.
+"""
+
+import os
+import time
+import logging
+import threading
+import mimetypes
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.filepost import choose_boundary
+
+# Seconds to wait for a connection, and between bytes of a response
+CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 10))
+READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 300))
+
+# Retries after a failed attempt; the wait doubles from the backoff factor between attempts
+MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 3))
+BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', 0.5))
+RETRY_STATUS_CODES = [500, 502, 503, 504]
+
+# Number of hosts to keep connections to, and connections kept to each host
+POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', 10))
+POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+
+# Largest piece of a file read into memory at a time by an upload, and seconds between the
+# progress messages of an upload
+UPLOAD_CHUNK_SIZE = int(os.getenv('HTTP_UPLOAD_CHUNK_KB', 1024)) * 1024
+UPLOAD_PROGRESS_SECONDS = float(os.getenv('HTTP_UPLOAD_PROGRESS_SECONDS', 30))
+
+# The session of this process, and the process that created it
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+
+# Requests made and bytes transferred since the counters were reset
+_counters = {'requests': 0, 'bytes_sent': 0, 'bytes_received': 0}
+
+
+def get_session():
+    """Returns the session shared by the calls of this process, creating it as needed
+
+    Connections don't survive a fork, so a session created by another process isn't reused.
+    """
+    global _session, _session_pid
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            # Requests whose response may not have been acted on, such as POSTs, are only
+            # retried when the connection couldn't be made
+            retries = Retry(total=MAX_RETRIES, connect=MAX_RETRIES, read=MAX_RETRIES,
+                            status=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR,
+                            status_forcelist=RETRY_STATUS_CODES, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE,
+                                  max_retries=retries)
+
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.hooks['response'].append(_count_response)
+
+            _session = session
+            _session_pid = os.getpid()
+
+        return _session
+
+
+def _count_response(response, *args, **kwargs):
+    """Response hook adding a request and its bytes to the counters
+    """
+    body = response.request.body
+    if isinstance(body, (bytes, str)):
+        sent = len(body)
+    else:
+        # Streamed bodies, such as a MultipartFileEncoder, declare their length
+        sent = getattr(body, 'len', 0)
+
+    # Streamed responses aren't read here, so they're counted by their declared length
+    if kwargs.get('stream'):
+        received = int(response.headers.get('Content-Length', 0))
+    else:
+        received = len(response.content or b'')
+
+    with _lock:
+        _counters['requests'] += 1
+        _counters['bytes_sent'] += sent
+        _counters['bytes_received'] += received
+
+
+def reset_counters():
+    """Sets the request and byte counters back to 0
+    """
+    with _lock:
+        for key in _counters:
+            _counters[key] = 0
+
+
+def get_counters():
+    """Returns a copy of the counters: 'requests', 'bytes_sent' and 'bytes_received'
+    """
+    with _lock:
+        return dict(_counters)
+
+
+def request(method, url, **kwargs):
+    """Makes a request with the shared session; the arguments are those of requests.request()
+
+    The default timeouts are used when no timeout is given.
+    """
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, params=None, **kwargs):
+    """Sends a GET request, see requests.get()
+    """
+    return request('get', url, params=params, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs):
+    """Sends a POST request, see requests.post()
+    """
+    return request('post', url, data=data, json=json, **kwargs)
+
+
+def put(url, data=None, **kwargs):
+    """Sends a PUT request, see requests.put()
+    """
+    return request('put', url, data=data, **kwargs)
+
+
+def delete(url, **kwargs):
+    """Sends a DELETE request, see requests.delete()
+    """
+    return request('delete', url, **kwargs)
+
+
+class MultipartFileEncoder(object):
+    """A multipart/form-data body holding one file, read from disk in chunks as it's sent.
+
+    Pass it as the data of a request along with its content_type, and use it as a context
+    manager so that the file is closed once the request is done:
+
+        with MultipartFileEncoder('File', path) as body:
+            post(url, data=body, headers={'Content-Type': body.content_type})
+
+    The length is known up front, so the body is sent with a Content-Length instead of being
+    chunk encoded. A body can be rewound with seek(), which lets a failed connection be retried.
+    """
+
+    def __init__(self, field_name, filepath, chunk_size=None, progress=None):
+        """Opens the file and lays out the body.
+
+        Keyword arguments:
+        field_name -- the name of the form field holding the file
+        filepath -- path to the file
+        chunk_size -- the most bytes held in memory by one read, defaults to UPLOAD_CHUNK_SIZE
+        progress -- optional function called with the bytes sent and the total after each read
+        """
+        self.filepath = filepath
+        self.chunk_size = max(int(chunk_size or UPLOAD_CHUNK_SIZE), 1)
+        self.progress = progress
+
+        boundary = choose_boundary()
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+        file_name = os.path.basename(filepath).replace('\\', '\\\\').replace('"', '%22')
+        file_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+        self.head = ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                     'Content-Type: %s\r\n\r\n' % (boundary, field_name, file_name,
+                                                   file_type)).encode('utf-8')
+        self.tail = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+
+        self.file = open(filepath, 'rb')
+        self.file_size = os.fstat(self.file.fileno()).st_size
+        self.len = len(self.head) + self.file_size + len(self.tail)
+        self.position = 0
+
+        self.clock = getattr(time, 'monotonic', time.time)
+        self.started = None
+        self.last_report = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.len
+
+    def close(self):
+        """Closes the file; the body can't be read afterwards
+        """
+        self.file.close()
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Moves to a position in the body, such as back to 0 to send it again
+        """
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.len
+        self.position = max(min(offset, self.len), 0)
+
+        file_offset = max(min(self.position - len(self.head), self.file_size), 0)
+        self.file.seek(file_offset)
+        return self.position
+
+    def read(self, size=-1):
+        """Returns the next bytes of the body, at most chunk_size of them at a time
+        """
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        if self.started is None:
+            self.started = self.last_report = self.clock()
+
+        pieces = []
+        while size > 0 and self.position < self.len:
+            file_start = len(self.head)
+            file_end = file_start + self.file_size
+            if self.position < file_start:
+                piece = self.head[self.position:self.position + size]
+            elif self.position < file_end:
+                piece = self.file.read(min(size, file_end - self.position))
+                if not piece:
+                    raise IOError("%s is shorter than when its upload started" % self.filepath)
+            else:
+                piece = self.tail[self.position - file_end:self.position - file_end + size]
+            pieces.append(piece)
+            self.position += len(piece)
+            size -= len(piece)
+
+        self.report_progress()
+        return b''.join(pieces)
+
+    def elapsed(self):
+        """Returns the seconds since the body started being read
+        """
+        return self.clock() - self.started if self.started is not None else 0.0
+
+    def throughput(self):
+        """Returns the bytes per second sent so far
+        """
+        elapsed = self.elapsed()
+        return self.position / elapsed if elapsed > 0 else 0.0
+
+    def report_progress(self):
+        """Calls the progress function, and logs the progress every UPLOAD_PROGRESS_SECONDS
+        """
+        if self.progress:
+            self.progress(self.position, self.len)
+
+        now = self.clock()
+        if now - self.last_report >= UPLOAD_PROGRESS_SECONDS:
+            self.last_report = now
+            logging.getLogger(__name__).info("Uploading %s: %d of %d bytes (%.0f%%), %.1f MB/s",
+                                             os.path.basename(self.filepath), self.position,
+                                             self.len, 100.0 * self.position / self.len,
+                                             self.throughput() / 1000000)
@@ -117,11 +117,21 @@ def image_get_geobounds(filename):
         The values are returned in following order: min_y, max_y, min_x, max_x. A list of numpy.nan
         is returned if the boundaries can't be determined
     """
+    return dataset_get_geobounds(gdal.Open(filename))
+
+def dataset_get_geobounds(src):
+    """Retrieves the recilinear boundaries of an open gdal dataset, such as an in-memory image
+
+    Args:
+        src(gdal.Dataset): the dataset to get the boundaries from
+
+    Returns:
+        The boundaries in the same form as image_get_geobounds()
+    """
     logger = logging.getLogger(__name__)
 
     try:
         # TODO: handle non-ortho images
-        src = gdal.Open(filename)
         ulx, xres, _, uly, _, yres = src.GetGeoTransform()
         lrx = ulx + (src.RasterXSize * xres)
         lry = uly + (src.RasterYSize * yres)
@@ -134,7 +144,7 @@ def image_get_geobounds(filename):
         return [min_y, max_y, min_x, max_x]
     # pylint: disable=broad-except
     except Exception as ex:
-        logger.info("[image_get_geobounds] Exception caught: %s", str(ex))
+        logger.info("[dataset_get_geobounds] Exception caught: %s", str(ex))
     # pylint: enable=broad-except
 
     return [nan, nan, nan, nan]
@@ -38,30 +38,61 @@ class Influx():
         self.pass_ = pass_
 
 
-    def log(self, extractorname, starttime, endtime, filecount, bytecount):
-
+    def log(self, extractorname, starttime, endtime, filecount, bytecount, duration_ns=None,
+            stages=None, cpu_ns=None, peak_rss=None, peak_rss_growth=None, http=None):
+        """Writes the measurements of a processed message to InfluxDB in one request.
+
+        Keyword arguments:
+        extractorname -- the name of the extractor, used as the 'extractor' tag
+        starttime -- when processing started, as a date string
+        endtime -- when processing ended, as a date string
+        filecount -- the number of files created
+        bytecount -- the number of bytes created
+        duration_ns -- the precise processing time in nanoseconds; without it the duration is
+                       calculated from the start and end times, to the second
+        stages -- dictionary of the nanoseconds spent in each stage, tagged with 'stage'
+        cpu_ns -- the CPU time used, in nanoseconds
+        peak_rss -- the peak resident memory while processing the message, in bytes
+        peak_rss_growth -- how much the peak resident memory of the process grew while processing
+                           the message, in bytes; for systems where the peak can't be reset
+        http -- dictionary of HTTP counts, such as 'requests' and 'bytes_sent', each written
+                with the type 'http_' followed by its key
+        """
         f_completed_ts = int(parse(endtime).strftime('%s'))*1000000000
-        f_duration = f_completed_ts - int(parse(starttime).strftime('%s'))*1000000000
+        if duration_ns is None:
+            f_duration = f_completed_ts - int(parse(starttime).strftime('%s'))*1000000000
+        else:
+            f_duration = int(duration_ns)
 
         if self.pass_:
             client = InfluxDBClient(self.host, self.port, self.user,
                                     self.pass_, self.db)
 
-            client.write_points([{
-                "measurement": "file_processed",
-                "time": f_completed_ts,
-                "fields": {"value": f_duration}
-            }], tags={"extractor": extractorname, "type": "duration"})
-            client.write_points([{
-                "measurement": "file_processed",
-                "time": f_completed_ts,
-                "fields": {"value": int(filecount)}
-            }], tags={"extractor": extractorname, "type": "filecount"})
-            client.write_points([{
-                "measurement": "file_processed",
-                "time": f_completed_ts,
-                "fields": {"value": int(bytecount)}
-            }], tags={"extractor": extractorname, "type": "bytes"})
+            def point(value, tags):
+                return {
+                    "measurement": "file_processed",
+                    "time": f_completed_ts,
+                    "tags": tags,
+                    "fields": {"value": int(value)}
+                }
+
+            points = [point(f_duration, {"type": "duration"}),
+                      point(filecount, {"type": "filecount"}),
+                      point(bytecount, {"type": "bytes"})]
+            if cpu_ns is not None:
+                points.append(point(cpu_ns, {"type": "cpu_time"}))
+            if peak_rss is not None:
+                points.append(point(peak_rss, {"type": "peak_rss"}))
+            if peak_rss_growth is not None:
+                points.append(point(peak_rss_growth, {"type": "peak_rss_growth"}))
+            if http:
+                for name in sorted(http):
+                    points.append(point(http[name], {"type": "http_" + name}))
+            if stages:
+                for name in sorted(stages):
+                    points.append(point(stages[name], {"type": "stage", "stage": name}))
+
+            client.write_points(points, tags={"extractor": extractorname})
 
 
     def error(self):
@@ -1,7 +1,7 @@
 
 # https://github.com/terraref/tutorials/blob/geostreams-guide/sensors/06-list-datasets-by-plot.md
 import os
-import requests
+from terrautils import httpclient
 
 import logging
 log = logging.getLogger(__name__)
@@ -25,7 +25,7 @@ def get_sensor_list(connection, host, key):
     """
 
     url = "%sapi/geostreams/streams?key=%s" % (host, key)
-    r = requests.get(url)
+    r = httpclient.get(url)
     r.raise_for_status()
     return r.json()
 
@@ -62,7 +62,7 @@ def get_datapoints(connection, host, key, sensor_id, **params):
     params['stream_id'] = sensor
 
     url = "%sapi/geostreams/datapoints" % host
-    r = requests.get(url, params=params)
+    r = httpclient.get(url, params=params)
     r.raise_for_status()
     return r.json()
 
@@ -97,7 +97,7 @@ def get_sensor(connection, host, key, sensor, sitename=''):
     
     url = '%sapi/geostreams/streams' % host
     params = { 'key': key, 'stream_name': sensor }
-    r = requests.get(url, params=params)
+    r = httpclient.get(url, params=params)
     r.raise_for_status()
     return r.json()
 
@@ -124,7 +124,7 @@ def get_files(connection, host, key, dataset):
 
     url = '%sapi/datasets/%s/files' % (host, dataset_id)
     log.debug('new url = %s', url)
-    r = requests.get(url, params={'key': key})
+    r = httpclient.get(url, params={'key': key})
     r.raise_for_status()
     return r.json()
 
@@ -170,7 +170,7 @@ def get_file_listing(connection, host, key, sensor, sitename,
         if until:
             params['until'] = until
 
-        r = requests.get(url, params=params)
+        r = httpclient.get(url, params=params)
         r.raise_for_status()
 
         if len(r.json()) > 0:
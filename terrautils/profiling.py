@@ -0,0 +1,157 @@
+"""Profiling
+
+This module profiles a sample of the messages an extractor processes. Each profiled message
+leaves a compressed cProfile dump and a summary of its hottest functions in a local folder,
+which is kept under a size limit by removing the oldest profiles. Only files with the
+profile extensions are ever removed, so the folder can be shared.
+
+Only the thread handling the message is profiled; the uploads that run in the background
+upload thread aren't included.
+"""
+
+import os
+import io
+import re
+import gzip
+import time
+import random
+import marshal
+import logging
+import pstats
+import tempfile
+import cProfile
+
+# File name endings of the compressed dumps and of the summaries
+DUMP_EXTENSION = '.prof.gz'
+SUMMARY_EXTENSION = '.prof.txt'
+
+
+def add_arguments(parser):
+
+    parser.add_argument('--profile-rate', dest="profile_rate", type=float,
+                        default=float(os.getenv("PROFILE_RATE", 0.0)),
+                        help="fraction of messages to profile, from 0 (off) to 1 (all)")
+    parser.add_argument('--profile-dir', dest="profile_dir", type=str,
+                        default=os.getenv("PROFILE_DIR",
+                                          os.path.join(tempfile.gettempdir(), "profiles")),
+                        help="folder to write the profiles of messages to")
+    parser.add_argument('--profile-max-mb', dest="profile_max_mb", type=int,
+                        default=int(os.getenv("PROFILE_MAX_MB", 100)),
+                        help="size limit of the profile folder in MB; the oldest profiles are " \
+                             "removed first (default=100)")
+    parser.add_argument('--profile-top', dest="profile_top", type=int,
+                        default=int(os.getenv("PROFILE_TOP", 30)),
+                        help="number of functions listed in the summary of a profile " \
+                             "(default=30)")
+
+
+class MessageProfiler():
+    """Profiles a random sample of messages with cProfile.
+
+    Only the thread handling the message is profiled; work done in other processes, such as a
+    pool of workers, shows up as the time spent waiting for them.
+    """
+
+    def __init__(self, directory, rate, max_mb, top):
+
+        self.directory = directory
+        self.rate = max(min(rate, 1.0), 0.0)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.top = top
+        self.profile = None
+        self.name = None
+
+
+    def start(self, name):
+        """Starts profiling a message, if it's picked for the sample.
+
+        Keyword arguments:
+        name -- identifies the message in the profile's file names
+        """
+        if self.profile is not None:
+            # The previous message ended without stop(), such as by an exception
+            self.profile.disable()
+            self.profile = None
+        if self.rate <= 0.0 or random.random() >= self.rate:
+            return
+
+        self.name = re.sub(r'[^A-Za-z0-9_.-]+', '_', name)[:100]
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+
+    def stop(self):
+        """Stops profiling the current message and saves its profile.
+
+        Returns the path of the summary, or None if the message wasn't profiled. A profile that
+        can't be saved is logged and dropped.
+        """
+        if self.profile is None:
+            return None
+
+        profile, self.profile = self.profile, None
+        profile.disable()
+        try:
+            return self.save(profile)
+        except (IOError, OSError) as ex:
+            logging.getLogger(__name__).warning("Unable to save profile of %s: %s",
+                                                self.name, str(ex))
+            return None
+
+
+    def save(self, profile):
+        """Writes the compressed dump and the summary of a profile and enforces the size limit.
+
+        The dump holds the same data as pstats.Stats.dump_stats(); gunzip it to load it with
+        pstats or a profile viewer.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        base_name = os.path.join(self.directory, "%s_%s" % (
+            time.strftime('%Y%m%dT%H%M%S'), self.name))
+
+        summary = io.StringIO()
+        stats = pstats.Stats(profile, stream=summary)
+        stats.sort_stats('cumulative').print_stats(self.top)
+
+        with gzip.open(base_name + DUMP_EXTENSION, 'wb') as out_file:
+            out_file.write(marshal.dumps(stats.stats))
+        with open(base_name + SUMMARY_EXTENSION, 'w') as out_file:
+            out_file.write(summary.getvalue())
+
+        self.rotate([base_name + DUMP_EXTENSION, base_name + SUMMARY_EXTENSION])
+        logging.getLogger(__name__).info("Wrote profile of %s to %s", self.name,
+                                         base_name + SUMMARY_EXTENSION)
+        return base_name + SUMMARY_EXTENSION
+
+
+    def rotate(self, keep):
+        """Removes the oldest profiles until the folder is within its size limit.
+
+        Keyword arguments:
+        keep -- the paths of the newest profile, which are never removed
+        """
+        entries = []
+        total_bytes = 0
+        for one_file in os.listdir(self.directory):
+            if not one_file.endswith(DUMP_EXTENSION) and not one_file.endswith(SUMMARY_EXTENSION):
+                continue
+            path = os.path.join(self.directory, one_file)
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                continue
+            total_bytes += file_stat.st_size
+            if path not in keep:
+                entries.append((file_stat.st_mtime, file_stat.st_size, path))
+
+        entries.sort()
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
@@ -4,7 +4,7 @@ This module provides access to user information
 """
 
 import logging
-import requests
+from terrautils import httpclient
 
 logging.basicConfig(format='%(asctime)s %(message)s')
 
@@ -33,7 +33,7 @@ def get_dataset_username(host, key, dataset_id):
 
     # Get the dataset information
     url = "%sapi/datasets/%s?key=%s" % (host, dataset_id, key)
-    result = requests.get(url)
+    result = httpclient.get(url)
     result.raise_for_status()
 
     # Get the author ID of the dataset
@@ -44,7 +44,7 @@ def get_dataset_username(host, key, dataset_id):
     # Lookup the user information
     if not user_id is None:
         url = "%sapi/users/%s?key=%s" % (host, user_id, key)
-        result = requests.get(url)
+        result = httpclient.get(url)
         result.raise_for_status()
 
         ret = result.json()
@@ -82,7 +82,7 @@ def find_user_name(host, secret_key, clowder_user, dataset_id=None):
         id_uris.append("%sapi/datasets/%s?key=%s" % (host, dataset_id, secret_key))
     for url in id_uris:
         try:
-            result = requests.get(url)
+            result = httpclient.get(url)
             result.raise_for_status()
 
             # Get the author ID of the dataset
@@ -99,7 +99,7 @@ def find_user_name(host, secret_key, clowder_user, dataset_id=None):
     # Now look through all the places to look
     for url in uris:
         try:
-            result = requests.get(url)
+            result = httpclient.get(url)
             result.raise_for_status()
 
             ret = result.json()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+
+"""Benchmarks the mask generation on images
+
+Synthetic field images of several sizes are generated and each stage of the mask pipeline is
+timed on them. The peak memory of each stage is measured in a separate process. Results can be
+written as JSON and compared against a stored baseline, in which case the exit code is non-zero
+when a stage has become slower, or uses more memory, than the tolerance allows.
+
+The extractor's dependencies need to be installed, as they are in the extractor's container.
+
+Example:
+    ./benchmark_rgbmask.py --output results.json --baseline baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+import multiprocessing
+
+import numpy as np
+import cv2
+from osgeo import gdal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+import terra_rgbmask as rgbmask
+import image_quality
+import mask_engines
+from terrautils.formats import create_geotiff
+
+# Image sizes that are benchmarked by default; the largest is a full stereoTop image
+DEFAULT_SIZES = ['820x618', '1648x1236', '3296x2472']
+
+# Kinds of synthetic images
+IMAGE_KINDS = ['canopy', 'soil', 'saturated']
+
+# Stages of the pipeline that are benchmarked, in pipeline order
+STAGES = ['image_quality', 'MAC', 'gen_plant_mask', 'gen_mask', 'gen_saturated_mask',
+          'over_saturation_pocess', 'create_geotiff']
+
+# Each mask engine is benchmarked as its own stage, named with this prefix
+ENGINE_STAGE_PREFIX = 'engine:'
+STAGES += [ENGINE_STAGE_PREFIX + one_engine for one_engine in sorted(mask_engines.MASK_ENGINES)]
+
+# Allowed change from the baseline before a result is reported as a regression
+DEFAULT_TOLERANCE = 0.25
+
+# Boundaries of the GeoTIFFs written by the create_geotiff stage
+BENCHMARK_BOUNDS = (33.0745, 33.0750, -111.9750, -111.9745)
+
+
+def reference_mask(img, kernelSize=3):
+    """The mask chain as it was before MaskMorphology, relabeling at each step
+    """
+    binMask = rgbmask.gen_plant_mask(img, kernelSize)
+    binMask = rgbmask.remove_small_area_mask(binMask, rgbmask.SMALL_AREA_THRESHOLD)
+    binMask = rgbmask.remove_small_holes_mask(binMask, rgbmask.SMALL_HOLE_THRESHOLD)
+    return binMask
+
+
+def time_call(func, repeat, *args):
+    """Returns the best time of calling the function, and the value of the last call
+    """
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, result)
+
+
+def parse_size(size):
+    """Returns the width and height of a size written as WIDTHxHEIGHT
+    """
+    width, height = size.lower().split('x')
+    return (int(width), int(height))
+
+
+def smooth_noise(rng, height, width, blur):
+    """Returns smoothly varying noise in the range of 0 to 1
+    """
+    noise = rng.random_sample((height, width)).astype(np.float32)
+    noise = cv2.GaussianBlur(noise, (0, 0), blur)
+    noise -= noise.min()
+    peak = noise.max()
+    if peak > 0:
+        noise /= peak
+    return noise
+
+
+def synthetic_image(width, height, kind, seed=0):
+    """Generates a BGR field image of plants on soil
+    Args:
+        width(int): the width of the image
+        height(int): the height of the image
+        kind(str): 'canopy' for leaves covering a large part of the soil, 'soil' for sparse
+                   seedlings, or 'saturated' for canopy with large sunlit areas
+        seed(int): the random seed; the same arguments always generate the same image
+    Return:
+        The uint8 image as a rows x columns x channels array
+    Notes:
+        The images pass the quality checks of image_quality.is_low_quality(), and more than
+        rgbmask.SATURATED_IMAGE_RATE of a 'saturated' image is saturated
+    """
+    rng = np.random.RandomState(seed)
+
+    # Leaves and sunlit patches have a fixed size in pixels, as they do with one camera
+    blur = 6.0
+
+    # Brownish soil with some texture
+    texture = smooth_noise(rng, height, width, 1.0)
+    img = np.empty((height, width, 3), dtype=np.float32)
+    img[:, :, 0] = 55 + 25 * texture
+    img[:, :, 1] = 75 + 30 * texture
+    img[:, :, 2] = 100 + 35 * texture
+
+    # Leaves are where the smoothed noise is high; green is brighter than red on leaves
+    cover = 0.08 if kind == 'soil' else 0.45
+    leaves = smooth_noise(rng, height, width, blur)
+    leaves = leaves > np.percentile(leaves, 100.0 * (1.0 - cover))
+    shade = smooth_noise(rng, height, width, blur / 2.0)
+    img[leaves, 0] = 50 + 30 * shade[leaves]
+    img[leaves, 1] = 150 + 60 * shade[leaves]
+    img[leaves, 2] = 80 + 30 * shade[leaves]
+
+    if kind == 'saturated':
+        # Sunlit patches that are bright on both soil and leaves
+        sun = smooth_noise(rng, height, width, blur * 2.0)
+        sun = sun > np.percentile(sun, 75.0)
+        img[sun] = 250 + 5 * shade[sun, np.newaxis]
+
+    img += rng.normal(0, 6, img.shape).astype(np.float32)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def run_stage(stage, img, out_dir):
+    """Runs one stage of the pipeline on an image
+    """
+    if stage == 'image_quality':
+        return image_quality.image_quality(img)
+    if stage == 'MAC':
+        return rgbmask.MAC(img.copy(), img.copy(), img)
+    if stage == 'gen_plant_mask':
+        return rgbmask.gen_plant_mask(img, 3)
+    if stage == 'gen_mask':
+        return rgbmask.gen_mask(img, 3)
+    if stage == 'gen_saturated_mask':
+        return rgbmask.gen_saturated_mask(img, 3)
+    if stage == 'over_saturation_pocess':
+        return rgbmask.over_saturation_pocess(img, rgbmask.gen_plant_mask(img, 3))
+    if stage == 'create_geotiff':
+        mask_rgb = rgbmask.gen_rgb_mask(img, rgbmask.gen_plant_mask(img, 3))
+        out_path = os.path.join(out_dir, 'benchmark_mask.tif')
+        create_geotiff(cv2.cvtColor(mask_rgb, cv2.COLOR_BGR2RGB), BENCHMARK_BOUNDS, out_path,
+                       None, False, None, None, None, rgbmask.DEFAULT_MASK_COMPRESSION,
+                       rgbmask.DEFAULT_MASK_PREDICTOR, None, rgbmask.MASK_GEOTIFF_TILED,
+                       rgbmask.MASK_GEOTIFF_THREADS)
+        os.remove(out_path)
+        return None
+    if stage.startswith(ENGINE_STAGE_PREFIX):
+        return rgbmask.gen_plant_mask_fused(img, 3, stage[len(ENGINE_STAGE_PREFIX):])
+    raise ValueError("Unknown stage: %s" % stage)
+
+
+def read_status_kb(field):
+    """Returns a memory field of /proc/self/status, such as VmRSS or VmHWM, in kilobytes
+    """
+    with open('/proc/self/status', 'r') as in_file:
+        for line in in_file:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+def reset_peak_rss():
+    """Resets the peak resident set size of this process to its current size
+    Return:
+        True if the peak was reset, and False if the system doesn't allow it
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as out_file:
+            out_file.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def measure_memory(stage, width, height, kind, out_dir):
+    """Measures the peak memory of a stage; called in a separate process
+    Return:
+        A tuple of the peak traced Python and numpy allocations, and the growth of the peak
+        resident set size, in megabytes
+    Notes:
+        Generating the image uses more memory than most stages, so the peak resident set size is
+        reset before the stage runs. Where that isn't allowed the growth beyond the peak of
+        generating the image is all that's measured
+    """
+    img = synthetic_image(width, height, kind)
+    if reset_peak_rss():
+        rss_before = read_status_kb('VmRSS')
+        peak_field = 'VmHWM'
+    else:
+        # ru_maxrss is in kilobytes on Linux
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_field = None
+
+    tracemalloc.start()
+    run_stage(stage, img, out_dir)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    if peak_field:
+        rss_after = read_status_kb(peak_field)
+    else:
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (traced_peak / (1024.0 * 1024.0), (rss_after - rss_before) / 1024.0)
+
+
+def benchmark_stages(sizes, kinds, repeat, measure):
+    """Times each stage on each synthetic image
+    Args:
+        sizes(list): image sizes as WIDTHxHEIGHT strings
+        kinds(list): the kinds of synthetic images to generate
+        repeat(int): the number of times each stage is timed; the best time is kept
+        measure(bool): whether to measure the peak memory of each stage
+    Return:
+        A dictionary of results keyed by stage/kind/size
+    """
+    results = {}
+    out_dir = tempfile.mkdtemp(prefix='benchmark_rgbmask_')
+    try:
+        for size in sizes:
+            width, height = parse_size(size)
+            megapixels = width * height / 1000000.0
+            for kind in kinds:
+                img = synthetic_image(width, height, kind)
+                for stage in STAGES:
+                    seconds, _ = time_call(run_stage, repeat, stage, img, out_dir)
+                    key = '%s/%s/%s' % (stage, kind, size)
+                    results[key] = {'seconds': seconds,
+                                    'megapixels_per_second': megapixels / max(seconds, 1e-9)}
+
+                    if measure:
+                        # A fresh interpreter for each measurement keeps peaks independent;
+                        # forked processes start with the peak of this one
+                        pool = multiprocessing.get_context('spawn').Pool(1)
+                        try:
+                            traced, rss = pool.apply(measure_memory,
+                                                     (stage, width, height, kind, out_dir))
+                        finally:
+                            pool.terminate()
+                            pool.join()
+                        results[key]['peak_traced_mb'] = traced
+                        results[key]['peak_rss_growth_mb'] = rss
+
+                    print("%-50s %8.3fs %8.2f MP/s%s" %
+                          (key, seconds, results[key]['megapixels_per_second'],
+                           (" %8.1f MB traced %8.1f MB rss" % (traced, rss)) if measure else ""))
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    return results
+
+
+def benchmark_morphology(image_paths, repeat):
+    """Compares the reference mask chain with the MaskMorphology one on each image
+    """
+    total_reference, total_pipeline = 0.0, 0.0
+    for one_path in image_paths:
+        img = rgbmask.read_bgr_image(gdal.Open(one_path))
+
+        reference_time, reference = time_call(reference_mask, repeat, img)
+        pipeline_time, pipeline = time_call(rgbmask.gen_mask, repeat, img, 3)
+        total_reference += reference_time
+        total_pipeline += pipeline_time
+
+        print("%s: %dx%d reference %.3fs, pipeline %.3fs, saving %.3fs (%.1f%%), identical %s" %
+              (os.path.basename(one_path), img.shape[1], img.shape[0], reference_time,
+               pipeline_time, reference_time - pipeline_time,
+               100.0 * (reference_time - pipeline_time) / reference_time,
+               str(np.array_equal(reference, pipeline))))
+
+    num_images = len(image_paths)
+    if num_images > 0:
+        print("Average per image: reference %.3fs, pipeline %.3fs, saving %.3fs" %
+              (total_reference / num_images, total_pipeline / num_images,
+               (total_reference - total_pipeline) / num_images))
+
+
+def find_regressions(results, baseline, tolerance):
+    """Compares results against a baseline
+    Args:
+        results(dict): the results of benchmark_stages()
+        baseline(dict): earlier results of benchmark_stages()
+        tolerance(float): the allowed portion of change before a result is a regression
+    Return:
+        A list of descriptions of the regressions found
+    Notes:
+        Only results found in both are compared; throughput regresses when it drops, and memory
+        regresses when it grows, by more than the tolerance
+    """
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        current, previous = results[key], baseline[key]
+
+        if current['megapixels_per_second'] < \
+                            previous['megapixels_per_second'] * (1.0 - tolerance):
+            regressions.append("%s: %.2f MP/s, baseline %.2f MP/s" %
+                               (key, current['megapixels_per_second'],
+                                previous['megapixels_per_second']))
+
+        for field in ['peak_traced_mb', 'peak_rss_growth_mb']:
+            if field in current and field in previous and previous[field] > 0 and \
+                            current[field] > previous[field] * (1.0 + tolerance):
+                regressions.append("%s: %s %.1f MB, baseline %.1f MB" %
+                                   (key, field, current[field], previous[field]))
+
+    return regressions
+
+
+def main():
+    """Runs the benchmarks
+    """
+    parser = argparse.ArgumentParser(description="Benchmark rgbmask mask generation")
+    parser.add_argument('images', nargs='*',
+                        help="stereoTop GeoTIFF images to compare the mask chains with")
+    parser.add_argument('--repeat', type=int, default=3, help="number of times each step is timed")
+    parser.add_argument('--sizes', default=','.join(DEFAULT_SIZES),
+                        help="comma separated WIDTHxHEIGHT sizes of the synthetic images " +
+                        "(default=" + ','.join(DEFAULT_SIZES) + ")")
+    parser.add_argument('--kinds', default=','.join(IMAGE_KINDS),
+                        help="comma separated kinds of synthetic images (default=" +
+                        ','.join(IMAGE_KINDS) + ")")
+    parser.add_argument('--no-memory', dest='measure', action='store_false', default=True,
+                        help="skip measuring the peak memory of each stage")
+    parser.add_argument('--output', help="file to write the results to as JSON")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed change from the baseline (default=" +
+                        str(DEFAULT_TOLERANCE) + ")")
+    args = parser.parse_args()
+
+    if args.images:
+        benchmark_morphology(args.images, args.repeat)
+
+    results = benchmark_stages(args.sizes.split(','), args.kinds.split(','), args.repeat,
+                               args.measure)
+
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            json.dump({'platform': platform.platform(),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'opencv': cv2.__version__,
+                       'gdal': gdal.__version__,
+                       'cpus': multiprocessing.cpu_count(),
+                       'results': results}, out_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as in_file:
+            baseline = json.load(in_file)['results']
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for one_regression in regressions:
+            print("REGRESSION %s" % one_regression)
+        if regressions:
+            return 1
+        print("No regressions found against %s" % args.baseline)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
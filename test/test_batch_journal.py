@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""Tests resuming batch runs from their journal
+
+Captures are laid out in a temporary sites folder, and batch runs are made with the masking
+replaced by a mock, so that the tests can check which images a run finds, which it records in
+its journal, and which a later run skips.
+
+The extractor's dependencies need to be installed, as they are in the extractor's container.
+
+Example:
+    python -m pytest test/test_batch_journal.py
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+import terra_rgbmask as rgbmask
+from terrautils.sensors import Sensors
+
+# The site of the test captures
+SITE = 'ua-mac'
+
+# Timestamps of the test captures, and the sides each one has an image of
+CAPTURES = [
+    ('2017-05-01__10-00-00-000', ['left', 'right']),
+    ('2017-05-01__10-05-00-000', ['left']),
+    ('2017-05-02__09-00-00-000', ['left', 'right']),
+    ('2017-05-03__09-00-00-000', ['right'])
+]
+
+
+def masked_result(job):
+    """Returns the result of mask_image_file() for a job, without masking the image
+    """
+    return {'source': job['source'], 'files': [job['mask_path']], 'masked': True, 'ratio': 0.5,
+            'bytes': 10, 'skip': None, 'info': [], 'timings': {}}
+
+
+class JournalTest(unittest.TestCase):
+    """Tests writing and reading journal events
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.journal = os.path.join(self.folder, 'journal.jsonl')
+
+    def test_missing_journal(self):
+        """A journal that doesn't exist yet has no events"""
+        self.assertEqual(rgbmask.read_journal(self.journal), (set(), [], set()))
+
+    def test_round_trip(self):
+        """Masked, skipped and registered events read back, ignoring a line cut short"""
+        masked = {'event': rgbmask.JOURNAL_MASKED, 'source': '/a.tif', 'timestamp': 't1',
+                  'files': ['/a_mask.tif'], 'ratio': 0.25}
+        with open(self.journal, 'a') as journal_file:
+            rgbmask.write_journal(journal_file, masked)
+            rgbmask.write_journal(journal_file, {'event': rgbmask.JOURNAL_SKIPPED,
+                                                 'source': '/b.tif', 'timestamp': 't2',
+                                                 'reason': 'low quality'})
+            rgbmask.write_journal(journal_file, {'event': rgbmask.JOURNAL_REGISTERED,
+                                                 'path': '/a_mask.tif', 'dataset': 'd',
+                                                 'id': 'f'})
+            journal_file.write('{"event": "masked", "sour')
+        rgbmask.write_journal(None, masked)
+
+        done, found, registered = rgbmask.read_journal(self.journal)
+        self.assertEqual(done, set(['/a.tif', '/b.tif']))
+        self.assertEqual(found, [masked])
+        self.assertEqual(registered, set(['/a_mask.tif']))
+
+
+class BatchTest(unittest.TestCase):
+    """Finds the captures of a sites folder and masks them in batch runs
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.base = os.path.join(self.folder, 'sites')
+        self.journal = os.path.join(self.folder, 'journal.jsonl')
+        self.sources = Sensors(base=self.base, station=SITE, sensor=rgbmask.BATCH_SOURCE_SENSOR)
+
+        self.images = {}
+        for timestamp, sides in CAPTURES:
+            for side in sides:
+                path = self.sources.get_sensor_path(timestamp, opts=[side])
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'wb') as out_file:
+                    out_file.write(b'pixels')
+                self.images[(timestamp, side)] = path
+
+        patcher = mock.patch.object(rgbmask, 'load_json_file', return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_batch(self, mask_image_file):
+        """Runs a batch masked by mask_image_file, returning the exit status and the masked images
+        """
+        with mock.patch.object(rgbmask, 'mask_image_file', side_effect=mask_image_file) as masker:
+            status = rgbmask.batch_main(['--terraref_base', self.base, '--terraref_site', SITE,
+                                         '--output-base', os.path.join(self.folder, 'out'),
+                                         '--journal', self.journal, '--workers', '1'])
+        return status, [call[0][0]['source'] for call in masker.call_args_list]
+
+    def test_find_captures(self):
+        """Captures missing a needed side or outside the dates are left out"""
+        captures = rgbmask.find_capture_images(self.sources, ['left'])
+        self.assertEqual([timestamp for timestamp, _ in captures],
+                         [timestamp for timestamp, _ in CAPTURES[:3]])
+        self.assertEqual(captures[0][1], [('left', self.images[(CAPTURES[0][0], 'left')]),
+                                          ('right', self.images[(CAPTURES[0][0], 'right')])])
+
+        captures = rgbmask.find_capture_images(self.sources, rgbmask.BATCH_SIDES)
+        self.assertEqual([timestamp for timestamp, _ in captures],
+                         [CAPTURES[0][0], CAPTURES[2][0]])
+
+        captures = rgbmask.find_capture_images(self.sources, ['right'], '2017-05-02',
+                                               '2017-05-02')
+        self.assertEqual([timestamp for timestamp, _ in captures], [CAPTURES[2][0]])
+
+        empty = Sensors(base=os.path.join(self.folder, 'none'), station=SITE,
+                        sensor=rgbmask.BATCH_SOURCE_SENSOR)
+        self.assertEqual(rgbmask.find_capture_images(empty, ['left']), [])
+
+    def test_resume(self):
+        """A run skips the images masked by earlier runs and retries the ones that failed"""
+        # Every image of the captures with a left image is masked, as the extractor does
+        images = [self.images[(timestamp, side)] for timestamp, sides in CAPTURES[:3]
+                  for side in sides]
+        with open(self.journal, 'a') as journal_file:
+            rgbmask.write_journal(journal_file, {'event': rgbmask.JOURNAL_MASKED,
+                                                 'source': images[0], 'timestamp': 't',
+                                                 'files': [], 'ratio': 0.5})
+
+        def fail_one(job):
+            if job['source'] == images[3]:
+                raise RuntimeError("damaged image")
+            return masked_result(job)
+
+        status, masked = self.run_batch(fail_one)
+        self.assertEqual(status, 1)
+        self.assertEqual(masked, images[1:])
+        done, events, _ = rgbmask.read_journal(self.journal)
+        self.assertEqual(done, set(images) - set([images[3]]))
+        self.assertTrue(events[1]['files'][0].startswith(os.path.join(self.folder, 'out')))
+
+        status, masked = self.run_batch(masked_result)
+        self.assertEqual((status, masked), (0, [images[3]]))
+        self.assertEqual(rgbmask.read_journal(self.journal)[0], set(images))
+
+        status, masked = self.run_batch(masked_result)
+        self.assertEqual((status, masked), (0, []))
+        with open(self.journal, 'r') as in_file:
+            self.assertEqual(len([json.loads(line) for line in in_file]), len(images))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""Tests the pool of image buffers
+
+Checks which buffers the pool hands back out, that it stays within its limit, and that images
+read with read_bgr_image() land in pooled buffers in BGR order.
+
+The extractor's dependencies need to be installed, as they are in the extractor's container.
+
+Example:
+    python -m pytest test/test_buffer_pool.py
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from osgeo import gdal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+import terra_rgbmask as rgbmask
+from buffer_pool import BufferPool
+
+# Shape of the test buffers; each one is 3,000,000 bytes
+BUFFER_SHAPE = (1000, 1000, 3)
+
+# Limit of the test pools, in megabytes, holding two test buffers but not three
+POOL_MAX_MB = 6
+
+
+class BufferPoolTest(unittest.TestCase):
+    """Tests getting, releasing and dropping buffers
+    """
+
+    def test_reuses_released_buffer(self):
+        """A released buffer is handed out again for the same shape and type only"""
+        pool = BufferPool(POOL_MAX_MB)
+        first = pool.get(BUFFER_SHAPE)
+        pool.release(first)
+
+        self.assertIsNot(pool.get(BUFFER_SHAPE, np.uint16), first)
+        self.assertIsNot(pool.get((10, 10, 3)), first)
+        self.assertIs(pool.get(list(BUFFER_SHAPE)), first)
+        self.assertIsNot(pool.get(BUFFER_SHAPE), first)
+        self.assertEqual((pool.hits, pool.misses), (1, 4))
+        self.assertEqual(pool.free_bytes, 0)
+
+    def test_most_recent_first(self):
+        """The most recently released buffer is handed out first"""
+        pool = BufferPool(POOL_MAX_MB)
+        first, second = pool.get(BUFFER_SHAPE), pool.get(BUFFER_SHAPE)
+        pool.release(first)
+        pool.release(second)
+        self.assertIs(pool.get(BUFFER_SHAPE), second)
+        self.assertIs(pool.get(BUFFER_SHAPE), first)
+
+    def test_rejects_views_and_repeats(self):
+        """Views, None and buffers already in the pool aren't added"""
+        pool = BufferPool(POOL_MAX_MB)
+        buf = pool.get(BUFFER_SHAPE)
+        pool.release(None)
+        pool.release(buf[:10])
+        pool.release(buf[:, :, 0])
+        self.assertEqual(pool.free, [])
+
+        pool.release(buf)
+        pool.release(buf)
+        self.assertEqual(len(pool.free), 1)
+        self.assertEqual(pool.free_bytes, buf.nbytes)
+
+    def test_limit(self):
+        """The least recently released buffers are dropped to keep within the limit"""
+        pool = BufferPool(POOL_MAX_MB)
+        buffers = [pool.get(BUFFER_SHAPE) for _ in range(3)]
+        for buf in buffers:
+            pool.release(buf)
+        self.assertEqual([id(buf) for buf in pool.free], [id(buf) for buf in buffers[1:]])
+        self.assertLessEqual(pool.free_bytes, pool.max_bytes)
+
+        pool.set_max_mb(0)
+        self.assertEqual((pool.free, pool.free_bytes), ([], 0))
+        pool.release(pool.get(BUFFER_SHAPE))
+        self.assertEqual(pool.free, [])
+
+
+class ReadBgrImageTest(unittest.TestCase):
+    """Reads RGB GeoTIFFs into pooled buffers
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        pool = rgbmask.image_buffers
+        self.addCleanup(pool.set_max_mb, pool.max_bytes // (1024 * 1024))
+
+        rng = np.random.RandomState(17)
+        self.rgb = rng.randint(0, 256, size=(120, 90, 3)).astype(np.uint8)
+        self.path = os.path.join(self.folder, 'rgb.tif')
+        raster = gdal.GetDriverByName('GTiff').Create(self.path, 90, 120, 3, gdal.GDT_Byte)
+        for band in range(3):
+            raster.GetRasterBand(band + 1).WriteArray(self.rgb[:, :, band])
+        raster = None
+        self.src = gdal.Open(self.path)
+
+    def test_bgr_order(self):
+        """Images and windows of them are read in BGR order"""
+        img = rgbmask.read_bgr_image(self.src)
+        self.assertEqual(img.dtype, np.uint8)
+        self.assertTrue(np.array_equal(img, self.rgb[:, :, ::-1]))
+
+        window = rgbmask.read_bgr_image(self.src, 10, 20, 30, 40)
+        self.assertTrue(np.array_equal(window, self.rgb[20:60, 10:40, ::-1]))
+
+    def test_reads_into_pooled_buffer(self):
+        """A released image's buffer is reused by the next read of the same size"""
+        pool = rgbmask.image_buffers
+        img = rgbmask.read_bgr_image(self.src)
+        pool.release(img)
+
+        again = rgbmask.read_bgr_image(self.src)
+        self.assertIs(again, img)
+        self.assertTrue(np.array_equal(again, self.rgb[:, :, ::-1]))
+
+        out = np.zeros_like(img)
+        self.assertIs(rgbmask.read_bgr_image(self.src, out=out), out)
+        self.assertTrue(np.array_equal(out, self.rgb[:, :, ::-1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
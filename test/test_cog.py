@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""Tests writing cloud optimized GeoTIFFs
+
+Checks the overview levels and creation options of cloud optimized GeoTIFFs, and that files
+written by create_geotiff() and convert_to_cog() are tiled, have their overviews, and read back
+unchanged.
+
+The extractor's dependencies need to be installed, as they are in the extractor's container.
+
+Example:
+    python -m pytest test/test_cog.py
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from osgeo import gdal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from terrautils import formats
+
+BOUNDS = (33.0, 33.001, -111.001, -111.0)
+
+# Size of the test images, as (height, width); the overviews halve it until it fits a tile
+IMAGE_SHAPE = (1200, 1500)
+
+
+class CogOptionsTest(unittest.TestCase):
+    """Tests the overview levels and the creation options
+    """
+
+    def test_overview_levels(self):
+        """Overviews are added until the smallest fits in a tile"""
+        self.assertEqual(formats.cog_overview_levels(512, 512), [])
+        self.assertEqual(formats.cog_overview_levels(513, 100), [2])
+        self.assertEqual(formats.cog_overview_levels(1500, 1200), [2, 4])
+        self.assertEqual(formats.cog_overview_levels(300, 300, block_size=64), [2, 4, 8])
+
+    def test_creation_options(self):
+        """Files are tiled once, in square blocks, with the source overviews copied"""
+        options = formats.cog_creation_options('DEFLATE', 2, 6, 'ALL_CPUS')
+        self.assertEqual(options.count('TILED=YES'), 1)
+        for one_option in ('COMPRESS=DEFLATE', 'PREDICTOR=2', 'ZLEVEL=6', 'NUM_THREADS=ALL_CPUS',
+                           'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COPY_SRC_OVERVIEWS=YES'):
+            self.assertIn(one_option, options)
+
+    def test_packed_options(self):
+        """Packed masks keep NBITS and leave out the predictor"""
+        options = formats.cog_creation_options('LZW', 2, None, None, 1, block_size=256)
+        self.assertIn('NBITS=1', options)
+        self.assertNotIn('PREDICTOR=2', options)
+        self.assertIn('BLOCKXSIZE=256', options)
+
+
+class CogWriteTest(unittest.TestCase):
+    """Writes cloud optimized GeoTIFFs and reads them back
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        rng = np.random.RandomState(14)
+        self.rgb = rng.randint(0, 256, size=IMAGE_SHAPE + (3,)).astype(np.uint8)
+        self.mask = rng.randint(0, 2, size=IMAGE_SHAPE).astype(np.uint8)
+
+    def assertCog(self, path, pixels, levels):
+        """Checks that a file is tiled, has its overviews, and holds the pixels"""
+        raster = gdal.Open(path)
+        bands = pixels.shape[2] if pixels.ndim == 3 else 1
+        self.assertEqual(raster.RasterCount, bands)
+        for band_idx in range(bands):
+            band = raster.GetRasterBand(band_idx + 1)
+            self.assertEqual(band.GetBlockSize(), [formats.COG_BLOCK_SIZE] * 2)
+            self.assertEqual(band.GetOverviewCount(), len(levels))
+            expected = pixels[:, :, band_idx] if pixels.ndim == 3 else pixels
+            self.assertTrue(np.array_equal(band.ReadAsArray(), expected))
+
+    def test_create_cog(self):
+        """create_geotiff() writes a cloud optimized GeoTIFF in one pass"""
+        levels = formats.cog_overview_levels(IMAGE_SHAPE[1], IMAGE_SHAPE[0])
+        rgb_path = os.path.join(self.folder, 'rgb.tif')
+        formats.create_geotiff(self.rgb, BOUNDS, rgb_path, None, compress='LZW', predictor=2,
+                               cog=True)
+        self.assertCog(rgb_path, self.rgb, levels)
+
+        mask_path = os.path.join(self.folder, 'mask.tif')
+        formats.create_geotiff(self.mask, BOUNDS, mask_path, None, compress='LZW', nbits=1,
+                               cog=True, overview_resample='NEAREST')
+        self.assertCog(mask_path, self.mask, levels)
+
+        # Nearest neighbour overviews keep the mask values
+        overview = gdal.Open(mask_path).GetRasterBand(1).GetOverview(0).ReadAsArray()
+        self.assertTrue(set(np.unique(overview).tolist()) <= set([0, 1]))
+
+    def test_convert_to_cog(self):
+        """convert_to_cog() replaces a GeoTIFF with a cloud optimized copy"""
+        path = os.path.join(self.folder, 'tiles.tif')
+        formats.create_geotiff(self.rgb, BOUNDS, path, None, compress='LZW', tiled=True)
+        self.assertEqual(gdal.Open(path).GetRasterBand(1).GetOverviewCount(), 0)
+
+        formats.convert_to_cog(path, 'LZW', 2)
+        self.assertCog(path, self.rgb, formats.cog_overview_levels(IMAGE_SHAPE[1],
+                                                                   IMAGE_SHAPE[0]))
+        self.assertEqual(os.listdir(self.folder), ['tiles.tif'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""Tests that the strip labeling of masks matches the scikit-image filters
+
+Random masks are filtered with MaskMorphology, labeling over several numbers of threads, and
+with remove_small_area_mask() and remove_small_holes_mask(), and the masks are compared bit for
+bit. The areas found by ComponentLabels are also checked against labeling the mask in one piece.
+
+The extractor's dependencies need to be installed, as they are in the extractor's container.
+
+Example:
+    python -m pytest test/test_component_labels.py
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+import terra_rgbmask as rgbmask
+import component_labels
+
+# Numbers of labeling threads that are checked
+WORKER_COUNTS = [1, 2, 3, 4]
+
+# Sizes of the random masks, as (height, width); tall masks are split into several strips
+MASK_SHAPES = [(1, 1), (9, 13), (130, 70), (257, 96)]
+
+# Component and hole sizes checked, including sizes that equal the areas of small blobs
+AREA_SIZES = [1, 2, 5, 16, 40]
+
+# Number of random masks of each shape
+MASKS_PER_SHAPE = 3
+
+
+def random_mask(rng, shape):
+    """Returns a random boolean mask with blobs and holes of many sizes
+    Args:
+        rng(numpy RandomState): the source of random numbers
+        shape(tuple): the (height, width) of the mask
+    Return:
+        The boolean mask
+    """
+    mask = rng.randint(0, 100, size=shape) < 45
+    blocks = rng.randint(0, 2, size=(shape[0] // 4 + 1, shape[1] // 4 + 1)).astype(bool)
+    blocks = np.repeat(np.repeat(blocks, 4, axis=0), 4, axis=1)[:shape[0], :shape[1]]
+    return np.where(rng.randint(0, 2, size=shape).astype(bool), mask, blocks)
+
+
+class ComponentLabelsTest(unittest.TestCase):
+    """Compares the strip labeling against labeling the whole mask
+    """
+
+    def setUp(self):
+        self.addCleanup(component_labels.set_label_workers,
+                        component_labels.get_label_workers())
+
+    def masks(self):
+        """Returns the random masks used by the tests
+        """
+        rng = np.random.RandomState(16)
+        return [random_mask(rng, shape) for shape in MASK_SHAPES
+                for _ in range(MASKS_PER_SHAPE)]
+
+    def test_areas_match_whole_mask(self):
+        """Component areas don't depend on the number of strips"""
+        for mask in self.masks():
+            for connectivity in (4, 8):
+                count, labels = cv2.connectedComponents(mask.view(np.uint8),
+                                                        connectivity=connectivity)
+                expected = np.bincount(labels.ravel(), minlength=count)
+                for workers in WORKER_COUNTS:
+                    components = component_labels.ComponentLabels(mask, connectivity, workers)
+                    roots = np.unique(components.roots[1:])
+                    chosen = np.ones(components.areas.size, dtype=bool)
+                    chosen[0] = False
+
+                    self.assertEqual(sorted(components.areas[roots].tolist()),
+                                     sorted(expected[1:].tolist()))
+                    self.assertTrue(np.array_equal(components.select(chosen), mask))
+
+    def test_remove_small_areas(self):
+        """Small components are removed like remove_small_area_mask() removes them"""
+        for mask in self.masks():
+            image = mask.astype(np.uint8) * rgbmask.MAX_PIXEL_VAL
+            for size in AREA_SIZES:
+                expected = rgbmask.remove_small_area_mask(image, size) > 0
+                for workers in WORKER_COUNTS:
+                    component_labels.set_label_workers(workers)
+                    found = rgbmask.MaskMorphology(mask.copy()).remove_small_areas(size).mask
+                    self.assertTrue(np.array_equal(found, expected),
+                                    "%s mask, size %s, %s workers" % (mask.shape, size, workers))
+
+    def test_fill_small_holes(self):
+        """Small holes are filled like remove_small_holes_mask() fills them"""
+        for mask in self.masks():
+            image = mask.astype(np.uint8) * rgbmask.MAX_PIXEL_VAL
+            for size in AREA_SIZES:
+                expected = rgbmask.remove_small_holes_mask(image, size) > 0
+                for workers in WORKER_COUNTS:
+                    component_labels.set_label_workers(workers)
+                    found = rgbmask.MaskMorphology(mask.copy()).fill_small_holes(size).mask
+                    self.assertTrue(np.array_equal(found, expected),
+                                    "%s mask, size %s, %s workers" % (mask.shape, size, workers))
+
+    def test_exact_size_is_kept(self):
+        """A component with exactly the minimum area is kept and a hole of exactly the maximum
+        size isn't filled"""
+        mask = np.zeros((8, 8), dtype=bool)
+        mask[1, 1:4] = True
+        image = mask.astype(np.uint8) * rgbmask.MAX_PIXEL_VAL
+
+        self.assertTrue(np.array_equal(rgbmask.remove_small_area_mask(image, 3) > 0, mask))
+        self.assertTrue(np.array_equal(rgbmask.MaskMorphology(mask.copy())
+                                       .remove_small_areas(3).mask, mask))
+
+        holes = np.logical_not(mask)
+        holes_image = holes.astype(np.uint8) * rgbmask.MAX_PIXEL_VAL
+        self.assertTrue(np.array_equal(rgbmask.remove_small_holes_mask(holes_image, 3) > 0,
+                                       holes))
+        self.assertTrue(np.array_equal(rgbmask.MaskMorphology(holes.copy())
+                                       .fill_small_holes(3).mask, holes))
+
+
+if __name__ == '__main__':
+    unittest.main()
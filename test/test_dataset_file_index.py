@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""Tests the file indexes of Clowder datasets
+
+The Clowder API is replaced by a fake that holds the files of one dataset, so that the tests can
+check that the index follows the uploads and deletes made through the helpers, including
+uploads made from other threads.
+
+The extractor's dependencies need to be installed, as they are in the extractor's container.
+
+Example:
+    python -m pytest test/test_dataset_file_index.py
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from terrautils import extractors
+
+HOST = 'https://clowder.example.org/'
+KEY = 'secret'
+DATASET = 'dataset1'
+
+# Number of threads uploading at the same time, and files uploaded by each
+UPLOAD_THREADS = 4
+UPLOADS_PER_THREAD = 25
+
+
+class FakeConnector(object):
+    """The parts of a pyclowder connector used by the upload helpers
+    """
+    mounted_paths = {}
+    ssl_verify = True
+
+
+class FakeResponse(object):
+    """The parts of a requests response used by the Clowder helpers
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.text = json.dumps(content)
+
+    def json(self):
+        return self.content
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeClowder(object):
+    """Holds the files of a dataset and answers the requests of the tests
+    """
+
+    def __init__(self):
+        self.files = {'f0': 'existing.tif'}
+        self.uploads = 0
+        self.list_requests = 0
+        self.lock = threading.Lock()
+
+    def get_file_list(self, connector, host, secret_key, dsid):
+        self.list_requests += 1
+        return [{'id': fileid, 'filename': name} for fileid, name in sorted(self.files.items())]
+
+    def post(self, url, data=None, *args, **kwargs):
+        # Read the streamed body the way requests would
+        while data.read(65536):
+            pass
+        with self.lock:
+            self.uploads += 1
+            fileid = 'upload%d' % self.uploads
+            self.files[fileid] = os.path.basename(data.filepath)
+        return FakeResponse({'id': fileid})
+
+    def delete(self, url, *args, **kwargs):
+        fileid = url.split('/api/files/')[1].split('?')[0]
+        with self.lock:
+            del self.files[fileid]
+        return FakeResponse({})
+
+
+class DatasetFileIndexTest(unittest.TestCase):
+    """Tests the dataset file index through the helpers that use it
+    """
+
+    def setUp(self):
+        extractors.clear_dataset_file_indexes()
+        self.clowder = FakeClowder()
+        patchers = [mock.patch.object(extractors, 'get_file_list', self.clowder.get_file_list),
+                    mock.patch.object(extractors.httpclient, 'post', self.clowder.post),
+                    mock.patch.object(extractors.httpclient, 'delete', self.clowder.delete)]
+        for one_patcher in patchers:
+            one_patcher.start()
+            self.addCleanup(one_patcher.stop)
+        self.addCleanup(extractors.clear_dataset_file_indexes)
+
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.connector = FakeConnector()
+
+    def make_file(self, name):
+        """Creates a small file to upload and returns its path
+        """
+        path = os.path.join(self.folder, name)
+        with open(path, 'wb') as out_file:
+            out_file.write(b'\0' * 100)
+        return path
+
+    def check(self, path, remove=False):
+        """Looks for a file in the dataset, see check_file_in_dataset()
+        """
+        return extractors.check_file_in_dataset(self.connector, HOST, KEY, DATASET, path,
+                                                remove=remove)
+
+    def assertIndexMatches(self):
+        """Checks that the index holds the files Clowder has"""
+        with extractors.dataset_file_indexes_lock:
+            index = extractors.dataset_file_indexes[(HOST, DATASET)]
+            self.assertEqual(sorted(index.by_id), sorted(self.clowder.files))
+            self.assertEqual(sorted(index.by_name), sorted(set(self.clowder.files.values())))
+
+    def test_uploads_and_deletes(self):
+        """Uploaded files are found and deleted files aren't, without fetching the list again"""
+        self.assertTrue(self.check('existing.tif'))
+        path = self.make_file('product.tif')
+        self.assertFalse(self.check(path))
+
+        extractors.upload_to_dataset(self.connector, HOST, 'user', 'pass', DATASET, path)
+        self.assertTrue(self.check(path))
+        self.assertIndexMatches()
+
+        # Removing a file deletes it from Clowder and from the index
+        self.assertTrue(self.check(path, remove=True))
+        self.assertFalse(self.check(path))
+        self.assertTrue(self.check('existing.tif', remove=True))
+        self.assertFalse(self.check('existing.tif'))
+        self.assertIndexMatches()
+
+        self.assertEqual(self.clowder.list_requests, 1)
+
+    def test_uploads_from_threads(self):
+        """Uploads from several threads at the same time all make it into the index"""
+        self.assertTrue(self.check('existing.tif'))
+        paths = [[self.make_file('product_%d_%d.tif' % (thread_idx, idx))
+                  for idx in range(UPLOADS_PER_THREAD)] for thread_idx in range(UPLOAD_THREADS)]
+
+        def upload(thread_paths):
+            for one_path in thread_paths:
+                extractors.upload_to_dataset(self.connector, HOST, 'user', 'pass', DATASET,
+                                             one_path)
+                self.check(one_path)
+
+        threads = [threading.Thread(target=upload, args=(thread_paths,))
+                   for thread_paths in paths]
+        for one_thread in threads:
+            one_thread.start()
+        for one_thread in threads:
+            one_thread.join()
+
+        self.assertIndexMatches()
+        for thread_paths in paths:
+            for one_path in thread_paths:
+                self.assertTrue(self.check(one_path))
+        self.assertEqual(self.clowder.list_requests, 1)
+
+    def test_clear_fetches_again(self):
+        """A cleared index is fetched again on the next lookup"""
+        self.assertTrue(self.check('existing.tif'))
+        self.clowder.files['f9'] = 'added_elsewhere.tif'
+        self.assertFalse(self.check('added_elsewhere.tif'))
+
+        extractors.clear_dataset_file_indexes(HOST, DATASET)
+        self.assertTrue(self.check('added_elsewhere.tif'))
+        self.assertEqual(self.clowder.list_requests, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
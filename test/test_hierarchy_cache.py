@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""Tests the caching of Clowder hierarchy lookups
+
+The Clowder API is replaced by a fake that records the requests made, so that the tests can
+check which requests the cache saves and which links it still makes.
+
+The extractor's dependencies need to be installed, as they are in the extractor's container.
+
+Example:
+    python -m pytest test/test_hierarchy_cache.py
+"""
+
+import os
+import sys
+import json
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from terrautils import extractors
+
+HOST = 'https://clowder.example.org/'
+KEY = 'secret'
+SPACE = 'space1'
+PARENT = 'parent1'
+CHILD = 'child1'
+CHILD_NAME = 'stereoRGB geotiffs - 2017'
+
+
+class FakeResponse(object):
+    """The parts of a requests response used by the Clowder helpers
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.text = json.dumps(content)
+
+    def json(self):
+        return self.content
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeClowder(object):
+    """Answers the Clowder requests of the tests and records them
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, *args, **kwargs):
+        self.requests.append(('get', url))
+        if '/getChildCollections' in url:
+            return FakeResponse([{'id': CHILD, 'name': CHILD_NAME}])
+        if 'api/collections?' in url:
+            return FakeResponse([{'id': CHILD, 'name': CHILD_NAME}])
+        return FakeResponse([])
+
+    def post(self, url, *args, **kwargs):
+        self.requests.append(('post', url))
+        return FakeResponse({})
+
+    def posts(self, part):
+        """Returns the POST requests whose URL contains part
+        """
+        return [url for method, url in self.requests if method == 'post' and part in url]
+
+
+class HierarchyCacheTest(unittest.TestCase):
+    """Tests the hierarchy cache through the Clowder helpers that use it
+    """
+
+    def setUp(self):
+        extractors.hierarchy_cache.clear()
+        self.clowder = FakeClowder()
+        patchers = [mock.patch.object(extractors.httpclient, 'get', self.clowder.get),
+                    mock.patch.object(extractors.httpclient, 'post', self.clowder.post)]
+        for one_patcher in patchers:
+            one_patcher.start()
+            self.addCleanup(one_patcher.stop)
+        self.addCleanup(extractors.hierarchy_cache.clear)
+
+    def test_repeat_lookup_is_cached(self):
+        """A collection found once isn't looked up or linked again"""
+        first = extractors.get_collection_or_create(HOST, KEY, 'user', 'pass', CHILD_NAME,
+                                                    PARENT, SPACE)
+        count = len(self.clowder.requests)
+        second = extractors.get_collection_or_create(HOST, KEY, 'user', 'pass', CHILD_NAME,
+                                                     PARENT, SPACE)
+
+        self.assertEqual(first, CHILD)
+        self.assertEqual(second, CHILD)
+        self.assertEqual(len(self.clowder.requests), count)
+
+    def test_child_lookup_then_get_links_space(self):
+        """A collection found among the children is still linked to its space when it's looked
+        up by get_collection_or_create() with the same key"""
+        coll_id = extractors.ensure_collection_in_children(HOST, KEY, 'user', 'pass', SPACE,
+                                                           PARENT, CHILD_NAME)
+        self.assertEqual(coll_id, CHILD)
+        self.assertEqual(self.clowder.posts('addCollectionToSpace'), [])
+
+        coll_id = extractors.get_collection_or_create(HOST, KEY, 'user', 'pass', CHILD_NAME,
+                                                      PARENT, SPACE)
+        self.assertEqual(coll_id, CHILD)
+        self.assertEqual(len(self.clowder.posts('/spaces/%s/addCollectionToSpace/%s' %
+                                                (SPACE, CHILD))), 1)
+        # The child is already known to be in the parent collection
+        self.assertEqual(self.clowder.posts('addSubCollection'), [])
+
+        # Both links are known now, so nothing more is requested
+        count = len(self.clowder.requests)
+        extractors.get_collection_or_create(HOST, KEY, 'user', 'pass', CHILD_NAME, PARENT, SPACE)
+        self.assertEqual(len(self.clowder.requests), count)
+
+
+if __name__ == '__main__':
+    unittest.main()
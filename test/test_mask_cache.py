@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""Tests the on-disk cache of masks
+
+Masks are stored in a temporary cache folder, so that the tests can check the fingerprints, the
+entries read back, and which entries are evicted when the cache grows past its limit.
+
+The extractor's dependencies need to be installed, as they are in the extractor's container.
+
+Example:
+    python -m pytest test/test_mask_cache.py
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+import mask_cache
+from mask_cache import MaskCache, file_fingerprint
+
+# Size limit of the test caches, in megabytes
+CACHE_MAX_MB = 1
+
+# Shape of the masks of the eviction test; each entry is about 125,000 bytes, so 8 entries fit
+# in the cache and 9 don't
+MASK_SHAPE = (1000, 1000)
+
+
+class MaskCacheTest(unittest.TestCase):
+    """Tests storing, reading and evicting cache entries
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.cache_dir = os.path.join(self.folder, 'cache')
+        self.addCleanup(mask_cache._cache_sizes.pop, self.cache_dir, None)
+        self.rng = np.random.RandomState(12)
+
+    def random_mask(self, shape):
+        """Returns a random boolean mask
+        """
+        return self.rng.randint(0, 2, size=shape).astype(bool)
+
+    def test_fingerprint(self):
+        """Fingerprints change with the file's bytes and with the parameters"""
+        path = os.path.join(self.folder, 'image.tif')
+        with open(path, 'wb') as out_file:
+            out_file.write(b'pixels' * 1000)
+        params = {'kernel_size': 3, 'engine': 'gr'}
+
+        first = file_fingerprint(path, params)
+        self.assertEqual(file_fingerprint(path, dict(params)), first)
+        self.assertNotEqual(file_fingerprint(path, {'kernel_size': 5, 'engine': 'gr'}), first)
+
+        with open(path, 'ab') as out_file:
+            out_file.write(b'!')
+        self.assertNotEqual(file_fingerprint(path, params), first)
+
+    def test_round_trip(self):
+        """Masks and low quality results read back as they were stored"""
+        cache = MaskCache(self.cache_dir, CACHE_MAX_MB)
+        mask = self.random_mask((37, 53))
+
+        self.assertIsNone(cache.get('aa01'))
+        cache.put('aa01', 0.25, mask)
+        cache.put('bb02', None, None)
+
+        ratio, found = cache.get('aa01')
+        self.assertEqual(ratio, 0.25)
+        self.assertEqual(found.dtype, np.bool_)
+        self.assertTrue(np.array_equal(found, mask))
+        self.assertEqual(cache.get('bb02'), (None, None))
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_evicts_least_recently_used(self):
+        """The entries used longest ago are evicted once the cache is over its limit"""
+        cache = MaskCache(self.cache_dir, CACHE_MAX_MB)
+        keys = ['%02x' % idx for idx in range(10)]
+        for key in keys[:8]:
+            cache.put(key, 0.5, self.random_mask(MASK_SHAPE))
+        self.assertLessEqual(cache.cached_bytes(), cache.max_bytes)
+
+        # Age the entries in the order they were added, then use the oldest one
+        old_time = time.time() - 1000
+        for idx, key in enumerate(keys[:8]):
+            os.utime(cache.entry_path(key), (old_time + idx, old_time + idx))
+        self.assertIsNotNone(cache.get(keys[0]))
+
+        for key in keys[8:]:
+            cache.put(key, 0.5, self.random_mask(MASK_SHAPE))
+
+        present = [key for key in keys if os.path.exists(cache.entry_path(key))]
+        self.assertEqual(present, [keys[0]] + keys[3:])
+        self.assertLessEqual(cache.scan()[1], cache.max_bytes)
+        self.assertEqual(cache.cached_bytes(), cache.scan()[1])
+
+    def test_put_walks_folder_only_when_needed(self):
+        """The folder is walked once, and again only when the cache goes over its limit"""
+        cache = MaskCache(self.cache_dir, CACHE_MAX_MB)
+        with mock.patch.object(MaskCache, 'scan', autospec=True,
+                               side_effect=MaskCache.scan) as scan:
+            for idx in range(8):
+                cache.put('%02x' % idx, 0.5, self.random_mask(MASK_SHAPE))
+            self.assertEqual(scan.call_count, 1)
+
+            cache.put('08', 0.5, self.random_mask(MASK_SHAPE))
+            self.assertEqual(scan.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
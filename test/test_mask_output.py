@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""Tests the single band mask product
+
+Checks the values of the single band mask, the number of bits it's stored with, the products
+each output mode creates, and that a mask written with NBITS reads back unchanged.
+
+The extractor's dependencies need to be installed, as they are in the extractor's container.
+
+Example:
+    python -m pytest test/test_mask_output.py
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import unittest
+
+import numpy as np
+from osgeo import gdal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+import terra_rgbmask as rgbmask
+
+BOUNDS = (33.0, 33.001, -111.001, -111.0)
+
+
+class FakeSensors(object):
+    """Builds product paths from the date and the options, like Sensors.create_sensor_path()
+    """
+
+    def create_sensor_path(self, datestamp, opts=None):
+        return '/sites/%s%s.tif' % (datestamp, ''.join(['_' + one_opt for one_opt in opts or []]))
+
+
+def parse_options(argv):
+    """Returns the mask options of a command line, see get_mask_options()
+    """
+    parser = argparse.ArgumentParser()
+    rgbmask.add_local_arguments(parser)
+    return rgbmask.get_mask_options(parser.parse_args(argv))
+
+
+class BinMaskTest(unittest.TestCase):
+    """Tests the values of the single band mask
+    """
+
+    def setUp(self):
+        self.img = np.full((4, 5, 3), 100, dtype=np.uint8)
+        self.img[0, 0] = 0
+        self.plants = np.zeros((4, 5), dtype=bool)
+        self.plants[1:3, 1:4] = True
+
+    def test_plants_are_one(self):
+        """Plants are 1 and everything else is 0"""
+        mask = rgbmask.gen_bin_mask(self.img, self.plants)
+        self.assertEqual(mask.dtype, np.uint8)
+        self.assertTrue(np.array_equal(mask, self.plants.astype(np.uint8)))
+
+    def test_nodata(self):
+        """Pixels that are black in every band are nodata"""
+        mask = rgbmask.gen_bin_mask(self.img, self.plants, 3)
+        self.assertEqual(mask[0, 0], 3)
+        self.assertEqual(np.count_nonzero(mask == 3), 1)
+        self.assertEqual(np.count_nonzero(mask == 1), np.count_nonzero(self.plants))
+
+    def test_nbits(self):
+        """The mask is stored with as few bits as its values need"""
+        self.assertEqual(rgbmask.mask_nbits(None), 1)
+        self.assertEqual(rgbmask.mask_nbits(2), 2)
+        self.assertEqual(rgbmask.mask_nbits(3), 2)
+        self.assertEqual(rgbmask.mask_nbits(4), 3)
+        self.assertEqual(rgbmask.mask_nbits(255), 8)
+
+
+class OutputModeTest(unittest.TestCase):
+    """Tests the products of each output mode and the checks of the options
+    """
+
+    def test_output_paths(self):
+        """Each output mode creates its products, named with the image's options"""
+        sensors = FakeSensors()
+        self.assertEqual(rgbmask.mask_output_paths(sensors, 'rgb', 'day', ['left']),
+                         ('/sites/day_left.tif', None))
+        self.assertEqual(rgbmask.mask_output_paths(sensors, 'mask', 'day', ['left']),
+                         (None, '/sites/day_left_%s.tif' % rgbmask.BIN_MASK_OPT))
+        self.assertEqual(rgbmask.mask_output_paths(sensors, 'both', 'day'),
+                         ('/sites/day.tif', '/sites/day_%s.tif' % rgbmask.BIN_MASK_OPT))
+
+    def test_nodata_option(self):
+        """The nodata value can't be a mask value or more than a byte holds"""
+        self.assertIsNone(parse_options([])['mask_nodata'])
+        self.assertEqual(parse_options(['--mask-nodata', '255'])['mask_nodata'], 255)
+        for bad_value in ('0', '1', '256'):
+            with self.assertRaises(ValueError):
+                parse_options(['--mask-nodata', bad_value])
+
+
+class NbitsWriteTest(unittest.TestCase):
+    """Writes single band masks with NBITS and reads them back
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_write_nbits(self):
+        """The mask reads back unchanged from a GeoTIFF with fewer bits per pixel"""
+        rng = np.random.RandomState(11)
+        img = rng.randint(0, 256, size=(300, 260, 3)).astype(np.uint8)
+        img[:10, :10] = 0
+        plants = rng.randint(0, 2, size=img.shape[:2]).astype(bool)
+
+        for nodata in (None, 3):
+            mask = rgbmask.gen_bin_mask(img, plants, nodata)
+            path = os.path.join(self.folder, 'mask_%s.tif' % str(nodata))
+            rgbmask.create_geotiff(mask, BOUNDS, path, nodata, False, None, None, None, 'LZW',
+                                   None, None, rgbmask.MASK_GEOTIFF_TILED,
+                                   rgbmask.MASK_GEOTIFF_THREADS, rgbmask.mask_nbits(nodata))
+
+            raster = gdal.Open(path)
+            band = raster.GetRasterBand(1)
+            self.assertEqual(band.GetMetadataItem('NBITS', 'IMAGE_STRUCTURE'),
+                             str(rgbmask.mask_nbits(nodata)))
+            self.assertTrue(np.array_equal(band.ReadAsArray(), mask))
+            if nodata is not None:
+                self.assertEqual(band.GetNoDataValue(), nodata)
+
+
+if __name__ == '__main__':
+    unittest.main()
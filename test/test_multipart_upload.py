@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""Tests the streamed multipart bodies of file uploads
+
+A temporary file is read through MultipartFileEncoder, so that the tests can check the length of
+the body, the size of each read, rewinding the body, and that the bytes sent are those of the
+multipart body urllib3 encodes in memory.
+
+The extractor's dependencies need to be installed, as they are in the extractor's container.
+
+Example:
+    python -m pytest test/test_multipart_upload.py
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import requests
+from urllib3.filepost import encode_multipart_formdata
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from terrautils.httpclient import MultipartFileEncoder
+
+# Size of the test file, and the chunk size of the bodies; the file takes several chunks
+FILE_SIZE = 10000
+CHUNK_SIZE = 1024
+
+
+def read_all(body, size=-1):
+    """Reads a body to its end, returning the bytes and the length of each read
+    """
+    pieces = []
+    while True:
+        piece = body.read(size)
+        if not piece:
+            break
+        pieces.append(piece)
+    return b''.join(pieces), [len(piece) for piece in pieces]
+
+
+class MultipartFileEncoderTest(unittest.TestCase):
+    """Reads a file through a multipart body
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.path = os.path.join(self.folder, 'mask "left".tif')
+        self.data = os.urandom(FILE_SIZE)
+        with open(self.path, 'wb') as out_file:
+            out_file.write(self.data)
+
+    def encoded(self, body):
+        """Returns the multipart body urllib3 encodes for the file, with the body's boundary
+        """
+        boundary = body.content_type.split('boundary=')[1]
+        file_name = os.path.basename(self.path).replace('"', '%22')
+        data, content_type = encode_multipart_formdata(
+            {'File': (file_name, self.data, 'image/tiff')}, boundary=boundary)
+        self.assertEqual(content_type, body.content_type)
+        return data
+
+    def test_body(self):
+        """The body is that of urllib3, read at most a chunk at a time"""
+        with MultipartFileEncoder('File', self.path, CHUNK_SIZE) as body:
+            expected = self.encoded(body)
+            self.assertEqual(len(body), len(expected))
+            self.assertEqual(body.len, len(expected))
+
+            data, sizes = read_all(body)
+            self.assertEqual(data, expected)
+            self.assertEqual(max(sizes), CHUNK_SIZE)
+            self.assertEqual(sum(sizes), len(expected))
+            self.assertEqual(body.tell(), body.len)
+
+            body.seek(0)
+            data, sizes = read_all(body, CHUNK_SIZE * 4)
+            self.assertEqual(data, expected)
+            self.assertEqual(max(sizes), CHUNK_SIZE)
+
+    def test_seek(self):
+        """Reads from any position continue with the bytes of the body from there"""
+        with MultipartFileEncoder('File', self.path, CHUNK_SIZE) as body:
+            expected = self.encoded(body)
+            head = len(expected) - FILE_SIZE - len(body.tail)
+            for position in (0, 10, head, head + 500, head + FILE_SIZE - 1, body.len - 3):
+                self.assertEqual(body.seek(position), position)
+                self.assertEqual(body.read(7), expected[position:position + 7])
+                self.assertEqual(body.tell(), min(position + 7, body.len))
+
+            self.assertEqual(body.seek(-5, os.SEEK_END), body.len - 5)
+            self.assertEqual(body.seek(2, os.SEEK_CUR), body.len - 3)
+            self.assertEqual(body.read(), expected[-3:])
+            self.assertEqual(body.seek(100, os.SEEK_END), body.len)
+            self.assertEqual(body.read(), b'')
+
+    def test_progress(self):
+        """The progress function is called with the bytes read and the total"""
+        calls = []
+        with MultipartFileEncoder('File', self.path, CHUNK_SIZE,
+                                  lambda sent, total: calls.append((sent, total))) as body:
+            read_all(body)
+            self.assertEqual(calls[-1], (body.len, body.len))
+            self.assertEqual([sent for sent, _ in calls], sorted(sent for sent, _ in calls))
+
+    def test_content_length(self):
+        """Requests send the body with a Content-Length instead of chunk encoding it"""
+        with MultipartFileEncoder('File', self.path, CHUNK_SIZE) as body:
+            request = requests.Request('POST', 'http://localhost/api/uploadToDataset/1', data=body,
+                                       headers={'Content-Type': body.content_type}).prepare()
+            self.assertEqual(request.headers['Content-Length'], str(body.len))
+            self.assertNotIn('Transfer-Encoding', request.headers)
+
+    def test_file_shrunk(self):
+        """A file cut short while it's uploaded fails the read instead of sending short"""
+        with MultipartFileEncoder('File', self.path, CHUNK_SIZE) as body:
+            with open(self.path, 'wb') as out_file:
+                out_file.write(self.data[:100])
+            with self.assertRaises(IOError):
+                read_all(body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""Tests masking images in their native EPSG space
+
+A UTM GeoTIFF of plant squares on soil is masked with gen_cc_enhanced_native(), which reprojects
+only the single band mask, and the mask is checked against the mask of the native image. The
+report of what the native masking saved is checked on its own.
+
+The extractor's dependencies need to be installed, as they are in the extractor's container.
+
+Example:
+    python -m pytest test/test_native_mask.py
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from osgeo import gdal, osr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+import terra_rgbmask as rgbmask
+
+# Size of the test image, as (height, width)
+IMAGE_SHAPE = (300, 400)
+
+# The UTM zone of the test image, its upper left corner and its pixel size in meters
+SOURCE_EPSG = 32612
+SOURCE_ORIGIN = (409000.0, 3660000.0)
+PIXEL_SIZE = 0.01
+
+# The nodata value of the single band mask, marking the pixels outside the reprojected image
+MASK_NODATA = 2
+
+
+def plant_squares_image():
+    """Returns a BGR image of plant squares on soil
+    """
+    img = np.empty(IMAGE_SHAPE + (3,), dtype=np.uint8)
+    img[:, :] = (90, 110, 140)
+    for top in range(10, IMAGE_SHAPE[0] - 30, 50):
+        for left in range(10, IMAGE_SHAPE[1] - 30, 50):
+            img[top:top + 30, left:left + 30] = (40, 200, 60)
+    return img
+
+
+def write_source(img, path):
+    """Writes a BGR image as an RGB GeoTIFF in SOURCE_EPSG
+    """
+    raster = gdal.GetDriverByName('GTiff').Create(path, img.shape[1], img.shape[0], 3,
+                                                  gdal.GDT_Byte)
+    raster.SetGeoTransform((SOURCE_ORIGIN[0], PIXEL_SIZE, 0, SOURCE_ORIGIN[1], 0, -PIXEL_SIZE))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(SOURCE_EPSG)
+    raster.SetProjection(srs.ExportToWkt())
+    for band in range(3):
+        raster.GetRasterBand(band + 1).WriteArray(img[:, :, 2 - band])
+    raster.FlushCache()
+
+
+class NativeWarpReportTest(unittest.TestCase):
+    """Tests the report of the bytes and CPU time saved by native masking
+    """
+
+    def test_saving(self):
+        """Warping a product smaller than the image is reported as a saving"""
+        report = rgbmask.native_warp_report(1000, 3000, 2.0)
+        self.assertIn("warped 1000 bytes of products instead of 3000 bytes", report)
+        self.assertIn("saving 2000 bytes", report)
+        self.assertIn("2.00s of CPU instead of an estimated 6.00s, saving 4.00s", report)
+
+    def test_negative_saving(self):
+        """Warping more bytes of products than of image is reported as a negative saving"""
+        report = rgbmask.native_warp_report(4000, 3000, 4.0)
+        self.assertIn("saving -1000 bytes", report)
+        self.assertIn("4.00s of CPU instead of an estimated 3.00s, saving -1.00s", report)
+
+    def test_nothing_warped(self):
+        """The CPU time of the image isn't estimated when nothing was warped"""
+        report = rgbmask.native_warp_report(0, 3000, 0.0)
+        self.assertIn("estimated 0.00s", report)
+
+
+class NativeMaskTest(unittest.TestCase):
+    """Masks a UTM image in its native space and writes the mask in EPSG:4326
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.source = os.path.join(self.folder, 'source.tif')
+        write_source(plant_squares_image(), self.source)
+
+    def test_native_mask(self):
+        """The reprojected mask keeps the values and the plant ratio of the native mask"""
+        # The output grid is that of the warped image, as mask_image_file() finds it
+        warped = rgbmask.reproject_image(self.source, 4326, 'VRT')
+        bounds = rgbmask.get_image_bounds(warped)
+        width, height = warped.RasterXSize, warped.RasterYSize
+
+        mask_path = os.path.join(self.folder, 'mask.tif')
+        ratio, warped_bytes, image_bytes, _ = \
+            rgbmask.gen_cc_enhanced_native(self.source, None, 4326, bounds, width, height,
+                                           quality_check=False, mask_path=mask_path,
+                                           mask_nodata=MASK_NODATA)
+
+        native_ratio, _, _ = rgbmask.gen_cc_enhanced_mask(self.source, quality_check=False)
+        self.assertAlmostEqual(ratio, native_ratio)
+        self.assertEqual(warped_bytes, IMAGE_SHAPE[0] * IMAGE_SHAPE[1])
+        self.assertEqual(image_bytes, 3 * IMAGE_SHAPE[0] * IMAGE_SHAPE[1])
+
+        output = gdal.Open(mask_path)
+        self.assertEqual((output.RasterXSize, output.RasterYSize), (width, height))
+        self.assertIn('4326', output.GetProjection())
+
+        # Nearest neighbour resampling keeps the mask values, and the plant pixels keep about
+        # the same share of the image
+        mask = output.GetRasterBand(1).ReadAsArray()
+        self.assertTrue(set(np.unique(mask).tolist()) <= set([0, 1, MASK_NODATA]))
+        image_pixels = np.count_nonzero(mask != MASK_NODATA)
+        self.assertGreater(image_pixels, 0)
+        self.assertAlmostEqual(np.count_nonzero(mask == 1) / float(image_pixels), native_ratio,
+                               delta=0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()
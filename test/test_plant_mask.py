@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""Tests that the fused plant mask matches the reference plant mask
+
+Random images are masked with gen_plant_mask() and gen_plant_mask_fused() for each odd kernel
+size, and the masks are compared bit for bit.
+
+The extractor's dependencies need to be installed, as they are in the extractor's container.
+
+Example:
+    python -m pytest test/test_plant_mask.py
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+import terra_rgbmask as rgbmask
+
+# Kernel sizes that are checked
+KERNELS = list(range(1, 22, 2))
+
+# Sizes of the random images, as (height, width); odd sizes exercise the borders of the filters
+IMAGE_SHAPES = [(1, 1), (7, 5), (64, 48), (97, 131), (256, 320)]
+
+# Number of random images of each shape and kind
+IMAGES_PER_KIND = 3
+
+
+def random_image(rng, shape, kind):
+    """Returns a random BGR image
+    Args:
+        rng(numpy RandomState): the source of random numbers
+        shape(tuple): the (height, width) of the image
+        kind(str): 'uniform' for uniform pixels, 'ties' for green and red values that are close
+                   or equal, 'patches' for large patches of plant and soil
+    Return:
+        The uint8 image
+    """
+    img = rng.randint(0, 256, size=shape + (3,)).astype(np.uint8)
+    if kind == 'ties':
+        # Ties between green and red are the boundary of the G>R test
+        img[:, :, 1] = np.clip(img[:, :, 2].astype(int) + rng.randint(-1, 2, size=shape),
+                               0, 255)
+    elif kind == 'patches':
+        plant = rng.randint(0, 2, size=(shape[0] // 8 + 1, shape[1] // 8 + 1)).astype(bool)
+        plant = np.repeat(np.repeat(plant, 8, axis=0), 8, axis=1)[:shape[0], :shape[1]]
+        img[:, :, 1] = np.where(plant, 200, 40)
+        img[:, :, 2] = np.where(plant, 60, 120)
+    return img
+
+
+class PlantMaskParityTest(unittest.TestCase):
+    """Compares the fused plant mask against the reference implementation
+    """
+
+    def check_kind(self, kind, seed):
+        rng = np.random.RandomState(seed)
+        for shape in IMAGE_SHAPES:
+            for idx in range(IMAGES_PER_KIND):
+                img = random_image(rng, shape, kind)
+                for kernel in KERNELS:
+                    expected = rgbmask.gen_plant_mask(img, kernel)
+                    actual = rgbmask.gen_plant_mask_fused(img, kernel)
+                    message = "shape %s image %d kernel %d: %d pixels differ" % \
+                              (shape, idx, kernel, np.count_nonzero(expected != actual))
+                    self.assertEqual(actual.dtype, expected.dtype, message)
+                    self.assertTrue(np.array_equal(expected, actual), message)
+
+    def test_uniform_images(self):
+        """Masks of uniformly random pixels are identical"""
+        self.check_kind('uniform', 0)
+
+    def test_green_red_ties(self):
+        """Masks of pixels on the G > R boundary are identical"""
+        self.check_kind('ties', 1)
+
+    def test_plant_patches(self):
+        """Masks of patches of plants and soil are identical"""
+        self.check_kind('patches', 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
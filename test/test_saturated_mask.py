@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""Tests that saturated areas are added to the mask the way the original loop added them
+
+Random masks of saturated pixels are classified with saturated_pixel_classification(), labeling
+over several numbers of threads, and compared bit for bit with a loop that checks each labeled
+area on its own.
+
+The extractor's dependencies need to be installed, as they are in the extractor's container.
+
+Example:
+    python -m pytest test/test_saturated_mask.py
+"""
+
+import os
+import sys
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import numpy as np
+from skimage import morphology
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+import terra_rgbmask as rgbmask
+import component_labels
+
+# Numbers of labeling threads that are checked
+WORKER_COUNTS = [1, 2, 4]
+
+# Sizes of the random masks, as (height, width)
+MASK_SHAPES = [(1, 1), (17, 23), (150, 90), (260, 200)]
+
+# Largest saturated area added to the mask by the tests, small enough for the random areas to
+# fall on both sides of it
+TEST_MAX_AREA = 30
+
+
+def reference_classification(baseMask, saturatedMask, dilateSize):
+    """Adds the saturated areas touching the mask one label at a time, as the original code did
+    """
+    saturatedMask = morphology.binary_dilation(saturatedMask, morphology.diamond(dilateSize))
+    label_img, num = morphology.label(saturatedMask, connectivity=2, return_num=True)
+
+    rel_mask = baseMask.copy()
+    for i in range(1, num + 1):
+        x = (label_img == i)
+        if np.sum(x) > rgbmask.MAX_SATURATED_AREA:
+            continue
+        if not (x & baseMask).any():
+            continue
+        rel_mask |= x
+
+    return rel_mask
+
+
+class SaturatedClassificationTest(unittest.TestCase):
+    """Compares saturated_pixel_classification() against the per label loop
+    """
+
+    def setUp(self):
+        self.addCleanup(component_labels.set_label_workers,
+                        component_labels.get_label_workers())
+        patcher = mock.patch.object(rgbmask, 'MAX_SATURATED_AREA', TEST_MAX_AREA)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_matches_loop(self):
+        """Saturated areas are added like the per label loop adds them"""
+        rng = np.random.RandomState(3)
+        for shape in MASK_SHAPES:
+            for dilate in (0, 1):
+                base = rng.randint(0, 100, size=shape) < 30
+                saturated = rng.randint(0, 100, size=shape) < 15
+                gray = rng.randint(0, 256, size=shape).astype(np.uint8)
+                expected = reference_classification(base, saturated, dilate)
+                for workers in WORKER_COUNTS:
+                    component_labels.set_label_workers(workers)
+                    found = rgbmask.saturated_pixel_classification(gray, base, saturated, dilate)
+                    self.assertTrue(np.array_equal(found, expected),
+                                    "%s mask, dilated by %s, %s workers" %
+                                    (shape, dilate, workers))
+
+    def test_last_label_is_added(self):
+        """The last labeled area is considered too"""
+        base = np.zeros((10, 10), dtype=bool)
+        saturated = np.zeros((10, 10), dtype=bool)
+        saturated[1, 1] = True
+        saturated[8, 7:9] = True
+        base[8, 9] = True
+
+        found = rgbmask.saturated_pixel_classification(None, base, saturated, 1)
+        self.assertTrue(found[8, 7])
+        self.assertFalse(found[1, 1])
+
+    def test_large_area_is_not_added(self):
+        """A saturated area larger than MAX_SATURATED_AREA isn't added"""
+        base = np.zeros((20, 20), dtype=bool)
+        base[0, 0] = True
+        saturated = np.zeros((20, 20), dtype=bool)
+        saturated[:, :TEST_MAX_AREA // 20 + 1] = True
+
+        found = rgbmask.saturated_pixel_classification(None, base, saturated)
+        self.assertTrue(np.array_equal(found, base))
+
+
+if __name__ == '__main__':
+    unittest.main()
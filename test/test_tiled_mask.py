@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""Tests that masking an image in tiles writes the same products as masking it whole
+
+A GeoTIFF of plant squares on soil is masked with gen_cc_enhanced_tiled() using a small memory
+budget, so that it's split into several tiles, and the products are compared bit for bit with
+the mask of the whole image. The plant squares are smaller than the tile halo, so the tiles
+don't change how they're classified.
+
+The extractor's dependencies need to be installed, as they are in the extractor's container.
+
+Example:
+    python -m pytest test/test_tiled_mask.py
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from osgeo import gdal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+import terra_rgbmask as rgbmask
+
+# Size of the test image, as (height, width); neither is a multiple of the block sizes
+IMAGE_SHAPE = (700, 900)
+
+# Block size of the source GeoTIFF
+SOURCE_BLOCK = 128
+
+# Size and spacing of the plant squares
+SQUARE_SIZE = 20
+SQUARE_SPACING = 40
+
+# Memory budget small enough to split the image into several tiles
+TILED_MEMORY_MB = 1
+
+BOUNDS = (33.0, 33.001, -111.001, -111.0)
+
+
+def plant_squares_image():
+    """Returns a BGR image of plant squares on soil
+    """
+    img = np.empty(IMAGE_SHAPE + (3,), dtype=np.uint8)
+    img[:, :] = (90, 110, 140)
+    rng = np.random.RandomState(2)
+    for top in range(5, IMAGE_SHAPE[0] - SQUARE_SIZE, SQUARE_SPACING):
+        for left in range(5, IMAGE_SHAPE[1] - SQUARE_SIZE, SQUARE_SPACING):
+            img[top:top + SQUARE_SIZE, left:left + SQUARE_SIZE] = (40, 200, 60)
+    # Speckle the soil with single plant pixels, which the mask removes
+    speckles = rng.randint(0, 100, size=IMAGE_SHAPE) == 0
+    img[speckles] = (40, 200, 60)
+    return img
+
+
+def write_source(img, path):
+    """Writes a BGR image as a tiled RGB GeoTIFF
+    """
+    raster = gdal.GetDriverByName('GTiff').Create(path, img.shape[1], img.shape[0], 3,
+                                                  gdal.GDT_Byte,
+                                                  ['TILED=YES',
+                                                   'BLOCKXSIZE=%s' % SOURCE_BLOCK,
+                                                   'BLOCKYSIZE=%s' % SOURCE_BLOCK])
+    for band in range(3):
+        raster.GetRasterBand(band + 1).WriteArray(img[:, :, 2 - band])
+    raster.FlushCache()
+
+
+def read_bands(path):
+    """Returns the bands of a GeoTIFF as rows x columns x bands
+    """
+    raster = gdal.Open(path)
+    return np.dstack([raster.GetRasterBand(band + 1).ReadAsArray()
+                      for band in range(raster.RasterCount)])
+
+
+class TileSizeTest(unittest.TestCase):
+    """Tests the rounding of tiles to the blocks of the source and the outputs
+    """
+
+    def test_common_multiple(self):
+        """Tiles are whole blocks of the source and of the outputs"""
+        self.assertEqual(rgbmask.tile_step(300, 128, [256]), 512)
+        self.assertEqual(rgbmask.tile_step(400, 96, [256, 256]), 768)
+        self.assertEqual(rgbmask.tile_step(300, 1, [256]), 512)
+        self.assertEqual(rgbmask.tile_step(300, 128, []), 384)
+
+    def test_large_common_multiple(self):
+        """Tiles keep to the output blocks when the common multiple is too large"""
+        self.assertEqual(rgbmask.tile_step(256, 96, [256]), 256)
+        self.assertEqual(rgbmask.tile_step(300, 1000, [256]), 512)
+
+
+class TiledMaskTest(unittest.TestCase):
+    """Compares the products of a tiled image against those of the whole image
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.img = plant_squares_image()
+        self.source = os.path.join(self.folder, 'source.tif')
+        write_source(self.img, self.source)
+
+    def test_tiles_are_aligned(self):
+        """The tiles are split on block boundaries of the source and the outputs"""
+        out_raster = rgbmask.create_geotiff_dataset(IMAGE_SHAPE[0], IMAGE_SHAPE[1], 1, BOUNDS,
+                                                    os.path.join(self.folder, 'blocks.tif'),
+                                                    None, tiled=True)
+        out_x, out_y = out_raster.GetRasterBand(1).GetBlockSize()
+        tile_x, tile_y = rgbmask.get_tile_size(gdal.Open(self.source), TILED_MEMORY_MB,
+                                               rgbmask.TILE_HALO, [out_raster])
+
+        self.assertLess(tile_x, IMAGE_SHAPE[1])
+        for tile, out_block in ((tile_x, out_x), (tile_y, out_y)):
+            self.assertEqual(tile % SOURCE_BLOCK, 0)
+            self.assertEqual(tile % out_block, 0)
+
+    def test_tiled_matches_whole(self):
+        """The tiled products are the same as the products of the whole image"""
+        rgb_path = os.path.join(self.folder, 'rgb.tif')
+        mask_path = os.path.join(self.folder, 'mask.tif')
+        ratio = rgbmask.gen_cc_enhanced_tiled(self.source, rgb_path, BOUNDS,
+                                              memory_mb=TILED_MEMORY_MB, quality_check=False,
+                                              mask_path=mask_path, mask_nodata=None)
+
+        whole_ratio, img, binMask = rgbmask.gen_cc_enhanced_mask(self.source,
+                                                                 quality_check=False)
+        expected_mask = rgbmask.gen_bin_mask(img, binMask)
+        expected_rgb = rgbmask.gen_rgb_mask(img, binMask.view(np.uint8))[:, :, ::-1]
+
+        self.assertGreater(np.count_nonzero(expected_mask), 0)
+        self.assertAlmostEqual(ratio, whole_ratio)
+        self.assertTrue(np.array_equal(read_bands(mask_path)[:, :, 0], expected_mask))
+        self.assertTrue(np.array_equal(read_bands(rgb_path), expected_rgb))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""Tests the background upload queue
+
+Uploads are replaced by calls that record their order, or fail, so that the tests can check
+that uploads run in the order they're queued and that the error of a failed upload is reported
+once.
+
+The extractor's dependencies need to be installed, as they are in the extractor's container.
+
+Example:
+    python -m pytest test/test_upload_queue.py
+"""
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from terrautils import extractors
+
+# Number of uploads queued by the ordering test; more than the queue holds
+UPLOAD_COUNT = 50
+
+
+class UploadError(Exception):
+    """The error raised by a failing upload
+    """
+
+
+def fail_upload():
+    """An upload that fails
+    """
+    raise UploadError("upload failed")
+
+
+class UploadQueueTest(unittest.TestCase):
+    """Tests the ordering and the errors of the upload queue
+    """
+
+    def setUp(self):
+        self.queue = extractors.UploadQueue(4)
+        self.done = []
+
+    def upload(self, name):
+        """An upload that records its name
+        """
+        self.done.append((name, threading.current_thread().name))
+
+    def test_order(self):
+        """Uploads run one at a time in the background thread, in the order they're queued"""
+        for idx in range(UPLOAD_COUNT):
+            self.queue.submit(self.upload, idx)
+        self.assertIsNone(self.queue.wait())
+
+        self.assertEqual([name for name, _ in self.done], list(range(UPLOAD_COUNT)))
+        self.assertEqual(set(thread for _, thread in self.done), set(["uploads"]))
+
+    def test_error_from_wait(self):
+        """The uploads after a failure are dropped and wait() returns the error"""
+        self.queue.submit(self.upload, 'first')
+        self.queue.submit(fail_upload)
+        self.queue.submit(self.upload, 'dropped')
+
+        error = self.queue.wait()
+        self.assertIsInstance(error, UploadError)
+        self.assertEqual([name for name, _ in self.done], ['first'])
+
+        # The queue is used again after the error is returned
+        self.queue.submit(self.upload, 'next')
+        self.assertIsNone(self.queue.wait())
+        self.assertEqual([name for name, _ in self.done], ['first', 'next'])
+
+    def test_error_raised_once(self):
+        """An error raised by submit() isn't returned by wait() again"""
+        self.queue.submit(fail_upload)
+        self.queue.tasks.join()
+
+        with self.assertRaises(UploadError):
+            self.queue.submit(self.upload, 'dropped')
+        # Uploads are refused until the caller is done with the failed message
+        with self.assertRaises(UploadError):
+            self.queue.submit(self.upload, 'dropped')
+        self.assertIsNone(self.queue.wait())
+        self.assertEqual(self.done, [])
+
+        self.queue.submit(self.upload, 'next')
+        self.assertIsNone(self.queue.wait())
+        self.assertEqual([name for name, _ in self.done], ['next'])
+
+
+if __name__ == '__main__':
+    unittest.main()